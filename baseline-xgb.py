@@ -0,0 +1,439 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import polars as pl
+from utils.models import MODEL_PATH, get_meta, save_model
+from utils.profiling import (
+    load_profile,
+    print_profile,
+    profile,
+    start_profiling,
+    stop_profiling,
+)
+from utils.rollups import GRAINS, LEVELS, align_days
+from utils.search import (
+    METRICS,
+    halving_schedule,
+    init_worker,
+    sample_params,
+    successive_halving,
+)
+from utils.stations import line_station_table, load_registry
+from utils.training import BACKENDS, cv, fit, rolling_origin_splits
+
+target_col = "passage"
+date_col = "timestamp"
+
+# results/<name>/ -> line_name, None trains one model on every line. on a
+# rollup the results are results/<name>_<level>_<grain>/
+experiments = {
+    "m1": "M1",
+    "m2": "M2",
+    "m4": "M4",
+    "t1": "T1",
+    "marmaray": "MARMARAY",
+    "all": None,
+}
+
+LOG1P = True
+
+param = {
+    "max_depth": 5,
+    "learning_rate": 0.02,
+    "n_estimators": 300,
+    "subsample": 0.8,
+    "colsample_bytree": 0.8,
+    "min_child_weight": 10,
+    "gamma": 3,
+    "objective": "reg:absoluteerror",
+}
+
+
+def xy_dir(level: str = "station", grain: str = "1h") -> str:
+    # where process-data.py writes the features of a level and grain
+    if (level, grain) == ("station", "1h"):
+        return "data/Xy"
+    return f"data/Xy_{level}_{grain}"
+
+
+def load_xy(
+    lines: list[str], level: str = "station", grain: str = "1h"
+) -> pl.DataFrame:
+    # one scan for every experiment, the filters are pushed into the parquet
+    # reader so only the row groups of the requested lines are decoded. the
+    # network rollup has no lines
+    filters = [
+        pl.col(date_col) >= datetime(2023, 1, 1, 0, 0, 0),
+        pl.col(target_col).is_not_null(),
+    ]
+    if "line_name" in LEVELS[level]:
+        filters.append(pl.col("line_name").is_in(lines))
+
+    return (
+        pl.scan_parquet(f"{xy_dir(level, grain)}/*.parquet").filter(filters).collect()
+    )
+
+
+def pin_worker(cores):
+    # every worker takes its own block of cores, so concurrent experiments do
+    # not oversubscribe or migrate between each other's cores
+    os.sched_setaffinity(0, cores.get())
+
+
+def core_blocks(context, workers: int, n_jobs: int):
+    cores = context.Queue()
+    available = sorted(os.sched_getaffinity(0))
+    for i in range(workers):
+        cores.put(available[i * n_jobs : (i + 1) * n_jobs])
+    return cores
+
+
+def load_experiment(
+    line: str | None, xy_path: str, level: str = "station"
+) -> tuple[pl.DataFrame, str]:
+    # the decoded table is memory mapped, every worker shares the same pages
+    df = pl.read_ipc(xy_path, memory_map=True)
+    if level != "station":
+        # a line or network series is keyed by the last column of its level
+        if line is not None:
+            df = df.filter(pl.col("line_name") == line)
+        return df, LEVELS[level][-1]
+
+    if line is None:
+        df = df.join(
+            line_station_table(load_registry(), df.schema),
+            on=["line_name", "station"],
+        ).drop("line_name", "station")
+        return df, "line_station"
+
+    return df.filter(pl.col("line_name") == line).drop("line_name"), "station"
+
+
+def save_experiment(
+    name: str,
+    line: str | None,
+    df: pl.DataFrame,
+    cat_col,
+    params,
+    cv_options,
+    path,
+    metrics: pl.DataFrame,
+):
+    # refit on every row and persist the booster with the schema serving needs
+    # and the cv metrics, as a new version of models/<name>/
+    xgb, matrix = fit(
+        df,
+        target_col,
+        date_col,
+        cat_col,
+        params,
+        LOG1P,
+        cv_options["backend"],
+        cv_options["nthread"],
+        cv_options["grain"],
+    )
+    meta = get_meta(
+        name, line, df, matrix, target_col, date_col, cat_col, params, LOG1P, metrics
+    )
+    version = save_model(xgb, meta, name, path)
+    print(f"saved {name} version {version} to {path}")
+
+
+def run_experiment(
+    name: str,
+    line: str | None,
+    xy_path: str,
+    params: dict,
+    cv_options: dict,
+    model_path: str | None = None,
+    profile_path: str | None = None,
+    level: str = "station",
+):
+    # with model_path the experiment is also refit on all its rows and saved,
+    # with profile_path its stages and cv folds are logged there
+    if profile_path is not None:
+        start_profiling(profile_path, experiment=name)
+
+    with profile("load_experiment") as record:
+        df, cat_col = load_experiment(line, xy_path, level)
+        record["rows_out"] = len(df)
+    with profile("cv", rows_in=len(df), folds=len(cv_options["splits"])):
+        by_all, by_cat = cv(
+            df,
+            target_col,
+            date_col,
+            cat_col,
+            params,
+            log1p=LOG1P,
+            **cv_options,
+        )
+
+    os.makedirs(f"results/{name}", exist_ok=True)
+    by_all.write_parquet(f"results/{name}/xgb_split.parquet")
+    by_cat.write_parquet(f"results/{name}/xgb_cat_split.parquet")
+
+    if model_path is not None:
+        with profile("save_experiment", rows_in=len(df)):
+            save_experiment(
+                name, line, df, cat_col, params, cv_options, model_path, by_all
+            )
+
+    stop_profiling()
+    return by_all, by_cat
+
+
+def run_search(
+    name: str,
+    line: str | None,
+    xy_path: str,
+    params: dict,
+    cv_options: dict,
+    args,
+    workers: int,
+    cores,
+    context,
+) -> pl.DataFrame:
+    # every worker loads the experiment once, the candidates of each rung are
+    # spread over them, the trial log is results/<name>/search.parquet
+    candidates = sample_params(params, args.search, seed=args.seed)
+    schedule = halving_schedule(
+        len(cv_options["splits"]), args.min_rounds, params["n_estimators"], args.eta
+    )
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=init_worker,
+        initargs=(
+            load_experiment,
+            (line, xy_path, args.level),
+            target_col,
+            date_col,
+            cv_options["splits"],
+            LOG1P,
+            cv_options["backend"],
+            cv_options["nthread"],
+            cores,
+            cv_options["grain"],
+        ),
+    ) as pool:
+        return successive_halving(
+            pool,
+            candidates,
+            schedule,
+            f"results/{name}/search.parquet",
+            args.metric,
+            args.eta,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "experiments",
+        nargs="*",
+        help=f"any of {', '.join(experiments)}, all of them by default",
+    )
+    parser.add_argument(
+        "--level",
+        choices=LEVELS,
+        default="station",
+        help="train on a rollup written by process-data.py --level",
+    )
+    parser.add_argument("--grain", choices=GRAINS, default="1h")
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="total cores shared by all experiments",
+    )
+    parser.add_argument(
+        "--workers", type=int, help="experiments run at once, defaults to one per core"
+    )
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="continue every fold from the previous fold's booster",
+    )
+    parser.add_argument("--warm-rounds", type=int, default=100)
+    parser.add_argument(
+        "--early-stopping",
+        type=int,
+        help="stop after this many rounds without improvement on a held out tail",
+    )
+    parser.add_argument("--holdout-days", type=int, default=14)
+    parser.add_argument("--backend", choices=BACKENDS, default="auto")
+    parser.add_argument(
+        "--pin",
+        action="store_true",
+        help="pin every worker to its own block of --cpus // --workers cores",
+    )
+    parser.add_argument("--max-bin", type=int, help="histogram bins per feature")
+    parser.add_argument(
+        "--external-memory",
+        action="store_true",
+        help="feed the training rows of every fold in batches, histogram pages on disk",
+    )
+    parser.add_argument("--folds", type=int, default=4)
+    parser.add_argument("--fold-days", type=int, default=30, help="test window length")
+    parser.add_argument(
+        "--fold-step", type=int, help="days between origins, --fold-days by default"
+    )
+    parser.add_argument(
+        "--save-models",
+        action="store_true",
+        help="refit every experiment on all its rows and save it for serving",
+    )
+    parser.add_argument("--models-dir", default=MODEL_PATH)
+    parser.add_argument(
+        "--search",
+        type=int,
+        metavar="N",
+        help="search N configs with successive halving instead of one cv run",
+    )
+    parser.add_argument("--eta", type=int, default=3, help="1/eta survive a rung")
+    parser.add_argument("--min-rounds", type=int, default=30)
+    parser.add_argument("--metric", choices=METRICS, default="mae")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="results/profile",
+        metavar="DIR",
+        help="log time, rows and peak rss of every stage and cv fold to DIR/<name>.jsonl",
+    )
+    args = parser.parse_args()
+
+    # the network rollup is a single series, only the all experiment exists
+    default = ["all"] if args.level == "network" else list(experiments)
+    names = list(dict.fromkeys(args.experiments or default))
+    unknown = [name for name in names if name not in experiments]
+    if unknown:
+        parser.error(f"unknown experiments {unknown}")
+    if args.level == "network" and names != ["all"]:
+        parser.error("the network rollup only has the all experiment")
+    rollup = (args.level, args.grain) != ("station", "1h")
+    runs = {
+        name: f"{name}_{args.level}_{args.grain}" if rollup else name for name in names
+    }
+    if args.profile and args.search:
+        parser.error("--profile is not supported with --search")
+    if args.external_memory and args.search:
+        parser.error("--external-memory is not supported with --search")
+
+    # a search runs its candidates in parallel, otherwise the experiments
+    workers = min(args.workers or args.cpus, args.cpus, args.search or len(names))
+    n_jobs = max(args.cpus // workers, 1)
+
+    lines = [line for line in experiments.values() if line is not None]
+    if all(experiments[name] is not None for name in names):
+        lines = [experiments[name] for name in names]
+
+    params = param
+    if args.max_bin is not None:
+        params = {**param, "max_bin": args.max_bin}
+
+    cv_options = {
+        "backend": args.backend,
+        "nthread": n_jobs,
+        "warm_start": args.warm_start,
+        "warm_rounds": args.warm_rounds,
+        "early_stopping_rounds": args.early_stopping,
+        "holdout_days": align_days(args.holdout_days, args.grain),
+        # day counts are rounded up to whole weeks on a weekly rollup
+        "splits": rolling_origin_splits(
+            datetime(2024, 6, 30, 23, 0),
+            args.folds,
+            timedelta(days=align_days(args.fold_days, args.grain)),
+            timedelta(days=align_days(args.fold_step or args.fold_days, args.grain)),
+            args.grain,
+        ),
+        "grain": args.grain,
+    }
+
+    # the workers inherit the thread budget, polars and openmp read it on
+    # import
+    os.environ["POLARS_MAX_THREADS"] = str(n_jobs)
+    os.environ["OMP_NUM_THREADS"] = str(n_jobs)
+
+    context = multiprocessing.get_context("spawn")
+    if args.pin and len(os.sched_getaffinity(0)) < workers * n_jobs:
+        parser.error(
+            f"--pin needs {workers * n_jobs} cores, "
+            f"{len(os.sched_getaffinity(0))} available"
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        xy_path = os.path.join(tmp, "Xy.arrow")
+        if args.external_memory:
+            cv_options["external_memory"] = os.path.join(tmp, "pages")
+        load_xy(lines, args.level, args.grain).write_ipc(
+            xy_path, compression="uncompressed"
+        )
+
+        if args.search:
+            for name in names:
+                cores = core_blocks(context, workers, n_jobs) if args.pin else None
+                best = run_search(
+                    runs[name],
+                    experiments[name],
+                    xy_path,
+                    params,
+                    cv_options,
+                    args,
+                    workers,
+                    cores,
+                    context,
+                )
+                trials = pl.DataFrame([json.loads(p) for p in best["params"]])
+                with pl.Config(tbl_cols=-1):
+                    print(
+                        runs[name],
+                        pl.concat(
+                            [best.select("trial", "score"), trials], how="horizontal"
+                        ),
+                    )
+        else:
+            cores = core_blocks(context, workers, n_jobs) if args.pin else None
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=pin_worker if args.pin else None,
+                initargs=(cores,),
+            ) as pool:
+                futures = {
+                    pool.submit(
+                        run_experiment,
+                        runs[name],
+                        experiments[name],
+                        xy_path,
+                        params,
+                        cv_options,
+                        args.models_dir if args.save_models else None,
+                        (
+                            os.path.join(args.profile, f"{runs[name]}.jsonl")
+                            if args.profile
+                            else None
+                        ),
+                        args.level,
+                    ): runs[name]
+                    for name in names
+                }
+                for future in as_completed(futures):
+                    by_all, by_cat = future.result()
+                    print(futures[future], by_cat, by_all)
+
+            if args.profile:
+                print_profile(
+                    load_profile(
+                        [
+                            os.path.join(args.profile, f"{runs[name]}.jsonl")
+                            for name in names
+                        ]
+                    ),
+                    by=["experiment"],
+                )
@@ -0,0 +1,74 @@
+import argparse
+import time
+from datetime import datetime
+
+import polars as pl
+from utils.matrix import get_matrix, to_dmatrix
+from utils.training import get_device, train_xgb
+
+target_col = "passage"
+date_col = "timestamp"
+
+param = {
+    "max_depth": 5,
+    "learning_rate": 0.02,
+    "subsample": 0.8,
+    "colsample_bytree": 0.8,
+    "min_child_weight": 10,
+    "gamma": 3,
+    "objective": "reg:absoluteerror",
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--line", help="one line, every line by default")
+    parser.add_argument("--backends", nargs="+", default=["cpu", "auto"])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1])
+    parser.add_argument("--max-bin", type=int, nargs="+", default=[256])
+    parser.add_argument("--rounds", type=int, default=100)
+    args = parser.parse_args()
+
+    filters = [
+        pl.col(date_col) >= datetime(2023, 1, 1, 0, 0, 0),
+        pl.col(target_col).is_not_null(),
+    ]
+    if args.line is not None:
+        filters.append(pl.col("line_name") == args.line)
+    df = pl.scan_parquet("data/Xy/*.parquet").filter(*filters).collect()
+    matrix = get_matrix(df.drop("line_name"), target_col, date_col, "station")
+
+    rows = []
+    for backend in dict.fromkeys(args.backends):
+        device = get_device(backend)
+        for nthread in args.threads:
+            for max_bin in args.max_bin:
+                start = time.perf_counter()
+                dtrain = to_dmatrix(matrix, max_bin=max_bin, nthread=nthread)
+                build = time.perf_counter() - start
+
+                start = time.perf_counter()
+                train_xgb(
+                    dtrain,
+                    {**param, "n_estimators": args.rounds, "max_bin": max_bin},
+                    backend=backend,
+                    nthread=nthread,
+                )
+                seconds = time.perf_counter() - start
+
+                # rows through one boosting round per second
+                rows.append(
+                    {
+                        "backend": backend,
+                        "device": device,
+                        "nthread": nthread,
+                        "max_bin": max_bin,
+                        "build_s": build,
+                        "train_s": seconds,
+                        "rows_per_s": len(df) * args.rounds / seconds,
+                    }
+                )
+
+    print(f"{len(df)} rows x {matrix.X.shape[1]} features, {args.rounds} rounds")
+    with pl.Config(tbl_rows=-1):
+        print(pl.DataFrame(rows))
@@ -0,0 +1,92 @@
+import argparse
+import tempfile
+import time
+from datetime import datetime
+
+import polars as pl
+from utils.profiling import read_hwm, reset_hwm
+from utils.training import BACKENDS, cv
+
+target_col = "passage"
+date_col = "timestamp"
+
+param = {
+    "max_depth": 5,
+    "learning_rate": 0.02,
+    "n_estimators": 300,
+    "subsample": 0.8,
+    "colsample_bytree": 0.8,
+    "min_child_weight": 10,
+    "gamma": 3,
+    "objective": "reg:absoluteerror",
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--line", default="M1")
+    parser.add_argument("--warm-rounds", type=int, default=100)
+    parser.add_argument("--early-stopping", type=int, default=30)
+    parser.add_argument("--holdout-days", type=int, default=14)
+    parser.add_argument("--backend", choices=BACKENDS, default="auto")
+    parser.add_argument(
+        "--batch-rows", type=int, default=2**16, help="rows per external memory batch"
+    )
+    args = parser.parse_args()
+
+    df = (
+        pl.scan_parquet("data/Xy/*.parquet")
+        .filter(
+            pl.col(date_col) >= datetime(2023, 1, 1, 0, 0, 0),
+            pl.col("line_name") == args.line,
+            pl.col(target_col).is_not_null(),
+        )
+        .drop("line_name")
+        .collect()
+    )
+
+    pages = tempfile.TemporaryDirectory()
+    modes = {
+        "scratch": {},
+        "warm": {"warm_start": True},
+        "early_stopping": {"early_stopping_rounds": args.early_stopping},
+        "warm_early_stopping": {
+            "warm_start": True,
+            "early_stopping_rounds": args.early_stopping,
+        },
+        "external_memory": {
+            "external_memory": pages.name,
+            "batch_rows": args.batch_rows,
+        },
+    }
+
+    # the peak is the rss high-water mark of the mode, the frame included
+    rows = []
+    for mode, options in modes.items():
+        reset_hwm()
+        start = time.perf_counter()
+        by_all, _ = cv(
+            df,
+            target_col,
+            date_col,
+            "station",
+            param,
+            warm_rounds=args.warm_rounds,
+            holdout_days=args.holdout_days,
+            backend=args.backend,
+            **options,
+        )
+        rows.append(
+            by_all.select(pl.col("rmse", "medae", "mae", "mape").mean()).with_columns(
+                mode=pl.lit(mode),
+                seconds=time.perf_counter() - start,
+                peak_rss_mb=read_hwm(),
+            )
+        )
+    pages.cleanup()
+
+    print(
+        pl.concat(rows)
+        .select("mode", "seconds", "peak_rss_mb", "rmse", "medae", "mae", "mape")
+        .with_columns(speedup=pl.col("seconds").first() / pl.col("seconds"))
+    )
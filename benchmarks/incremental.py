@@ -0,0 +1,115 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import polars as pl
+from utils.stations import canonicalize
+from utils.synthetic import generate_raw
+
+SCRIPT = os.path.abspath("process-data.py")
+
+
+def process_data(path: str, *args: str) -> float:
+    # process-data.py reads and writes data/ under its working directory
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, SCRIPT, "--no-cache", *args],
+        cwd=path,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def write_raw(path: str, raw: pl.DataFrame):
+    os.makedirs(os.path.join(path, "data"), exist_ok=True)
+    raw.write_parquet(os.path.join(path, "data", "hourly_transportation.parquet"))
+
+
+def read_xy(path: str) -> pl.DataFrame:
+    return pl.read_parquet(os.path.join(path, "data", "Xy", "*.parquet")).sort(
+        "line_name", "station", "timestamp"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=2)
+    parser.add_argument("--stations", type=int, default=3)
+    parser.add_argument("--days", type=int, default=420)
+    parser.add_argument(
+        "--new-days", type=int, default=45, help="days the refresh appends"
+    )
+    parser.add_argument(
+        "--quiet-days",
+        type=int,
+        default=200,
+        help="days without a row of one station at the end, past the lookback",
+    )
+    args = parser.parse_args()
+
+    start = datetime(2023, 1, 1)
+    raw = generate_raw(
+        lines=args.lines, stations=args.stations, days=args.days, start=start.date()
+    )
+    day = lambda days: (start + timedelta(days=days)).strftime("%Y-%m-%d")
+    # one station stops reporting long before the refresh, its slice is empty
+    quiet = raw.get_column("station_poi_desc_cd")[0]
+    raw = raw.filter(
+        (pl.col("station_poi_desc_cd") != quiet)
+        | (pl.col("transition_date") < day(args.days - args.quiet_days))
+    )
+    old = raw.filter(pl.col("transition_date") < day(args.days - args.new_days))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        full_path, incremental_path = [os.path.join(tmp, name) for name in "ab"]
+
+        write_raw(full_path, raw)
+        full_time = process_data(full_path)
+        full = read_xy(full_path)
+
+        write_raw(incremental_path, old)
+        process_data(incremental_path)
+        write_raw(incremental_path, raw)
+        incremental_time = process_data(incremental_path, "--incremental")
+        incremental = read_xy(incremental_path)
+
+    keys = ["line_name", "station", "timestamp"]
+    assert full.select(keys).equals(incremental.select(keys)), "rows differ"
+    for col in full.columns:
+        a, b = full.get_column(col), incremental.get_column(col)
+        assert a.is_null().equals(b.is_null()), f"{col} nulls differ"
+        if a.dtype.is_float():
+            # the windows of the refresh start from a different first row, so
+            # the float32 features may differ by rounding
+            a, b = a.to_numpy().astype(np.float64), b.to_numpy().astype(np.float64)
+            assert np.allclose(a, b, rtol=1e-5, atol=1e-6, equal_nan=True), col
+        elif col not in keys:
+            assert a.equals(b), f"{col} differs"
+
+    # the null rows of the quiet station in the months the refresh rewrote
+    station = pl.select(canonicalize(pl.lit(quiet))).item()
+    refresh = start + timedelta(days=args.days - args.new_days)
+    print(
+        pl.DataFrame(
+            {
+                "run": ["full", "incremental"],
+                "rows": [len(full), len(incremental)],
+                "quiet_rows": [
+                    len(
+                        df.filter(
+                            pl.col("station") == station,
+                            pl.col("timestamp") >= refresh,
+                        )
+                    )
+                    for df in [full, incremental]
+                ],
+                "seconds": [full_time, incremental_time],
+            }
+        )
+    )
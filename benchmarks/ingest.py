@@ -0,0 +1,91 @@
+import argparse
+import time
+
+import polars as pl
+from utils.ingest import scan_raw
+
+lines = ["M1", "M2", "M4", "T1", "MARMARAY"]
+
+
+def legacy_ingest(path: str) -> pl.LazyFrame:
+    # timestamp construction of process-data.py before utils.ingest
+    df = (
+        pl.scan_parquet(path)
+        .filter(pl.col("road_type") == "RAYLI")
+        .select(
+            "line_name",
+            "station_poi_desc_cd",
+            "transition_date",
+            "transition_hour",
+            "number_of_passage",
+        )
+        .rename({"station_poi_desc_cd": "station"})
+    )
+    df = df.with_columns(
+        pl.when(pl.col("transition_hour") < 10)
+        .then(pl.concat_str([pl.lit("0"), pl.col("transition_hour")]))
+        .otherwise(pl.col("transition_hour"))
+        .alias("transition_hour")
+    )
+    df = df.with_columns(
+        pl.concat_str([pl.col("transition_hour"), pl.lit("-00")]).alias(
+            "transition_hour"
+        )
+    )
+    df = df.with_columns(
+        pl.concat_str(
+            [pl.col("transition_date"), pl.col("transition_hour")], separator="-"
+        )
+        .str.to_datetime(format="%Y-%m-%d-%H-%M")
+        .alias("timestamp")
+    ).drop(["transition_date", "transition_hour"])
+
+    return df.filter(pl.col("line_name").is_in(lines)).filter(
+        pl.col("station").is_not_null()
+    )
+
+
+def best_of(fn, repeat: int):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", default="data/hourly_transportation.parquet")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    legacy_time, legacy = best_of(
+        lambda: legacy_ingest(args.path).collect(), args.repeat
+    )
+    typed_time, typed = best_of(
+        lambda: scan_raw(args.path, lines).collect(), args.repeat
+    )
+
+    keys = ["timestamp", "line_name", "station", "number_of_passage"]
+    assert (
+        legacy.select(keys)
+        .sort(keys)
+        .equals(
+            typed.select(keys)
+            .with_columns(pl.col("line_name", "station").cast(pl.String))
+            .sort(keys)
+        )
+    ), "typed ingest does not reproduce the legacy rows"
+
+    print(
+        pl.DataFrame(
+            {
+                "ingest": ["legacy", "typed"],
+                "rows": [len(legacy), len(typed)],
+                "seconds": [legacy_time, typed_time],
+                "mb": [legacy.estimated_size("mb"), typed.estimated_size("mb")],
+            }
+        ).with_columns(speedup=legacy_time / pl.col("seconds"))
+    )
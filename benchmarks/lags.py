@@ -0,0 +1,68 @@
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import polars as pl
+from utils.lag_features import add_lag_features
+
+lags = [30, 31, 32, 33, 35, 37, 40, 42, 49, 56, 63, 70]
+
+
+def dense_grid(n_series: int, days: int, seed: int = 42) -> pl.DataFrame:
+    rng = np.random.default_rng(seed)
+    timestamps = pl.datetime_range(
+        datetime(2022, 1, 1),
+        datetime(2022, 1, 1) + timedelta(hours=days * 24 - 1),
+        interval="1h",
+        eager=True,
+    )
+    grid = pl.DataFrame({"timestamp": timestamps}).join(
+        pl.DataFrame({"station": [f"S{i}" for i in range(n_series)]}), how="cross"
+    )
+    passage = rng.poisson(200, len(grid)).astype(np.float64)
+    passage[rng.random(len(grid)) < 0.1] = np.nan
+
+    return grid.with_columns(
+        pl.Series("passage", passage).fill_nan(None),
+        pl.col("station").cast(pl.Enum([f"S{i}" for i in range(n_series)])),
+    )
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--series", type=int, default=300)
+    parser.add_argument("--days", type=int, default=365)
+    args = parser.parse_args()
+
+    df = dense_grid(args.series, args.days)
+    keys = ["timestamp", "station"]
+
+    join_time, joined = timed(
+        lambda: add_lag_features(
+            df, "passage", ["station"], "timestamp", lags, engine="join"
+        ).collect()
+    )
+    shift_time, shifted = timed(
+        lambda: add_lag_features(
+            df, "passage", ["station"], "timestamp", lags, engine="shift"
+        ).collect()
+    )
+
+    assert joined.sort(keys).equals(shifted.select(joined.columns).sort(keys))
+
+    print(
+        pl.DataFrame(
+            {
+                "engine": ["join", "shift"],
+                "rows": [len(joined), len(shifted)],
+                "seconds": [join_time, shift_time],
+            }
+        ).with_columns(speedup=join_time / pl.col("seconds"))
+    )
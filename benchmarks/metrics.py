@@ -0,0 +1,65 @@
+import argparse
+import time
+
+import numpy as np
+import polars as pl
+from utils.metrics import METRIC_NAMES, get_all_metrics
+
+
+def fake_results(stations: int, splits: int, hours: int, seed: int = 42):
+    # what cv() scores: one row per (split, station, hour) with the target
+    # and the prediction
+    rng = np.random.default_rng(seed)
+    names = [f"S{i}" for i in range(stations)]
+    n = stations * splits * hours
+    passage = rng.poisson(200, n).astype(np.float32)
+
+    return pl.DataFrame(
+        {
+            "split": np.repeat(np.arange(splits, dtype=np.int32), stations * hours),
+            "station": np.tile(np.repeat(names, hours), splits),
+            "passage": passage,
+            "prediction": (passage * rng.lognormal(0, 0.2, n)).astype(np.float32),
+        }
+    ).with_columns(pl.col("station").cast(pl.Enum(names)))
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", type=int, default=300)
+    parser.add_argument("--splits", type=int, default=12)
+    parser.add_argument("--hours", type=int, default=720, help="test rows per fold")
+    args = parser.parse_args()
+
+    results = fake_results(args.stations, args.splits, args.hours)
+
+    rows = []
+    for engine in ["sklearn", "polars"]:
+        seconds, (by_all, by_cat) = timed(
+            lambda: get_all_metrics(results, "station", "passage", engine)
+        )
+        rows.append(
+            {"engine": engine, "groups": len(by_all) + len(by_cat), "seconds": seconds}
+        )
+        if engine == "sklearn":
+            expected = by_all, by_cat
+            continue
+
+        # sklearn sums float32 inputs in float32, the expressions in float64
+        for got, want in zip((by_all, by_cat), expected):
+            assert got.drop(METRIC_NAMES).equals(want.drop(METRIC_NAMES))
+            for name in METRIC_NAMES:
+                np.testing.assert_allclose(got[name], want[name], rtol=1e-5)
+
+    print(f"{len(results)} rows")
+    print(
+        pl.DataFrame(rows).with_columns(
+            speedup=pl.col("seconds").first() / pl.col("seconds")
+        )
+    )
@@ -0,0 +1,107 @@
+import argparse
+import tempfile
+import time
+from datetime import timedelta
+
+import numpy as np
+import polars as pl
+from utils.online import OnlineFeatures
+from utils.rolling import MOMENT_STATS
+from utils.synthetic import build_xy
+
+target_col = "passage"
+date_col = "timestamp"
+cat_cols = ["line_name", "station"]
+lags = [30, 31, 32, 33, 35, 37, 40, 42, 49, 56, 63, 70]
+intervals = ["1 day", "1 week", "1 month", "3 months"]
+
+
+def moment_columns(columns: list[str]) -> list[str]:
+    return [col for col in columns if col.split(f"_{target_col}_")[0] in MOMENT_STATS]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default="data/Xy/*.parquet")
+    parser.add_argument("--line", help="only the series of one line")
+    parser.add_argument("--days", type=int, default=7, help="days streamed online")
+    parser.add_argument(
+        "--rtol", type=float, default=1e-4, help="tolerance of the moment stats"
+    )
+    parser.add_argument(
+        "--synthetic",
+        action="store_true",
+        help="stream synthetic data built like data/Xy/ instead of --path",
+    )
+    args = parser.parse_args()
+
+    if args.synthetic:
+        with tempfile.TemporaryDirectory() as tmp:
+            Xy = build_xy(tmp, intervals, lags, lines=2, stations=3, days=240).lazy()
+    else:
+        Xy = pl.scan_parquet(args.path)
+    if args.line:
+        Xy = Xy.filter(pl.col("line_name") == args.line)
+    Xy = Xy.sort(*cat_cols, date_col).collect()
+    cutoff = Xy.get_column(date_col).max() - timedelta(days=args.days)
+
+    start = time.perf_counter()
+    online = OnlineFeatures(target_col, date_col, cat_cols, intervals, lags).load(
+        Xy.filter(pl.col(date_col) <= cutoff)
+    )
+    load_time = time.perf_counter() - start
+
+    # the features of every hour are built before its observations arrive,
+    # the same order a forecast of the next hour would see them
+    stream = Xy.filter(pl.col(date_col) > cutoff).sort(date_col, *cat_cols)
+    frames, update_time, feature_time = [], 0.0, 0.0
+    for (hour,), part in stream.partition_by(date_col, as_dict=True).items():
+        start = time.perf_counter()
+        frames.append(online.features())
+        feature_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for *key, value in part.select(*cat_cols, target_col).iter_rows():
+            online.update(tuple(key), hour, value)
+        update_time += time.perf_counter() - start
+
+    got = pl.concat(frames).sort(*cat_cols, date_col)
+    expected = stream.sort(*cat_cols, date_col)
+    assert got.select(date_col, *cat_cols).equals(
+        expected.select(date_col, *cat_cols)
+    ), "online rows differ from the offline features"
+
+    # target and was_null are not known before the hour is observed
+    moments = moment_columns(got.columns)
+    exact = [
+        col for col in got.columns if col not in [target_col, "was_null", *moments]
+    ]
+    assert got.select(exact).equals(expected.select(exact)), "exact features differ"
+
+    worst = 0.0
+    for col in moments:
+        a, b = got.get_column(col), expected.get_column(col)
+        assert a.is_null().equals(b.is_null()), f"{col} nulls differ"
+        a, b = a.drop_nulls().to_numpy(), b.drop_nulls().to_numpy()
+        assert np.array_equal(np.isnan(a), np.isnan(b)), f"{col} NaNs differ"
+        a, b = a[~np.isnan(a)].astype(np.float64), b[~np.isnan(b)].astype(np.float64)
+        close = np.isclose(a, b, rtol=args.rtol, atol=0) | (a == b)
+        assert close.all(), f"{col} differs by more than rtol {args.rtol}"
+        scale = np.maximum(np.abs(b), np.finfo(np.float32).tiny)
+        worst = max(worst, float(np.max(np.abs(a - b) / scale, initial=0)))
+
+    n_updates = len(stream)
+    print(
+        f"{len(online.series)} series, {len(frames)} hours online, "
+        f"{len(exact) - 1 - len(cat_cols)} exact and {len(moments)} moment "
+        f"features match offline (moments within {worst:.1e} relative)"
+    )
+    print(
+        pl.DataFrame(
+            {
+                "step": ["load", "update", "features"],
+                "calls": [1, n_updates, len(frames)],
+                "seconds": [load_time, update_time, feature_time],
+            }
+        ).with_columns(us_per_call=pl.col("seconds") / pl.col("calls") * 1e6)
+    )
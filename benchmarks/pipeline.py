@@ -0,0 +1,88 @@
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import polars as pl
+from benchmarks.lags import dense_grid, lags
+from utils.date_features import add_date_features
+from utils.lag_features import add_lag_features
+from utils.pipeline import build_features
+from utils.stat_features import add_stat_features
+
+intervals = ["1 day", "1 week", "1 month", "3 months"]
+
+
+def staged(df: pl.DataFrame) -> pl.DataFrame:
+    # process-data.py before utils.pipeline, one collect per feature step
+    df = add_stat_features(
+        df,
+        "passage",
+        "timestamp",
+        ["station"],
+        intervals,
+        quantile_engine="sliding",
+        moment_engine="prefix",
+    ).collect()
+    df = add_lag_features(df, "passage", ["station"], "timestamp", lags).collect()
+    return add_date_features(df, "timestamp").collect()
+
+
+def fused(df: pl.DataFrame) -> pl.DataFrame:
+    return build_features(
+        df, "passage", "timestamp", ["station"], intervals, lags
+    ).collect()
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss survives fork and exec on linux and would report the parent's
+    # peak, VmHWM is the high water mark of this process alone
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 2**10
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def run(name: str, n_series: int, days: int):
+    df = dense_grid(n_series, days)
+    start = time.perf_counter()
+    result = {"staged": staged, "fused": fused}[name](df)
+    seconds = time.perf_counter() - start
+
+    return seconds, peak_rss_mb(), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--series", type=int, default=100)
+    parser.add_argument("--days", type=int, default=365)
+    args = parser.parse_args()
+
+    # a fresh process per pipeline, so the peak RSS is that pipeline's alone
+    results = {}
+    for name in ["staged", "fused"]:
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            results[name] = pool.submit(run, name, args.series, args.days).result()
+
+    keys = ["timestamp", "station"]
+    staged_df, fused_df = results["staged"][2], results["fused"][2]
+    assert staged_df.sort(keys).equals(fused_df.select(staged_df.columns).sort(keys))
+
+    print(
+        pl.DataFrame(
+            {
+                "pipeline": list(results),
+                "rows": [len(result) for _, _, result in results.values()],
+                "seconds": [seconds for seconds, _, _ in results.values()],
+                "peak_rss_mb": [rss for _, rss, _ in results.values()],
+            }
+        ).with_columns(
+            speedup=results["staged"][0] / pl.col("seconds"),
+            saved_mb=results["staged"][1] - pl.col("peak_rss_mb"),
+        )
+    )
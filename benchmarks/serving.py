@@ -0,0 +1,224 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import polars as pl
+from utils.matrix import get_features
+from utils.models import get_meta, load_model, save_model
+from utils.serving import (
+    Client,
+    Forecaster,
+    LocalClient,
+    HORIZON,
+    ServiceError,
+    load_features,
+    make_server,
+)
+from utils.synthetic import build_xy
+from utils.training import fit, predict_xgb
+
+target_col = "passage"
+date_col = "timestamp"
+
+lags = [30, 31, 32, 33, 35, 37, 40, 42, 49, 56, 63, 70]
+intervals = ["1 day", "1 week", "1 month", "3 months"]
+
+param = {
+    "max_depth": 5,
+    "learning_rate": 0.02,
+    "subsample": 0.8,
+    "colsample_bytree": 0.8,
+    "min_child_weight": 10,
+    "gamma": 3,
+    "objective": "reg:absoluteerror",
+}
+
+
+def make_requests(forecaster, n: int, batch: int, hours: int, seed: int = 42):
+    # batches of random (line, station, range) of `hours` hours
+    rng = np.random.default_rng(seed)
+    series = list(forecaster.series)
+    first, last = forecaster.index.min(), forecaster.index.max()
+    span = int((last - first) / np.timedelta64(1, "h")) - hours
+    batches = []
+    for _ in range(n):
+        requests = []
+        for i in rng.integers(len(series), size=batch):
+            start = first + np.timedelta64(int(rng.integers(span)), "h")
+            end = start + np.timedelta64(hours - 1, "h")
+            requests.append(
+                {
+                    "line": series[i][0],
+                    "station": series[i][1],
+                    "start": str(start.astype("datetime64[s]")),
+                    "end": str(end.astype("datetime64[s]")),
+                }
+            )
+        batches.append(requests)
+
+    return batches
+
+
+def status_of(call) -> int:
+    try:
+        call()
+    except ServiceError as e:
+        return e.status
+    return 200
+
+
+def check_service(client: LocalClient, forecaster: Forecaster, name: str):
+    # status codes, row counts and forecasts of one series through the client,
+    # against predict_xgb on the same feature rows: a day of history, the day
+    # after the last hour of data/Xy/ and the last hour of the horizon
+    xgb, meta = forecaster.models[name]
+    line, station = next(iter(forecaster.series))
+    offset, length = forecaster.series[(line, station)]
+    rows = forecaster.features.slice(offset, length)
+    last = rows.get_column(date_col).max()
+    history_end = last - timedelta(days=HORIZON)
+
+    def request(start, end) -> dict:
+        return {"line": line, "station": station, "start": str(start), "end": str(end)}
+
+    hour = timedelta(hours=1)
+    ranges = [
+        (history_end - 47 * hour, history_end - 24 * hour),
+        (history_end + hour, history_end + 24 * hour),
+        (last, last),
+    ]
+    for start, end in ranges:
+        got = client.forecast([request(start.isoformat(), end.isoformat())])
+        expected = rows.filter(pl.col(date_col).is_between(start, end))
+        assert len(got) == len(expected) == (end - start) // hour + 1, (start, end)
+
+        X = get_features(
+            expected, meta["features"], meta["cat_col"], forecaster.dtypes[name]
+        )
+        y_pred = predict_xgb(X, xgb, meta["log1p"], None)
+        assert np.allclose([row["forecast"] for row in got], y_pred), (start, end)
+
+    past = (last + hour).isoformat()
+    bad = {
+        "past the horizon": ([request(past, past)], 400),
+        "missing field": ([{"line": line, "station": station}], 400),
+        "bad timestamp": ([request("yesterday", past)], 400),
+        "unknown station": ([{**request(past, past), "station": "NOWHERE"}], 404),
+    }
+    for case, (requests, status) in bad.items():
+        got = status_of(lambda: client.forecast(requests))
+        assert got == status, f"{case}: {got}, expected {status}"
+    assert status_of(lambda: client.request("GET", "/nowhere")) == 404
+    assert status_of(lambda: client.request("POST", "/forecast", {})) == 400
+    assert status_of(lambda: client.request("GET", "/health")) == 200
+
+    print(
+        f"service checks pass: {len(ranges)} ranges up to {last} "
+        f"(history ends {history_end}), {len(bad) + 3} status codes"
+    )
+
+
+def timed_batches(client, batches) -> tuple[np.ndarray, list]:
+    latencies, results = [], []
+    for requests in batches:
+        start = time.perf_counter()
+        results.append(client.forecast(requests))
+        latencies.append(time.perf_counter() - start)
+
+    return np.array(latencies) * 1000, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--line", default="M1")
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--batches", type=int, default=500)
+    parser.add_argument("--batch", type=int, default=10, help="series per batch")
+    parser.add_argument("--hours", type=int, default=24, help="hours per series")
+    parser.add_argument(
+        "--synthetic",
+        action="store_true",
+        help="serve a model of synthetic data instead of data/Xy/",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        xy_path = "data/Xy/*.parquet"
+        if args.synthetic:
+            build_xy(tmp, intervals, lags, lines=1, stations=3, days=240)
+            xy_path = os.path.join(tmp, "Xy", "*.parquet")
+
+        df = (
+            pl.scan_parquet(xy_path)
+            .filter(
+                pl.col(date_col) >= datetime(2023, 1, 1, 0, 0, 0),
+                pl.col("line_name") == args.line,
+                pl.col(target_col).is_not_null(),
+            )
+            .drop("line_name")
+            .collect()
+        )
+        params = {**param, "n_estimators": args.rounds}
+        xgb, matrix = fit(df, target_col, date_col, "station", params, backend="cpu")
+        meta = get_meta(
+            args.line,
+            args.line,
+            df,
+            matrix,
+            target_col,
+            date_col,
+            "station",
+            params,
+            True,
+        )
+
+        save_model(xgb, meta, args.line, tmp)
+        start = time.perf_counter()
+        models = {args.line: load_model(args.line, tmp)}
+        features = load_features(models, xy_path, since=datetime(2023, 1, 1))
+        forecaster = Forecaster(models, features, "cpu")
+        print(f"loaded in {time.perf_counter() - start:.2f}s")
+        check_service(LocalClient(forecaster), forecaster, args.line)
+
+        batches = make_requests(forecaster, args.batches, args.batch, args.hours)
+        socket_path = os.path.join(tmp, "forecast.sock")
+        servers = {
+            "tcp": make_server(forecaster, port=0),
+            "unix": make_server(forecaster, socket_path=socket_path),
+        }
+        for server in servers.values():
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        clients = {
+            "local": LocalClient(forecaster),
+            "tcp": Client(port=servers["tcp"].server_address[1]),
+            "unix": Client(socket_path=socket_path),
+        }
+        rows, expected = [], None
+        for name, client in clients.items():
+            latencies, results = timed_batches(client, batches)
+            expected = expected or results
+            assert results == expected, f"{name} forecasts differ from local"
+            rows.append(
+                {
+                    "client": name,
+                    "p50_ms": np.percentile(latencies, 50),
+                    "p99_ms": np.percentile(latencies, 99),
+                    "rows_per_s": sum(map(len, results)) / latencies.sum() * 1000,
+                }
+            )
+
+        for server in servers.values():
+            server.shutdown()
+            server.server_close()
+
+    print(
+        f"{args.batches} batches of {args.batch} series x {args.hours} hours, "
+        f"{args.rounds} trees"
+    )
+    print(pl.DataFrame(rows))
+    print("server side", forecaster.metrics())
@@ -0,0 +1,172 @@
+import argparse
+import time
+from datetime import datetime, timedelta
+from fractions import Fraction
+
+import numpy as np
+import polars as pl
+from utils.rolling import MOMENT_STATS, ORDER_STATS, interval_suffix, to_duration
+from utils.stat_features import add_stat_features
+
+intervals = ["1 day", "1 week", "1 month", "3 months"]
+
+# skew and kurt are differences of nearly equal power sums at station scale,
+# they are checked against exact rational values instead of DuckDB's doubles
+EXACT_STATS = ["skew", "kurt", "slope"]
+
+
+def station_grid(n_series: int, days: int, level: float, seed: int = 42):
+    # hourly counts at station magnitudes, every other station closed (zero)
+    # at night, a stuck sensor repeating one value for a few days and gaps of
+    # missing hours. the flat stations are where the power sums cancel
+    rng = np.random.default_rng(seed)
+    timestamps = pl.datetime_range(
+        datetime(2022, 1, 1),
+        datetime(2022, 1, 1) + timedelta(hours=days * 24 - 1),
+        interval="1h",
+        eager=True,
+    )
+    hours = np.arange(len(timestamps))
+    profile = np.where(hours % 24 < 5, 0.0, 1 + 0.5 * np.sin(hours % 24 / 24 * np.pi))
+
+    series = []
+    for i in range(n_series):
+        x = rng.poisson(level * (profile if i % 2 else 1), len(hours))
+        x = x.astype(np.float64)
+        stuck = rng.integers(0, len(x) - 100)
+        x[stuck : stuck + 100] = x[stuck]
+        gap = rng.integers(0, len(x) - 50)
+        x[gap : gap + 50] = np.nan
+        x[rng.random(len(x)) < 0.02] = np.nan
+        series.append(
+            pl.DataFrame(
+                {"timestamp": timestamps, "station": f"S{i}", "passage": x}
+            ).with_columns(pl.col("passage").fill_nan(None))
+        )
+
+    return pl.concat(series).with_columns(
+        pl.col("station").cast(pl.Enum([f"S{i}" for i in range(n_series)]))
+    )
+
+
+def exact_stats(x: np.ndarray, t: np.ndarray) -> dict:
+    # DuckDB's skew, kurt and slope finalizers on the exact window moments
+    valid = x == x
+    x = [Fraction(int(v)) for v in x[valid]]
+    t = [Fraction(int(v)) for v in t[valid]]
+    n = len(x)
+    if n < 2:
+        return {}
+
+    mean, mean_t = sum(x) / n, sum(t) / n
+    m2, m3, m4 = [sum((v - mean) ** p for v in x) / n for p in (2, 3, 4)]
+    stats = {
+        "slope": float(
+            sum((u - mean_t) * (v - mean) for u, v in zip(t, x))
+            / sum((u - mean_t) ** 2 for u in t)
+        )
+    }
+    if n > 2 and m2 > 0:
+        stats["skew"] = (n * (n - 1)) ** 0.5 / (n - 2) * float(m3) / float(m2) ** 1.5
+    if n > 3 and m2 > 0:
+        stats["kurt"] = float(
+            (n - 1) * ((n + 1) * m4 / (m2 * m2) - 3 * (n - 1)) / ((n - 2) * (n - 3))
+        )
+    return stats
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--series", type=int, default=4)
+    parser.add_argument("--days", type=int, default=730)
+    parser.add_argument(
+        "--level", type=float, default=60000, help="mean hourly count of a series"
+    )
+    parser.add_argument(
+        "--samples", type=int, default=50, help="windows per series checked exactly"
+    )
+    parser.add_argument(
+        "--rtol", type=float, default=1e-4, help="tolerance against DuckDB"
+    )
+    args = parser.parse_args()
+
+    df = station_grid(args.series, args.days, args.level)
+    keys = ["station", "timestamp"]
+    # horizon 0, so the window of a row ends at the row itself
+    features = lambda quantiles, moments: (
+        add_stat_features(
+            df,
+            "passage",
+            "timestamp",
+            ["station"],
+            intervals,
+            horizon=0,
+            quantile_engine=quantiles,
+            moment_engine=moments,
+        )
+        .collect()
+        .sort(keys)
+    )
+    duckdb_time, duckdb = timed(lambda: features("duckdb", "duckdb"))
+    native_time, native = timed(lambda: features("sliding", "prefix"))
+    assert duckdb.select(keys).equals(native.select(keys))
+
+    for interval in intervals:
+        for name in ORDER_STATS + MOMENT_STATS:
+            col = f"{name}_passage_{interval_suffix(interval)}"
+            a, b = duckdb.get_column(col), native.get_column(col)
+            assert a.is_null().equals(b.is_null()), f"{col} nulls differ"
+            a, b = a.to_numpy().astype(np.float64), b.to_numpy().astype(np.float64)
+            assert np.array_equal(np.isnan(a), np.isnan(b)), f"{col} NaNs differ"
+            if name in ORDER_STATS:
+                assert np.array_equal(a, b, equal_nan=True), f"{col} differs"
+            elif name not in EXACT_STATS:
+                ok = ~np.isnan(a)
+                assert np.allclose(a[ok], b[ok], rtol=args.rtol), f"{col} differs"
+
+    # the exact windows of a sample of rows of every series
+    rng = np.random.default_rng(0)
+    errors = {
+        (engine, name): 0.0 for engine in ["duckdb", "native"] for name in EXACT_STATS
+    }
+    for (station,), part in df.partition_by("station", as_dict=True).items():
+        ts = part.get_column("timestamp")
+        x = part.get_column("passage").fill_null(np.nan).to_numpy()
+        t = (ts - ts[0]).dt.total_seconds().to_numpy()
+        rows = np.flatnonzero(duckdb.get_column("station") == station)
+        for interval in intervals:
+            lower = ts.dt.offset_by(f"-{to_duration(interval)}").to_numpy()
+            for i in rng.choice(len(x), args.samples, replace=False):
+                lo = np.searchsorted(ts.to_numpy(), lower[i], "left")
+                exact = exact_stats(x[lo : i + 1], t[lo : i + 1])
+                for name, value in exact.items():
+                    col = f"{name}_passage_{interval_suffix(interval)}"
+                    # float32 output, a slope of exactly 0 comes out as rounding
+                    scale = max(abs(value), 1e-9 if name == "slope" else 0)
+                    for engine, out in [("duckdb", duckdb), ("native", native)]:
+                        got = out.get_column(col)[int(rows[i])]
+                        error = abs(got - value) / scale
+                        errors[engine, name] = max(errors[engine, name], error)
+
+    for name in EXACT_STATS:
+        assert errors["native", name] < 1e-6, f"{name} is off the exact value"
+
+    print(
+        pl.DataFrame(
+            {
+                "engine": ["duckdb", "native"],
+                "rows": [len(duckdb), len(native)],
+                "seconds": [duckdb_time, native_time],
+                **{
+                    f"{name}_rel_error": [errors[e, name] for e in ["duckdb", "native"]]
+                    for name in EXACT_STATS
+                },
+            }
+        ).with_columns(speedup=duckdb_time / pl.col("seconds"))
+    )
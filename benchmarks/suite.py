@@ -0,0 +1,226 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import duckdb
+import polars as pl
+from utils.date_features import build_calendar, join_date_features
+from utils.densification import get_dense
+from utils.ingest import scan_raw
+from utils.lag_features import add_lag_features
+from utils.matrix import slice_matrix, to_dmatrix
+from utils.metrics import get_all_metrics
+from utils.pipeline import build_features
+from utils.stat_features import add_stat_features
+from utils.stations import apply_registry, update_registry
+from utils.synthetic import line_names, write_raw
+from utils.training import get_folds, predict_xgb, time_rows, train_xgb
+import xgboost
+
+target_col = "passage"
+date_col = "timestamp"
+cat_cols = ["line_name", "station"]
+lags = [30, 31, 32, 33, 35, 37, 40, 42, 49, 56, 63, 70]
+intervals = ["1 day", "1 week", "1 month", "3 months"]
+
+param = {
+    "max_depth": 5,
+    "learning_rate": 0.02,
+    "subsample": 0.8,
+    "colsample_bytree": 0.8,
+    "min_child_weight": 10,
+    "gamma": 3,
+    "objective": "reg:absoluteerror",
+}
+
+
+def best_of(fn, repeat: int):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+
+def parse_scale(scale: str) -> dict:
+    lines, stations, days = map(int, scale.split("x"))
+    return {"lines": lines, "stations": stations, "days": days}
+
+
+def machine() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "polars": pl.__version__,
+        "duckdb": duckdb.__version__,
+        "xgboost": xgboost.__version__,
+    }
+
+
+def run_scale(scale: dict, tmp: str, rounds: int, repeat: int) -> list[dict]:
+    # every stage of process-data.py and of one cv fold on synthetic raw data
+    # of the scale, the best of `repeat` runs each
+    raw_path = write_raw(os.path.join(tmp, "raw.parquet"), **scale)
+    lines = line_names(scale["lines"])
+    records = []
+
+    def stage(name: str, fn, rows_in: int, rows_out: int | None = None):
+        seconds, out = best_of(fn, repeat)
+        rows_out = len(out) if rows_out is None else rows_out
+        records.append(
+            {
+                **scale,
+                "stage": name,
+                "rows_in": rows_in,
+                "rows_out": rows_out,
+                "seconds": seconds,
+            }
+        )
+        print(f"{name:<18} {rows_in:>10} -> {rows_out:>10} rows {seconds:8.3f}s")
+        return out
+
+    def ingest() -> pl.DataFrame:
+        df = scan_raw(raw_path, lines)
+        registry = update_registry(df, os.path.join(tmp, "stations.parquet"))
+        return (
+            apply_registry(df, registry)
+            .group_by(*cat_cols, date_col)
+            .agg(pl.sum("number_of_passage").alias(target_col))
+            .sort(*cat_cols, date_col)
+            .collect()
+        )
+
+    raw_rows = pl.scan_parquet(raw_path).select(pl.len()).collect().item()
+    df = stage("ingest", ingest, raw_rows)
+    dense = stage(
+        "get_dense",
+        lambda: get_dense(df.lazy(), target_col, date_col, cat_cols).collect(),
+        len(df),
+    )
+    stage(
+        "add_stat_features",
+        lambda: add_stat_features(
+            dense,
+            target_col,
+            date_col,
+            cat_cols,
+            intervals,
+            quantile_engine="sliding",
+            moment_engine="prefix",
+        ).collect(),
+        len(dense),
+    )
+    stage(
+        "add_lag_features",
+        lambda: add_lag_features(dense, target_col, cat_cols, date_col, lags).collect(),
+        len(dense),
+    )
+    years = dense.select(
+        pl.col(date_col).dt.year().min().alias("start"),
+        pl.col(date_col).dt.year().max().alias("end"),
+    ).row(0)
+    stage(
+        "add_date_features",
+        lambda: join_date_features(dense, build_calendar(*years), date_col).collect(),
+        len(dense),
+    )
+    Xy = stage(
+        "build_features",
+        lambda: build_features(
+            dense, target_col, date_col, cat_cols, intervals, lags
+        ).collect(),
+        len(dense),
+    )
+
+    # one fold: the last 30 days are scored by a model of everything before
+    Xy = Xy.filter(pl.col(target_col).is_not_null()).drop("line_name")
+    Xy, index, matrix = get_folds(Xy, target_col, date_col, "station")
+    end = Xy.get_column(date_col).max()
+    train_rows = time_rows(index, None, end - timedelta(days=30))
+    test_rows = time_rows(index, end - timedelta(days=30), end)
+    dtrain = to_dmatrix(slice_matrix(matrix, *train_rows))
+    params = {**param, "n_estimators": rounds}
+    xgb = stage(
+        "train_xgb",
+        lambda: train_xgb(dtrain, params, backend="cpu"),
+        train_rows[1],
+        train_rows[1],
+    )
+
+    X = slice_matrix(matrix, *test_rows).X
+    y_pred = stage("predict_xgb", lambda: predict_xgb(X, xgb, True, "cpu"), len(X))
+    results = (
+        Xy.slice(*test_rows)
+        .select("station", target_col)
+        .with_columns(pl.Series("prediction", y_pred), pl.lit(0).alias("split"))
+    )
+    stage(
+        "get_all_metrics",
+        lambda: pl.concat(
+            get_all_metrics(results, "station", target_col), how="diagonal"
+        ),
+        len(results),
+    )
+
+    return records
+
+
+def compare(records: list[dict], path: str) -> pl.DataFrame:
+    # seconds against a previous run, ratio > 1 is slower now
+    keys = ["lines", "stations", "days", "stage"]
+    with open(path) as f:
+        before = pl.DataFrame(json.load(f)["results"]).select(*keys, "seconds")
+
+    return (
+        pl.DataFrame(records)
+        .select(*keys, "seconds")
+        .join(before, on=keys, how="left", suffix="_before")
+        .with_columns(ratio=pl.col("seconds") / pl.col("seconds_before"))
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        default=["2x3x180", "5x6x365"],
+        help="LINESxSTATIONSxDAYS of synthetic raw data",
+    )
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--out", default="results/benchmarks.json")
+    parser.add_argument("--compare", help="a previous --out to compare against")
+    args = parser.parse_args()
+
+    records = []
+    for scale in map(parse_scale, args.scales):
+        print("{lines} lines x {stations} stations x {days} days".format(**scale))
+        with tempfile.TemporaryDirectory() as tmp:
+            records += run_scale(scale, tmp, args.rounds, args.repeat)
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump({"machine": machine(), "results": records}, f, indent=2)
+    print(f"wrote {args.out}")
+
+    if args.compare:
+        with pl.Config(tbl_rows=-1):
+            print(compare(records, args.compare))
@@ -0,0 +1,34 @@
+import argparse
+
+import polars as pl
+from utils.cache import CACHE_PATH, list_cache, prune_cache
+
+parser = argparse.ArgumentParser(description="inspect and prune the stage cache")
+parser.add_argument("--cache-dir", default=CACHE_PATH)
+commands = parser.add_subparsers(dest="command", required=True)
+commands.add_parser("list", help="list the entries, most recently used first")
+prune = commands.add_parser("prune", help="drop entries")
+prune.add_argument(
+    "--max-gb",
+    type=float,
+    help="drop the least recently used entries until the cache fits",
+)
+prune.add_argument("--stage", help="drop every entry of this stage")
+prune.add_argument("--all", action="store_true", help="drop every entry")
+args = parser.parse_args()
+
+if args.command == "list":
+    entries = list_cache(args.cache_dir)
+    with pl.Config(tbl_rows=-1, fmt_str_lengths=40):
+        print(entries.drop("file"))
+    print(f"{len(entries)} entries, {entries.get_column('mb').sum():.1f} MB")
+else:
+    if args.max_gb is None and args.stage is None and not args.all:
+        parser.error("prune needs --max-gb, --stage or --all")
+
+    max_bytes = 0 if args.all else None
+    if args.max_gb is not None:
+        max_bytes = int(args.max_gb * 2**30)
+
+    dropped = prune_cache(args.cache_dir, max_bytes, args.stage)
+    print(f"dropped {len(dropped)} entries, {dropped.get_column('mb').sum():.1f} MB")
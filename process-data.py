@@ -1,131 +1,328 @@
+import argparse
+import shutil
+import sys
+
 import polars as pl
-from utils.densification import get_dense
-from utils.stat_features import add_stat_features
-from utils.lag_features import add_lag_features
-from utils.date_features import add_date_features
-
-df = (
-    pl.scan_parquet("data/hourly_transportation.parquet")
-    .filter(pl.col("road_type") == "RAYLI")
-    .drop(
-        "road_type",
-        "number_of_passenger",
-        "town",
-        "line",
-        "product_kind",
-        "transfer_type",
-        "transport_type_id",
-        "transaction_type_desc",
-    )
-    .rename({"station_poi_desc_cd": "station"})
+from utils.cache import CACHE_MAX_BYTES, CACHE_PATH, cached, frame_key, get_key
+from utils.densification import dense_report, get_dense, iter_dense
+from utils.pipeline import build_features
+from utils.ingest import scan_raw
+from utils.incremental import (
+    get_lookback,
+    get_refresh_start,
+    known_series,
+    merge_partitions,
+    read_watermark,
+    recast_partitions,
+    write_partitions,
 )
+from utils.profiling import print_profile, profile, start_profiling, stop_profiling
+from utils.rollups import GRAINS, LEVELS, align_days, build_rollups
+from utils.session import SPILL_PATH, Session
+from utils.stations import apply_registry, load_registry, station_dtype, update_registry
 
-
-df = df.with_columns(
-    pl.when(pl.col("transition_hour") < 10)
-    .then(pl.concat_str([pl.lit("0"), pl.col("transition_hour")]))
-    .otherwise(pl.col("transition_hour"))
-    .alias("transition_hour")
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="only recompute the months touched by new raw data and append them to data/Xy/",
 )
-
-df = df.with_columns(
-    pl.concat_str([pl.col("transition_hour"), pl.lit("-00")]).alias("transition_hour")
+parser.add_argument(
+    "--dense-span",
+    choices=["global", "series"],
+    default="global",
+    help="densify each series over the global time range or only its own active span",
+)
+parser.add_argument(
+    "--operating-hours",
+    nargs=2,
+    type=int,
+    metavar=("START", "END"),
+    help="only densify hours in [START, END), e.g. 6 1 for 06:00-01:00",
+)
+parser.add_argument(
+    "--dense-chunks",
+    type=int,
+    metavar="N",
+    help="densify, featurize and write N series at a time instead of the whole table",
+)
+parser.add_argument(
+    "--level",
+    choices=list(LEVELS),
+    default="station",
+    help="aggregation level of the series the features are built on",
+)
+parser.add_argument(
+    "--grain",
+    choices=GRAINS,
+    default="1h",
+    help="time resolution of the series the features are built on",
+)
+parser.add_argument(
+    "--min-coverage",
+    type=float,
+    default=1.0,
+    help="a rollup bucket missing some of its station hours is scaled up to all "
+    "of them above this share of observed hours, and null below it",
+)
+parser.add_argument(
+    "--quantile-engine",
+    choices=["duckdb", "sliding"],
+    default="sliding",
+    help="compute rolling min/max/quantiles in DuckDB or with the sliding window engine",
+)
+parser.add_argument(
+    "--moment-engine",
+    choices=["duckdb", "prefix"],
+    default="prefix",
+    help="compute rolling avg/std/skew/kurt/sums/slope in DuckDB or from prefix sums",
 )
+parser.add_argument(
+    "--cache-dir",
+    default=CACHE_PATH,
+    help="where the dense series and the feature stages are cached",
+)
+parser.add_argument("--no-cache", action="store_true", help="recompute every stage")
+parser.add_argument(
+    "--cache-max-gb",
+    type=float,
+    default=CACHE_MAX_BYTES / 2**30,
+    help="least recently used cache entries are evicted above this size",
+)
+parser.add_argument(
+    "--duckdb-threads",
+    type=int,
+    help="threads of the feature SQL, every core by default",
+)
+parser.add_argument(
+    "--duckdb-memory",
+    help="memory limit of the feature SQL, e.g. 8GB, beyond it DuckDB spills to disk",
+)
+parser.add_argument(
+    "--duckdb-spill-dir",
+    default=SPILL_PATH,
+    help="where DuckDB spills what does not fit in --duckdb-memory",
+)
+parser.add_argument(
+    "--profile",
+    nargs="?",
+    const="results/profile/process-data.jsonl",
+    metavar="LOG",
+    help="log time, rows and peak rss of every stage as JSON lines and print a summary",
+)
+parser.add_argument(
+    "--explain",
+    action="store_true",
+    help="with --profile, also log EXPLAIN ANALYZE of the DuckDB queries (runs them twice)",
+)
+args = parser.parse_args()
+if args.explain and not args.profile:
+    parser.error("--explain needs --profile")
+if args.dense_chunks and args.dense_span != "series":
+    parser.error("--dense-chunks needs --dense-span series")
+
+session = Session(args.duckdb_threads, args.duckdb_memory, args.duckdb_spill_dir)
+if args.profile:
+    start_profiling(
+        args.profile, args.explain, script="process-data", duckdb=session.settings()
+    )
+
+rollup = (args.level, args.grain) != ("station", "1h")
+if rollup and args.incremental:
+    parser.error("--incremental only supports the hourly station series")
+if args.dense_chunks and (rollup or args.incremental):
+    parser.error(
+        "--dense-chunks only supports a full rebuild of the hourly station series"
+    )
+
+raw_path = "data/hourly_transportation.parquet"
+out_path = "data/Xy" if not rollup else f"data/Xy_{args.level}_{args.grain}"
 
+cat_cols = ["line_name", "station"]
+date_col = "timestamp"
+target_col = "passage"
+lags = [30, 31, 32, 33, 35, 37, 40, 42, 49, 56, 63, 70]
+intervals = ["1 day", "1 week", "1 month", "3 months"]
+horizon = 30
 
-df = df.with_columns(
-    pl.concat_str([pl.col("transition_date"), pl.col("transition_hour")], separator="-")
-    .str.to_datetime(format="%Y-%m-%d-%H-%M")
-    .alias("timestamp")
-).drop(["transition_date", "transition_hour"])
+if rollup:
+    lags = sorted({align_days(lag, args.grain) for lag in lags})
+    horizon = align_days(horizon, args.grain)
 
 lines = ["M1", "M2", "M4", "T1", "MARMARAY"]
 
-df = df.filter(pl.col("line_name").is_in(lines))
-df = df.filter(pl.col("station").is_not_null())
-
-df = df.with_columns(
-    pl.col("station")
-    .str.replace_many(
-        [
-            " (GUNEY)",
-            " (KUZEY)",
-            " (BATI)",
-            " (DOGU)",
-            " GUNEY",
-            " KUZEY",
-            " BATI",
-            " DOGU",
-        ],
-        [""],
+watermark = read_watermark(out_path, date_col) if args.incremental else None
+if watermark is not None:
+    refresh_start = get_refresh_start(watermark)
+    df = scan_raw(
+        raw_path, lines, start=refresh_start - get_lookback(intervals, lags, horizon)
     )
-    .alias("station")
-)
-
-mapping = {
-    "HASTANE (DOGU/ADLIYE)": "HASTANE",
-    "SABIHA GOKCEN HAVALIMANI": "SABIHA GOKCEN",
-    "M4 KURTKOY": "KURTKOY",
-    "SEYRANTEPE 3 STAD GIRISI": "SEYRANTEPE",
-    "SEYRANTEPE 1": "SEYRANTEPE",
-    "SEYRANTEPE 2": "SEYRANTEPE",
-    "4 LEVENT 2": "4 LEVENT",
-    "LEVENT 2": "LEVENT",
-    "SISLI 2": "SISLI",
-    "OSMANBEY 2": "OSMANBEY",
-    "OTOGAR 1": "OTOGAR",
-    "AKSARAY 1": "AKSARAY",
-    "SIRKECI-4": "SIRKECI",
-    "SIRKECI-3": "SIRKECI",
-    "SIRKECI-2": "SIRKECI",
-    "SIRKECI-1": "SIRKECI",
-    "BAKIRKOY-1": "BAKIRKOY",
-    "BAKIRKOY-2": "BAKIRKOY",
-    "USKUDAR-1": "USKUDAR",
-    "USKUDAR-2": "USKUDAR",
-    "USKUDAR-3": "USKUDAR",
-    "GEBZE-1": "GEBZE",
-    "GEBZE-2": "GEBZE",
-    "KUCUKYALI-1": "KUCUKYALI",
-    "KUCUKYALI-2": "KUCUKYALI",
-    "YENIKAPI-1": "YENIKAPI",
-    "YENIKAPI-2": "YENIKAPI",
-    "YENIKAPI-3": "YENIKAPI",
-    "TERSANE-1": "TERSANE",
-    "TERSANE-2": "TERSANE",
-    "BOSTANCI-1": "BOSTANCI",
-    "BOSTANCI-2": "BOSTANCI",
-    "CEVIZLI-1": "CEVIZLI",
-    "CEVIZLI-2": "CEVIZLI",
-    "EMINONU 2": "EMINONU",
-    "ZEYTINBURNU 2": "ZEYTINBURNU",
-    "KABATAS 2": "KABATAS",
-    "AYRILIKCESME": "AYRILIKCESMESI",
-    "CAMI": "YAVUZSELIM",
-    "KERESTECILER": "MERTER",
-}
-
-df = df.with_columns(pl.col("station").replace(mapping).alias("station"))
+else:
+    df = scan_raw(raw_path, lines)
+
+old_stations = station_dtype(load_registry())
+registry = update_registry(df)
+if watermark is not None and station_dtype(registry) != old_stations:
+    recast_partitions(out_path, {"station": station_dtype(registry)})
+
+df = apply_registry(df, registry)
 df = df.group_by("line_name", "station", "timestamp").agg(
     pl.sum("number_of_passage").alias("passage")
 )
 
-cat_cols = ["line_name", "station"]
-date_col = "timestamp"
-target_col = "passage"
-lags = [30, 31, 32, 33, 35, 37, 40, 42, 49, 56, 63, 70]
+if watermark is not None:
+    new_max = df.select(pl.col(date_col).max()).collect().item()
+    if new_max is None or new_max <= watermark:
+        print(f"{out_path} is up to date ({watermark})")
+        sys.exit(0)
+
+    print(f"Refreshing {refresh_start} -> {new_max}")
+
+cache = None if args.no_cache else args.cache_dir
+cache_max_bytes = int(args.cache_max_gb * 2**30)
+
+# sorted so the content key of the dense stage does not depend on row order
+with profile("ingest") as record:
+    df = df.sort(*cat_cols, date_col).collect()
+    record["rows_out"] = len(df)
+if args.dense_span == "series" or args.operating_hours:
+    print(dense_report(df, date_col, cat_cols, operating_hours=args.operating_hours))
+
+# the refresh slice only has the series with rows since the lookback, the
+# global grid of a full rebuild also holds the null rows of the quiet ones
+series = None
+if watermark is not None and args.dense_span == "global":
+    series = known_series(out_path, registry, cat_cols, df.schema)
+
+if args.dense_chunks:
+    # every chunk of series is densified over its own span, featurized and
+    # written as parts of the months it covers, so the peak follows the chunk
+    # instead of the whole dense table. the features of a series only depend
+    # on its own rows
+    parts_path = f"{out_path}.parts"
+    shutil.rmtree(parts_path, ignore_errors=True)
+    chunks = iter_dense(
+        df,
+        target_col,
+        date_col,
+        cat_cols,
+        operating_hours=args.operating_hours,
+        chunk_size=args.dense_chunks,
+    )
+    rows = 0
+    for i, chunk in enumerate(chunks):
+        with profile("build_features", rows_in=len(chunk), chunk=i) as record:
+            chunk = build_features(
+                chunk,
+                target_col,
+                date_col,
+                cat_cols,
+                intervals=intervals,
+                lags=lags,
+                horizon=horizon,
+                quantile_engine=args.quantile_engine,
+                moment_engine=args.moment_engine,
+                session=session,
+                cache=cache,
+                cache_max_bytes=cache_max_bytes,
+            ).collect()
+            record["rows_out"] = len(chunk)
+        with profile("write_partitions", rows_in=len(chunk), chunk=i):
+            write_partitions(chunk, parts_path, date_col, cat_cols, part=i)
+        rows += len(chunk)
+    session.close()
+
+    shutil.rmtree(out_path, ignore_errors=True)
+    with profile("merge_partitions", rows_in=rows):
+        months = merge_partitions(parts_path, out_path, date_col, cat_cols)
+    shutil.rmtree(parts_path)
+else:
+    dense_key = get_key(
+        "dense",
+        [get_dense],
+        frame_key(df),
+        target_col,
+        date_col,
+        cat_cols,
+        args.dense_span,
+        args.operating_hours,
+        None if series is None else frame_key(series),
+    )
+    with profile("get_dense", rows_in=len(df)) as record:
+        df = cached(
+            "dense",
+            dense_key,
+            lambda: get_dense(
+                df.lazy(),
+                target_col,
+                date_col,
+                cat_cols,
+                span=args.dense_span,
+                operating_hours=args.operating_hours,
+                series=series,
+            ).collect(),
+            cache,
+            cache_max_bytes,
+        )
+        record["rows_out"] = len(df)
+
+    if rollup:
+        # one pass writes every table to data/rollups/, the one this run uses is
+        # cached under the dense key like the feature stages
+        rollup_key = get_key(
+            "rollup",
+            [build_rollups],
+            dense_key,
+            args.level,
+            args.grain,
+            args.min_coverage,
+        )
+        with profile("build_rollups", rows_in=len(df)) as record:
+            df = cached(
+                f"rollup_{args.level}_{args.grain}",
+                rollup_key,
+                lambda: pl.read_parquet(
+                    build_rollups(df, target_col, date_col, args.min_coverage)[
+                        args.level, args.grain
+                    ]
+                ),
+                cache,
+                cache_max_bytes,
+            )
+            record["rows_out"] = len(df)
+        # the hour counts stay in data/rollups/, Xy only keeps was_null like
+        # the hourly series
+        df = df.drop("observed", "expected")
+        cat_cols = LEVELS[args.level]
 
-df = get_dense(df, target_col, date_col, cat_cols)
+    with profile("build_features") as record:
+        df = build_features(
+            df,
+            target_col,
+            date_col,
+            cat_cols,
+            intervals=intervals,
+            lags=lags,
+            horizon=horizon,
+            quantile_engine=args.quantile_engine,
+            moment_engine=args.moment_engine,
+            session=session,
+            cache=cache,
+            cache_max_bytes=cache_max_bytes,
+        ).collect()
+        record["rows_out"] = len(df)
+    session.close()
 
-df = add_stat_features(
-    df,
-    "passage",
-    "timestamp",
-    ["line_name", "station"],
-    intervals=["1 day", "1 week", "1 month", "3 months"],
-).collect()
+    if watermark is not None:
+        df = df.filter(pl.col(date_col) >= refresh_start)
+    else:
+        shutil.rmtree(out_path, ignore_errors=True)
 
-df = add_lag_features(df, target_col, cat_cols, date_col, lags).collect()
-df = add_date_features(df, date_col)
+    with profile("write_partitions", rows_in=len(df)):
+        months = write_partitions(df, out_path, date_col, cat_cols)
+    rows = len(df)
+print(f"Wrote {rows} rows to {out_path} ({months[0]} .. {months[-1]})")
 
-df.sink_parquet("data/Xy.parquet")
+if args.profile:
+    print_profile(stop_profiling())
+    print(f"profile written to {args.profile}")
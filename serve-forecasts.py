@@ -0,0 +1,63 @@
+import argparse
+import os
+import time
+from datetime import datetime
+
+from utils.models import MODEL_PATH, list_models, load_models
+from utils.serving import HORIZON, Forecaster, load_features, make_server
+from utils.training import BACKENDS
+
+parser = argparse.ArgumentParser(
+    description="serve the saved models over http, POST /forecast, GET /metrics"
+)
+parser.add_argument(
+    "models",
+    nargs="*",
+    help="model names, name@version for an older version, every saved model "
+    "(latest version) by default",
+)
+parser.add_argument("--models-dir", default=MODEL_PATH)
+parser.add_argument("--features", default="data/Xy/*.parquet")
+parser.add_argument(
+    "--since", type=datetime.fromisoformat, help="oldest feature row kept"
+)
+parser.add_argument(
+    "--horizon",
+    type=int,
+    default=HORIZON,
+    help="days after the last hour of every series that can be forecast",
+)
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument("--socket", help="listen on this unix socket instead")
+parser.add_argument("--backend", choices=BACKENDS, default="cpu")
+parser.add_argument("--nthread", type=int)
+args = parser.parse_args()
+
+names = args.models or list_models(args.models_dir)
+if not names:
+    parser.error(f"no models in {args.models_dir}, run baseline-xgb.py --save-models")
+
+versions = {}
+for spec in names:
+    name, _, version = spec.partition("@")
+    versions[name] = int(version) if version else None
+
+start = time.perf_counter()
+models = load_models(versions, args.models_dir)
+loaded = [f"{name}@{meta['version']}" for name, (_, meta) in models.items()]
+print(f"loaded {', '.join(loaded)} in {time.perf_counter() - start:.2f}s")
+features = load_features(models, args.features, args.since, args.horizon)
+forecaster = Forecaster(models, features, args.backend, args.nthread)
+
+if args.socket is not None and os.path.exists(args.socket):
+    os.remove(args.socket)
+server = make_server(forecaster, args.host, args.port, args.socket)
+print(
+    f"serving {', '.join(models)} ({len(forecaster.series)} series) on "
+    f"{args.socket or f'http://{args.host}:{args.port}'}"
+)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    server.server_close()
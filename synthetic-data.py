@@ -0,0 +1,29 @@
+import argparse
+from datetime import date
+
+from utils.synthetic import write_raw
+
+parser = argparse.ArgumentParser(
+    description="write synthetic raw data in the schema of the IBB hourly export"
+)
+parser.add_argument("--out", default="data/hourly_transportation.parquet")
+parser.add_argument("--lines", type=int, default=5)
+parser.add_argument("--stations", type=int, default=6, help="stations per line")
+parser.add_argument("--days", type=int, default=365)
+parser.add_argument("--start", type=date.fromisoformat, default=date(2023, 1, 1))
+parser.add_argument(
+    "--missing", type=float, default=0.01, help="share of station hours dropped"
+)
+parser.add_argument("--seed", type=int, default=42)
+args = parser.parse_args()
+
+write_raw(
+    args.out,
+    lines=args.lines,
+    stations=args.stations,
+    days=args.days,
+    start=args.start,
+    missing=args.missing,
+    seed=args.seed,
+)
+print(f"wrote {args.out}")
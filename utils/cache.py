@@ -0,0 +1,110 @@
+import hashlib
+import inspect
+import os
+from datetime import datetime
+from glob import glob
+
+import polars as pl
+
+CACHE_PATH = "data/cache"
+CACHE_MAX_BYTES = 20 * 2**30
+
+
+def frame_key(df: pl.DataFrame) -> str:
+    # content and row order, the schema carries the enum categories
+    digest = hashlib.sha256(str(df.schema).encode())
+    digest.update(df.hash_rows(seed=0).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_key(stage: str, code: list, *params) -> str:
+    # the stage name, the source of the modules that compute it, the polars
+    # version (hash_rows is not stable across versions) and every parameter
+    digest = hashlib.sha256(f"{stage}|{pl.__version__}".encode())
+    for module in {inspect.getmodule(obj) for obj in code}:
+        digest.update(inspect.getsource(module).encode())
+    for param in params:
+        digest.update(repr(param).encode())
+
+    return digest.hexdigest()[:16]
+
+
+def cache_file(stage: str, key: str, path: str = CACHE_PATH) -> str:
+    return os.path.join(path, f"{stage}-{key}.parquet")
+
+
+def cached(
+    stage: str,
+    key: str,
+    compute,
+    path: str | None = CACHE_PATH,
+    max_bytes: int = CACHE_MAX_BYTES,
+) -> pl.DataFrame:
+    # compute() unless an entry with the same key exists, path=None disables
+    # the cache
+    if path is None:
+        return compute()
+
+    file = cache_file(stage, key, path)
+    if os.path.exists(file):
+        # the modification time is the last use, eviction drops the oldest
+        os.utime(file)
+        return pl.read_parquet(file)
+
+    df = compute()
+    os.makedirs(path, exist_ok=True)
+    df.write_parquet(f"{file}.tmp")
+    os.replace(f"{file}.tmp", file)
+    prune_cache(path, max_bytes, keep=file)
+
+    return df
+
+
+def list_cache(path: str = CACHE_PATH) -> pl.DataFrame:
+    files = glob(os.path.join(path, "*.parquet"))
+    stats = [os.stat(file) for file in files]
+
+    return pl.DataFrame(
+        {
+            "stage": [os.path.basename(file).rsplit("-", 1)[0] for file in files],
+            "key": [os.path.basename(file).rsplit("-", 1)[1][:-8] for file in files],
+            "mb": [stat.st_size / 2**20 for stat in stats],
+            "last_used": [datetime.fromtimestamp(stat.st_mtime) for stat in stats],
+            "file": files,
+        },
+        schema={
+            "stage": pl.String,
+            "key": pl.String,
+            "mb": pl.Float64,
+            "last_used": pl.Datetime("us"),
+            "file": pl.String,
+        },
+    ).sort("last_used", descending=True)
+
+
+def prune_cache(
+    path: str = CACHE_PATH,
+    max_bytes: int | None = None,
+    stage: str | None = None,
+    keep: str | None = None,
+) -> pl.DataFrame:
+    # drops every entry of `stage`, then the least recently used entries until
+    # the cache fits in max_bytes, returns the dropped entries
+    entries = list_cache(path)
+    dropped = entries.filter(pl.lit(False))
+    if stage is not None:
+        dropped = entries.filter(pl.col("stage") == stage)
+        entries = entries.filter(pl.col("stage") != stage)
+
+    if max_bytes is not None:
+        # entries are sorted most recent first, keep the prefix that fits
+        over = entries.filter(
+            (pl.col("mb").cum_sum() * 2**20 > max_bytes)
+            & pl.col("file").ne_missing(keep)
+        )
+        dropped = pl.concat([dropped, over])
+
+    for file in dropped.get_column("file"):
+        os.remove(file)
+
+    return dropped
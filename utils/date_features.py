@@ -1,21 +1,32 @@
-import duckdb as ddb
+import math
+import os
+
 import polars as pl
 from holidays import Turkey
+from utils.profiling import profile
+from utils.session import Session, get_session
 
+CALENDAR_PATH = "data/calendar.parquet"
 
-class Holiday:
-    def __init__(self, start=2021, end=2025):
-        self.holidays = Turkey(years=[start, end], expand=True)
-
-    def __call__(self, date) -> int:
-        return int(date in self.holidays)
 
+def get_holidays(start_year: int, end_year: int) -> pl.DataFrame:
+    return pl.DataFrame(
+        {"day": sorted(Turkey(years=range(start_year, end_year + 1)))},
+        schema={"day": pl.Date},
+    )
 
-ddb.create_function("is_holiday", Holiday())
 
+def build_calendar(
+    start_year: int, end_year: int, session: Session | None = None
+) -> pl.DataFrame:
+    # one row per hour of every day of the years, the holiday counts look a
+    # week past the years so their first and last days count every holiday
+    with profile("get_holidays") as record:
+        holiday_df = get_holidays(start_year - 1, end_year + 1)
+        record["rows_out"] = len(holiday_df)
 
-def add_date_features(df, date_col):
-    date_df = ddb.sql(f"""
+    query = f"""
+    WITH days AS (
     SELECT 
         day,
         is_holiday::BOOLEAN AS is_holiday,
@@ -45,39 +56,123 @@ def add_date_features(df, date_col):
         
     FROM (
         SELECT 
-            DISTINCT {date_col}::DATE AS day,
-            ISOYEAR({date_col}) AS year,
-            DAYOFYEAR({date_col}) AS doy,
-            WEEKOFYEAR({date_col}) AS woy,
-            MONTH({date_col}) AS moy,
-            ISODOW({date_col}) AS dow,
-            DAY({date_col}) AS dom,
-            DAY(LAST_DAY({date_col}::DATE)) AS total_days_in_month,
+            day,
+            ISOYEAR(day) AS year,
+            DAYOFYEAR(day) AS doy,
+            WEEKOFYEAR(day) AS woy,
+            MONTH(day) AS moy,
+            ISODOW(day) AS dow,
+            DAY(day) AS dom,
+            DAY(LAST_DAY(day)) AS total_days_in_month,
             -- december 28 guarantees last week of the year
-            WEEKOFYEAR(MAKE_DATE(ISOYEAR({date_col}::DATE)::INT, 12, 28)) AS total_weeks_in_year,
-            DAYOFYEAR(MAKE_DATE(YEAR({date_col}::DATE)::INT, 12, 31)) AS total_days_in_year,
-            IS_HOLIDAY({date_col}::DATE) AS is_holiday
+            WEEKOFYEAR(MAKE_DATE(ISOYEAR(day)::INT, 12, 28)) AS total_weeks_in_year,
+            DAYOFYEAR(MAKE_DATE(YEAR(day)::INT, 12, 31)) AS total_days_in_year,
+            (day IN (SELECT day FROM holiday_df))::INT AS is_holiday
         FROM 
-            df
+            (SELECT range::DATE AS day FROM range(
+                MAKE_DATE({start_year - 1}, 12, 25),
+                MAKE_DATE({end_year + 1}, 1, 8),
+                INTERVAL 1 DAY
+            ))
+    )
+    )
+
+    SELECT
+        day,
+        hour,
+        SIN(2*PI()*hour/24) AS hour_sin,
+        COS(2*PI()*hour/24) AS hour_cos,
+        days.* EXCLUDE(day)
+    FROM
+        days
+    CROSS JOIN
+        (SELECT range::INT AS hour FROM range(24))
+    """
+    calendar = (
+        get_session(session)
+        .sql(query, {"holiday_df": holiday_df}, "build_calendar")
+        .pl()
+    )
+
+    return calendar.filter(
+        pl.col("day").dt.year().is_between(start_year, end_year)
+    ).sort("day", "hour")
+
+
+def load_calendar(
+    start_year: int,
+    end_year: int,
+    path: str = CALENDAR_PATH,
+    session: Session | None = None,
+) -> pl.DataFrame:
+    # built once and only rebuilt when a run needs years it does not cover
+    if os.path.exists(path):
+        calendar = pl.read_parquet(path)
+        years = calendar.select(
+            pl.col("day").dt.year().min().alias("start"),
+            pl.col("day").dt.year().max().alias("end"),
+        ).row(0)
+        if years[0] <= start_year and end_year <= years[1]:
+            return calendar
+
+        start_year, end_year = min(start_year, years[0]), max(end_year, years[1])
+
+    with profile("build_calendar") as record:
+        calendar = build_calendar(start_year, end_year, session)
+        record["rows_out"] = len(calendar)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    calendar.write_parquet(path)
+
+    return calendar
+
+
+def get_calendar(
+    df, date_col, path: str = CALENDAR_PATH, session: Session | None = None
+) -> pl.DataFrame:
+    years = (
+        df.lazy()
+        .select(
+            pl.col(date_col).dt.year().min().alias("start"),
+            pl.col(date_col).dt.year().max().alias("end"),
+        )
+        .collect()
+        .row(0)
     )
-    """).pl()
+    return load_calendar(*years, path=path, session=session)
+
+
+def join_date_features(df, calendar: pl.DataFrame, date_col) -> pl.LazyFrame:
+    minute = 2 * math.pi * pl.col(date_col).dt.minute() / 60
+    columns = df.collect_schema().names()
+    hour_columns = ["hour_sin", "hour_cos"]
 
     return (
-        ddb.sql(f"""
-        SELECT 
-            t.*,
-            SIN(2*PI()*HOUR(t.{date_col})/24) AS hour_sin,
-            COS(2*PI()*HOUR(t.{date_col})/24) AS hour_cos,
-            SIN(2*PI()*MINUTE(t.{date_col})/60) AS minute_sin,
-            COS(2*PI()*MINUTE(t.{date_col})/60) AS minute_cos,
-            d.* EXCLUDE(day)
-        FROM 
-            df t
-        LEFT JOIN
-            date_df d
-        ON
-            (t.{date_col}::DATE = d.day)
-    """)
-        .pl(lazy=True)
+        df.lazy()
+        .with_columns(
+            minute.sin().alias("minute_sin"),
+            minute.cos().alias("minute_cos"),
+            pl.col(date_col).dt.date().alias("__day"),
+            pl.col(date_col).dt.hour().cast(pl.Int32).alias("__hour"),
+        )
+        .join(
+            calendar.lazy(),
+            left_on=["__day", "__hour"],
+            right_on=["day", "hour"],
+            how="left",
+            maintain_order="left",
+        )
+        .select(
+            *columns,
+            *hour_columns,
+            "minute_sin",
+            "minute_cos",
+            pl.all().exclude(
+                *columns, *hour_columns, "minute_sin", "minute_cos", "__day", "__hour"
+            ),
+        )
         .with_columns(pl.selectors.numeric().cast(pl.Float32))
     )
+
+
+def add_date_features(df, date_col, session: Session | None = None):
+    return join_date_features(df, get_calendar(df, date_col, session=session), date_col)
@@ -1,31 +1,176 @@
 import polars as pl
 
 
+def get_spans(df: pl.LazyFrame, date_col: str, cat_cols: list[str]) -> pl.DataFrame:
+    return (
+        df.group_by(cat_cols)
+        .agg(
+            pl.col(date_col).min().alias("start"),
+            pl.col(date_col).max().alias("end"),
+        )
+        .sort(cat_cols)
+        .collect()
+    )
+
+
+def in_operating_hours(date: pl.Expr, operating_hours: tuple[int, int]) -> pl.Expr:
+    # [start, end) in hours of the day, wrapping past midnight when start > end
+    start, end = operating_hours
+    hour = date.dt.hour()
+    if start <= end:
+        return hour.is_between(start, end, closed="left")
+
+    return (hour >= start) | (hour < end)
+
+
+def get_grid(
+    df: pl.LazyFrame,
+    date_col: str,
+    cat_cols: list[str],
+    interval: str = "1h",
+    span: str = "global",
+    operating_hours: tuple[int, int] | None = None,
+    spans: pl.DataFrame | None = None,
+    series: pl.DataFrame | None = None,
+) -> pl.LazyFrame:
+    if span == "global":
+        # every series of df over the whole range, or every one in series when
+        # df is a slice some of them have no rows in
+        if series is None:
+            series = df.select(cat_cols).unique()
+
+        bounds = df.select(
+            [pl.col(date_col).min().alias("min"), pl.col(date_col).max().alias("max")]
+        ).collect()
+
+        grid = pl.LazyFrame(
+            {
+                date_col: pl.datetime_range(
+                    bounds.get_column("min")[0],
+                    bounds.get_column("max")[0],
+                    interval=interval,
+                    eager=True,
+                )
+            }
+        ).join(series.lazy().select(cat_cols), how="cross")
+    elif span == "series":
+        if spans is None:
+            spans = get_spans(df, date_col, cat_cols)
+
+        # every series only spans its own first to last observation
+        grid = (
+            spans.lazy()
+            .select(
+                pl.datetime_ranges("start", "end", interval=interval).alias(date_col),
+                *cat_cols,
+            )
+            .explode(date_col)
+        )
+    else:
+        raise ValueError(f"span must be 'global' or 'series', got {span!r}")
+
+    if operating_hours is not None:
+        grid = grid.filter(in_operating_hours(pl.col(date_col), operating_hours))
+
+    return grid
+
+
 def get_dense(
     df: pl.LazyFrame,
     target_col: str,
     date_col: str,
     cat_cols: list[str],
     interval: str = "1h",
+    span: str = "global",
+    operating_hours: tuple[int, int] | None = None,
+    spans: pl.DataFrame | None = None,
+    series: pl.DataFrame | None = None,
 ):
+    grid = get_grid(
+        df, date_col, cat_cols, interval, span, operating_hours, spans, series
+    )
 
-    bounds = df.select(
-        [pl.col(date_col).min().alias("min"), pl.col(date_col).max().alias("max")]
-    ).collect()
+    # observations outside the operating hours are kept, not dropped by the grid
+    if operating_hours is None:
+        dense = grid.join(df, on=[date_col, *cat_cols], how="left")
+    else:
+        dense = grid.join(df, on=[date_col, *cat_cols], how="full", coalesce=True)
 
-    date_range_df = pl.LazyFrame(
-        {
-            date_col: pl.datetime_range(
-                bounds.get_column("min")[0],
-                bounds.get_column("max")[0],
-                interval=interval,
-                eager=True,
-            )
-        }
+    return dense.with_columns(
+        pl.col(target_col).is_null().cast(pl.Int8).alias("was_null")
     )
 
-    return (
-        date_range_df.join(df.select(cat_cols).unique(), how="cross")
-        .join(df, on=[date_col, *cat_cols], how="left")
-        .with_columns(pl.col(target_col).is_null().cast(pl.Int8).alias("was_null"))
+
+def iter_dense(
+    df: pl.LazyFrame,
+    target_col: str,
+    date_col: str,
+    cat_cols: list[str],
+    interval: str = "1h",
+    operating_hours: tuple[int, int] | None = None,
+    chunk_size: int = 32,
+):
+    # df is re-read once per chunk, so pass a materialized frame or a cheap scan
+    df = df.lazy()
+    spans = get_spans(df, date_col, cat_cols)
+
+    for offset in range(0, len(spans), chunk_size):
+        chunk = spans.slice(offset, chunk_size)
+        part = df.join(chunk.lazy().select(cat_cols), on=cat_cols, how="semi")
+
+        yield get_dense(
+            part,
+            target_col,
+            date_col,
+            cat_cols,
+            interval,
+            span="series",
+            operating_hours=operating_hours,
+            spans=chunk,
+        ).collect()
+
+
+def dense_report(
+    df: pl.LazyFrame,
+    date_col: str,
+    cat_cols: list[str],
+    interval: str = "1h",
+    operating_hours: tuple[int, int] | None = None,
+) -> pl.DataFrame:
+    df = df.lazy()
+    observed = df.select(pl.len()).collect().item()
+
+    # dense rows cost the full width of the observed rows plus was_null
+    sample = df.head(100_000).collect()
+    row_bytes = sample.estimated_size() / max(len(sample), 1) + 1
+
+    # observations outside the operating hours are added on top of the grid
+    outside = 0
+    if operating_hours is not None:
+        outside = (
+            df.filter(~in_operating_hours(pl.col(date_col), operating_hours))
+            .select(pl.len())
+            .collect()
+            .item()
+        )
+
+    rows = {
+        span: get_grid(df, date_col, cat_cols, interval, span, operating_hours)
+        .select(pl.len())
+        .collect(engine="streaming")
+        .item()
+        + outside
+        for span in ["global", "series"]
+    }
+
+    return pl.DataFrame(
+        {
+            "span": list(rows),
+            "rows": list(rows.values()),
+            "added_rows": [n - observed for n in rows.values()],
+            "mb": [n * row_bytes / 2**20 for n in rows.values()],
+            "saved_mb": [
+                (rows["global"] - n) * row_bytes / 2**20 for n in rows.values()
+            ],
+        }
     )
@@ -0,0 +1,111 @@
+import os
+from datetime import datetime, timedelta
+from glob import glob
+
+import polars as pl
+
+UNIT_DAYS = {"hour": 1 / 24, "day": 1, "week": 7, "month": 31, "year": 366}
+
+
+def interval_days(interval: str) -> float:
+    # upper bound in days of a DuckDB interval string such as "3 months"
+    n, unit = interval.split()
+    return int(n) * UNIT_DAYS[unit.lower().removesuffix("s")]
+
+
+def get_lookback(intervals: list[str], lags: list[int], horizon: int = 30) -> timedelta:
+    days = max(
+        horizon + max(interval_days(interval) for interval in intervals),
+        max(lags),
+    )
+    return timedelta(days=days)
+
+
+def partition_files(path: str) -> list[str]:
+    return sorted(glob(os.path.join(path, "*.parquet")))
+
+
+def read_watermark(path: str, date_col: str) -> datetime | None:
+    files = partition_files(path)
+    if not files:
+        return None
+
+    # partitions are named by month, so the last file holds the latest rows
+    return pl.scan_parquet(files[-1]).select(pl.col(date_col).max()).collect().item()
+
+
+def known_series(
+    path: str, registry: pl.DataFrame, cat_cols: list[str], schema: pl.Schema
+) -> pl.DataFrame:
+    # every series a full rebuild would densify: the ones already written and
+    # the ones in the station registry, typed like the refresh slice. a refresh
+    # slice misses the series that have gone quiet since the lookback
+    dtypes = {col: schema[col] for col in cat_cols}
+    written = pl.scan_parquet(partition_files(path)).select(cat_cols)
+    registered = (
+        registry.lazy()
+        .filter(pl.col("line_name").is_in(schema["line_name"].categories))
+        .select(cat_cols)
+    )
+
+    return (
+        pl.concat([written.cast(dtypes), registered.cast(dtypes)])
+        .unique()
+        .sort(cat_cols)
+        .collect()
+    )
+
+
+def get_refresh_start(watermark: datetime) -> datetime:
+    # partitions are rewritten whole, so restart at the month boundary
+    return datetime(watermark.year, watermark.month, 1)
+
+
+def write_partitions(
+    df: pl.DataFrame,
+    path: str,
+    date_col: str,
+    sort_cols: list[str],
+    part: int | None = None,
+):
+    # with part, the rows go to <month>.<part>.parquet next to the other parts
+    # of the month instead of replacing it, see merge_partitions
+    os.makedirs(path, exist_ok=True)
+
+    partitions = df.with_columns(
+        pl.col(date_col).dt.strftime("%Y-%m").alias("__month")
+    ).partition_by("__month", as_dict=True, include_key=False)
+
+    for (month,), part_df in sorted(partitions.items()):
+        name = month if part is None else f"{month}.{part:05d}"
+        file = os.path.join(path, f"{name}.parquet")
+        part_df.sort(date_col, *sort_cols).write_parquet(f"{file}.tmp")
+        os.replace(f"{file}.tmp", file)
+
+    return sorted(month for (month,) in partitions)
+
+
+def merge_partitions(
+    parts_path: str, path: str, date_col: str, sort_cols: list[str]
+) -> list[str]:
+    # the parts written by write_partitions(part=...) become one file per month
+    # in path, one month is read at a time
+    months = {}
+    for file in partition_files(parts_path):
+        months.setdefault(os.path.basename(file).split(".")[0], []).append(file)
+
+    os.makedirs(path, exist_ok=True)
+    for month, files in sorted(months.items()):
+        file = os.path.join(path, f"{month}.parquet")
+        pl.scan_parquet(files).sort(date_col, *sort_cols).sink_parquet(f"{file}.tmp")
+        os.replace(f"{file}.tmp", file)
+
+    return sorted(months)
+
+
+def recast_partitions(path: str, dtypes: dict[str, pl.DataType]):
+    # partitions written before the station registry grew carry the shorter
+    # enum, cast them so the whole dataset scans with a single schema
+    for file in partition_files(path):
+        pl.read_parquet(file).cast(dtypes).write_parquet(f"{file}.tmp")
+        os.replace(f"{file}.tmp", file)
@@ -0,0 +1,88 @@
+from datetime import date, datetime
+
+import polars as pl
+
+RAW_SCHEMA = {
+    "transition_date": pl.String,
+    "transition_hour": pl.Int64,
+    "transport_type_id": pl.Int64,
+    "road_type": pl.String,
+    "line": pl.String,
+    "line_name": pl.String,
+    "station_poi_desc_cd": pl.String,
+    "transfer_type": pl.String,
+    "number_of_passage": pl.Int64,
+    "number_of_passenger": pl.Int64,
+    "product_kind": pl.String,
+    "transaction_type_desc": pl.String,
+    "town": pl.String,
+}
+
+US_PER_DAY = 86_400_000_000
+US_PER_HOUR = 3_600_000_000
+
+
+def check_schema(df: pl.LazyFrame) -> pl.Schema:
+    schema = df.collect_schema()
+    missing = [col for col in RAW_SCHEMA if col not in schema]
+    if missing:
+        raise ValueError(f"raw data is missing columns: {missing}")
+
+    for col, dtype in RAW_SCHEMA.items():
+        actual = schema[col]
+        # some exports store the date already typed, both are accepted
+        if col == "transition_date" and actual == pl.Date:
+            continue
+        if dtype.is_integer() and actual.is_integer():
+            continue
+        if actual != dtype:
+            raise TypeError(f"raw column {col} is {actual}, expected {dtype}")
+
+    return schema
+
+
+def to_timestamp(
+    schema: pl.Schema, date_col="transition_date", hour_col="transition_hour"
+):
+    if schema[date_col] == pl.String:
+        # cache=True parses each distinct day once instead of once per row
+        day = pl.col(date_col).str.to_date("%Y-%m-%d", cache=True)
+    else:
+        day = pl.col(date_col)
+
+    return (
+        day.cast(pl.Int32).cast(pl.Int64) * US_PER_DAY
+        + pl.col(hour_col).cast(pl.Int64) * US_PER_HOUR
+    ).cast(pl.Datetime("us"))
+
+
+def scan_raw(
+    path: str,
+    lines: list[str],
+    road_type: str = "RAYLI",
+    start: datetime | None = None,
+) -> pl.LazyFrame:
+    df = pl.scan_parquet(path)
+    schema = check_schema(df)
+
+    # plain column predicates directly on the scan, so they are pushed down
+    # to the parquet reader and evaluated against row group statistics
+    predicates = [
+        pl.col("road_type") == road_type,
+        pl.col("line_name").is_in(lines),
+        pl.col("station_poi_desc_cd").is_not_null(),
+    ]
+    if start is not None:
+        if schema["transition_date"] == pl.String:
+            predicates.append(pl.col("transition_date") >= start.strftime("%Y-%m-%d"))
+        else:
+            predicates.append(
+                pl.col("transition_date") >= date(start.year, start.month, start.day)
+            )
+
+    return df.filter(*predicates).select(
+        pl.col("line_name").cast(pl.Enum(lines)),
+        pl.col("station_poi_desc_cd").cast(pl.Categorical).alias("station"),
+        to_timestamp(schema).alias("timestamp"),
+        pl.col("number_of_passage"),
+    )
@@ -1,8 +1,103 @@
-import duckdb as ddb
+from datetime import timedelta
+
 import polars as pl
+from utils.session import Session, get_session
+from utils.stations import decode_keys, encode_keys
+
+LAG_UNITS = {
+    "MINUTE": timedelta(minutes=1),
+    "HOUR": timedelta(hours=1),
+    "DAY": timedelta(days=1),
+    "WEEK": timedelta(weeks=1),
+}
+
+
+def get_step(df: pl.DataFrame, date_col, cat_cols) -> timedelta | None:
+    # the single spacing of every series if df (sorted by series, then date)
+    # is a regular grid, None if any series has gaps or duplicates
+    steps = (
+        df.select(pl.col(date_col).diff().over(cat_cols).alias("step"))
+        .drop_nulls()
+        .unique()
+    )
+    if len(steps) != 1 or steps.item() <= timedelta(0):
+        return None
+
+    return steps.item()
+
+
+def get_offsets(
+    df: pl.DataFrame, date_col, cat_cols, lags, lag_unit="DAY"
+) -> list[int] | None:
+    # row offset of every lag if df (sorted by series, then date) is a regular
+    # grid the lags land on, None otherwise
+    step = get_step(df, date_col, cat_cols)
+    if step is None or lag_unit.upper() not in LAG_UNITS:
+        return None
+
+    deltas = [lag * LAG_UNITS[lag_unit.upper()] for lag in lags]
+    if any(delta % step != timedelta(0) for delta in deltas):
+        return None
+
+    return [delta // step for delta in deltas]
+
+
+def lag_features_shift(
+    df: pl.DataFrame, target_col, cat_cols, date_col, lags, offsets: list[int]
+):
+    # on a regular grid a lag is a fixed row offset within the series
+    position = pl.int_range(pl.len()).over(cat_cols)
+
+    return (
+        df.lazy()
+        .with_columns(
+            pl.when(position >= offset)
+            .then(pl.col(target_col).shift(offset))
+            .alias(f"{target_col}_lag_{lag}")
+            for lag, offset in zip(lags, offsets)
+        )
+        .with_columns(pl.selectors.numeric().cast(pl.Float32))
+    )
 
 
-def add_lag_features(df, target_col, cat_cols, date_col, lags, lag_unit="DAY"):
+def add_lag_features(
+    df,
+    target_col,
+    cat_cols,
+    date_col,
+    lags,
+    lag_unit="DAY",
+    engine="auto",
+    session: Session | None = None,
+):
+    if engine not in ("auto", "shift", "join"):
+        raise ValueError(f"engine must be 'auto', 'shift' or 'join', got {engine!r}")
+
+    if engine != "join":
+        df = df.lazy().sort(*cat_cols, date_col).collect()
+        offsets = get_offsets(df, date_col, cat_cols, lags, lag_unit)
+        if offsets is not None:
+            return lag_features_shift(df, target_col, cat_cols, date_col, lags, offsets)
+        if engine == "shift":
+            raise ValueError(
+                "lags are not a fixed row offset, df is not a regular grid"
+            )
+
+    return lag_features_join(
+        df, target_col, cat_cols, date_col, lags, lag_unit, session
+    )
+
+
+def lag_features_join(
+    df,
+    target_col,
+    cat_cols,
+    date_col,
+    lags,
+    lag_unit="DAY",
+    session: Session | None = None,
+):
+    df, key_dtypes = encode_keys(df, cat_cols)
     cat_col_str = ", ".join(col for col in cat_cols)
     constants = f"{date_col}, {target_col}, {cat_col_str},\n"
 
@@ -33,9 +128,7 @@ def add_lag_features(df, target_col, cat_cols, date_col, lags, lag_unit="DAY"):
     )
     cte_select_clauses_str = "".join(cte_select_clauses)
 
-    return (
-        ddb.sql(
-            f"""
+    query = f"""
     WITH future_table AS (
         SELECT
             {select_clauses_str}
@@ -49,7 +142,11 @@ def add_lag_features(df, target_col, cat_cols, date_col, lags, lag_unit="DAY"):
         df a
     {join_condition_str}
     """
-        )
+
+    return (
+        get_session(session)
+        .sql(query, {"df": df}, "lag_features_join")
         .pl(lazy=True)
+        .with_columns(decode_keys(key_dtypes))
         .with_columns(pl.selectors.numeric().cast(pl.Float32))
     )
@@ -0,0 +1,127 @@
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import polars as pl
+import xgboost
+
+
+@dataclass
+class Matrix:
+    X: pd.DataFrame
+    y: np.ndarray
+    weight: np.ndarray | None
+
+
+def category_dtype(df: pl.DataFrame, cat_col) -> pl.Enum:
+    # the global dictionary, enum keys keep their registry order, anything
+    # else is sorted the way pandas orders inferred categories
+    dtype = df.schema[cat_col]
+    if isinstance(dtype, pl.Enum):
+        return dtype
+
+    return pl.Enum(df.get_column(cat_col).cast(pl.String).drop_nulls().unique().sort())
+
+
+def get_matrix(
+    Xy: pl.DataFrame,
+    target_col,
+    date_col,
+    cat_col,
+    log1p: bool = True,
+    weighted: bool = True,
+    dtype: pl.Enum | None = None,
+) -> Matrix:
+    # one pandas copy of the features, cat_col is cast to the fixed dictionary
+    # so every fold and every batch sees the same category codes
+    dtype = dtype or category_dtype(Xy, cat_col)
+    X = Xy.drop(date_col, target_col).with_columns(pl.col(cat_col).cast(dtype))
+
+    if log1p:
+        y = Xy.get_column(target_col).log1p().to_numpy()
+    else:
+        y = Xy.get_column(target_col).to_numpy()
+
+    return Matrix(X.to_pandas(), y, 1 / y if weighted else None)
+
+
+def get_features(
+    Xy: pl.DataFrame, columns: list[str], cat_col, dtype: pl.Enum
+) -> pd.DataFrame:
+    # the feature frame of a trained model, its columns in training order and
+    # cat_col cast to its dictionary
+    return Xy.select(columns).with_columns(pl.col(cat_col).cast(dtype)).to_pandas()
+
+
+def slice_matrix(matrix: Matrix, offset: int, length: int) -> Matrix:
+    # row views, nothing is copied until xgboost reads the rows
+    rows = slice(offset, offset + length)
+    weight = None if matrix.weight is None else matrix.weight[rows]
+    return Matrix(matrix.X.iloc[rows], matrix.y[rows], weight)
+
+
+def to_dmatrix(
+    matrix: Matrix,
+    ref: xgboost.DMatrix | None = None,
+    max_bin: int | None = None,
+    nthread: int | None = None,
+) -> xgboost.DMatrix:
+    # evaluation sets pass the training matrix as ref to share its bins,
+    # max_bin has to match the booster's
+    return xgboost.QuantileDMatrix(
+        matrix.X,
+        matrix.y,
+        weight=matrix.weight,
+        enable_categorical=True,
+        ref=ref,
+        max_bin=max_bin,
+        nthread=nthread,
+    )
+
+
+class XyBatches(xgboost.DataIter):
+    # feeds xgboost one lazy frame at a time (a parquet file with its filters
+    # pushed down), only the current batch and the compressed histogram pages
+    # are held in memory
+    def __init__(
+        self,
+        batches: list[pl.LazyFrame],
+        target_col,
+        date_col,
+        cat_col,
+        dtype: pl.Enum,
+        log1p: bool = True,
+        weighted: bool = True,
+        cache_dir: str = "data/cache/xgb",
+    ):
+        self.batches = batches
+        self.options = (target_col, date_col, cat_col, log1p, weighted, dtype)
+        self._it = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        super().__init__(cache_prefix=os.path.join(cache_dir, "batches"))
+
+    def next(self, input_data) -> bool:
+        while self._it < len(self.batches):
+            Xy = self.batches[self._it].collect()
+            self._it += 1
+            if len(Xy) > 0:
+                matrix = get_matrix(Xy, *self.options)
+                input_data(data=matrix.X, label=matrix.y, weight=matrix.weight)
+                return True
+
+        return False
+
+    def reset(self):
+        self._it = 0
+
+
+def external_dmatrix(
+    batches: XyBatches,
+    ref: xgboost.DMatrix | None = None,
+    max_bin: int | None = None,
+    nthread: int | None = None,
+):
+    return xgboost.ExtMemQuantileDMatrix(
+        batches, enable_categorical=True, ref=ref, max_bin=max_bin, nthread=nthread
+    )
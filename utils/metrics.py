@@ -1,3 +1,6 @@
+import math
+
+import numpy as np
 import polars as pl
 from sklearn.metrics import (
     mean_absolute_error,
@@ -6,13 +9,171 @@ from sklearn.metrics import (
     root_mean_squared_error,
 )
 
+METRIC_NAMES = ["rmse", "medae", "mae", "mape", "wape", "smape"]
+
+# sklearn's guard against dividing by a zero target in mape
+EPSILON = np.finfo(np.float64).eps
+
+# sketch bucket of the exact zero errors
+ZERO_BUCKET = -(2**31)
+
+
+def metric_exprs(target_col, pred_col: str = "prediction") -> list[pl.Expr]:
+    # METRIC_NAMES as aggregations, so every group is scored inside one
+    # group_by instead of a python callback per group
+    y = pl.col(target_col).cast(pl.Float64)
+    y_pred = pl.col(pred_col).cast(pl.Float64)
+    error = (y - y_pred).abs()
+    scale = y.abs() + y_pred.abs()
+
+    return [
+        (error * error).mean().sqrt().alias("rmse"),
+        error.median().alias("medae"),
+        error.mean().alias("mae"),
+        (error / pl.max_horizontal(y.abs(), pl.lit(EPSILON))).mean().alias("mape"),
+        (error.sum() / y.abs().sum()).alias("wape"),
+        # a pair of zeros is a perfect forecast, not a division by zero
+        pl.when(scale > 0).then(2 * error / scale).otherwise(0).mean().alias("smape"),
+    ]
 
-def get_all_metrics(results: pl.DataFrame, cat_col, target_col):
 
+def residual_sums(target_col, pred_col: str = "prediction") -> list[pl.Expr]:
+    # the sums every metric but medae is finished from, sums of two groups add
+    # up to the sums of their union
+    y = pl.col(target_col).cast(pl.Float64)
+    y_pred = pl.col(pred_col).cast(pl.Float64)
+    error = (y - y_pred).abs()
+    scale = y.abs() + y_pred.abs()
+
+    return [
+        pl.len().cast(pl.Float64).alias("n"),
+        (error * error).sum().alias("squared_error"),
+        error.sum().alias("absolute_error"),
+        (error / pl.max_horizontal(y.abs(), pl.lit(EPSILON))).sum().alias("ape"),
+        y.abs().sum().alias("absolute_target"),
+        pl.when(scale > 0).then(2 * error / scale).otherwise(0).sum().alias("sape"),
+    ]
+
+
+def finish_metrics(df, keys: list[str]) -> pl.LazyFrame:
+    # one row per group, METRIC_NAMES in order and float32 like the results
+    return (
+        df.lazy()
+        .select(*keys, *METRIC_NAMES)
+        .sort(keys)
+        .with_columns(pl.selectors.float().cast(pl.Float32))
+    )
+
+
+class MetricAccumulator:
+    # METRIC_NAMES per group of keys, updated batch by batch (a cv fold) and
+    # mergeable with other accumulators. the sums are kept exactly, medae
+    # comes from a DDSketch of the absolute errors: log spaced buckets with
+    # `relative_accuracy`, at most `max_buckets` per group (the lowest ones
+    # are collapsed first), so the state never grows with the rows seen
+    def __init__(
+        self,
+        keys: list[str],
+        target_col,
+        pred_col: str = "prediction",
+        relative_accuracy: float = 0.005,
+        max_buckets: int = 2048,
+    ):
+        self.keys = keys
+        self.target_col = target_col
+        self.pred_col = pred_col
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.max_buckets = max_buckets
+        self.sums = None
+        self.buckets = None
+
+    def update(self, df):
+        # df holds at least the keys, the target and the prediction
+        error = (
+            pl.col(self.target_col).cast(pl.Float64)
+            - pl.col(self.pred_col).cast(pl.Float64)
+        ).abs()
+        bucket = (
+            pl.when(error > 0)
+            .then((error.log() / math.log(self.gamma)).ceil())
+            .otherwise(ZERO_BUCKET)
+            .cast(pl.Int32)
+        )
+
+        df = df.lazy()
+        sums, buckets = pl.collect_all(
+            [
+                df.group_by(self.keys).agg(
+                    residual_sums(self.target_col, self.pred_col)
+                ),
+                df.group_by(*self.keys, bucket.alias("bucket")).agg(
+                    pl.len().cast(pl.Int64).alias("count")
+                ),
+            ]
+        )
+        self.add(sums, buckets)
+
+    def merge(self, other: "MetricAccumulator"):
+        if other.sums is not None:
+            self.add(other.sums, other.buckets)
+
+    def add(self, sums: pl.DataFrame, buckets: pl.DataFrame):
+        if self.sums is not None:
+            sums = pl.concat([self.sums, sums]).group_by(self.keys).agg(pl.all().sum())
+            buckets = pl.concat([self.buckets, buckets])
+
+        # the buckets below the max_buckets highest are folded into the lowest
+        # one kept, only the small errors lose accuracy
+        floor = pl.col("bucket").unique().top_k(self.max_buckets).min()
+        self.sums = sums
+        self.buckets = (
+            buckets.with_columns(
+                pl.max_horizontal("bucket", floor.over(self.keys)).alias("bucket")
+            )
+            .group_by(*self.keys, "bucket")
+            .agg(pl.col("count").sum())
+        )
+
+    def result(self) -> pl.DataFrame:
+        # the median from the sketch, within relative_accuracy of the lower of
+        # the two middle errors
+        count = pl.col("count")
+        bucket = pl.col("bucket").filter(count.cum_sum() > (count.sum() - 1) / 2)
+        value = 2 * pl.lit(self.gamma).pow(bucket.first()) / (self.gamma + 1)
+        medae = (
+            self.buckets.lazy()
+            .sort(*self.keys, "bucket")
+            .group_by(self.keys)
+            .agg(
+                pl.when(bucket.first() == ZERO_BUCKET)
+                .then(0.0)
+                .otherwise(value)
+                .alias("medae")
+            )
+        )
+
+        n = pl.col("n")
+        return finish_metrics(
+            self.sums.lazy()
+            .join(medae, on=self.keys)
+            .with_columns(
+                (pl.col("squared_error") / n).sqrt().alias("rmse"),
+                (pl.col("absolute_error") / n).alias("mae"),
+                (pl.col("ape") / n).alias("mape"),
+                (pl.col("absolute_error") / pl.col("absolute_target")).alias("wape"),
+                (pl.col("sape") / n).alias("smape"),
+            ),
+            self.keys,
+        ).collect()
+
+
+def sklearn_metrics(target_col, pred_col: str = "prediction"):
     def calculate_metrics(s: pl.Series) -> pl.Series:
         df = s.struct.unnest()
         y = df[target_col].to_numpy()
-        y_pred = df["prediction"].to_numpy()
+        y_pred = df[pred_col].to_numpy()
+        error = np.abs(y - y_pred)
+        scale = np.abs(y) + np.abs(y_pred)
 
         return pl.Series(
             [
@@ -21,38 +182,43 @@ def get_all_metrics(results: pl.DataFrame, cat_col, target_col):
                     "medae": median_absolute_error(y, y_pred),
                     "mae": mean_absolute_error(y, y_pred),
                     "mape": mean_absolute_percentage_error(y, y_pred),
+                    "wape": error.sum() / np.abs(y).sum(),
+                    "smape": np.mean(
+                        np.divide(
+                            2 * error, scale, out=np.zeros_like(scale), where=scale > 0
+                        )
+                    ),
                 }
             ]
         )
 
-    by_all = (
-        (
-            results.group_by("split", cat_col)
-            .agg(
-                pl.struct(target_col, "prediction")
-                .map_batches(calculate_metrics)
-                .alias("metrics"),
-            )
-            .with_columns(pl.col("metrics").list.first())
-            .unnest("metrics")
-        )
-        .sort(["split", cat_col])
-        .with_columns(pl.selectors.float().cast(pl.Float32))
-    )
+    return [
+        pl.struct(target_col, pred_col).map_batches(calculate_metrics).alias("metrics")
+    ]
 
-    by_cat = (
-        (
-            results.group_by(cat_col)
-            .agg(
-                pl.struct(target_col, "prediction")
-                .map_batches(calculate_metrics)
-                .alias("metrics"),
-            )
+
+def get_all_metrics(results: pl.DataFrame, cat_col, target_col, engine="polars"):
+    # the metrics of every (split, cat_col) and of every cat_col over all
+    # splits, both levels are planned together and run in parallel
+    if engine not in ("polars", "sklearn"):
+        raise ValueError(f"engine must be 'polars' or 'sklearn', got {engine!r}")
+
+    def score(keys: list[str]) -> pl.LazyFrame:
+        if engine == "polars":
+            return results.lazy().group_by(keys).agg(metric_exprs(target_col))
+
+        # the reference, a python callback per group
+        return (
+            results.lazy()
+            .group_by(keys)
+            .agg(sklearn_metrics(target_col))
             .with_columns(pl.col("metrics").list.first())
             .unnest("metrics")
         )
-        .sort(cat_col)
-        .with_columns(pl.selectors.float().cast(pl.Float32))
+
+    levels = [["split", cat_col], [cat_col]]
+    by_all, by_cat = pl.collect_all(
+        [finish_metrics(score(keys), keys) for keys in levels]
     )
 
     return by_all, by_cat
@@ -0,0 +1,113 @@
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+import polars as pl
+import xgboost
+
+MODEL_PATH = "models"
+
+
+def get_meta(
+    name: str,
+    line: str | None,
+    df,
+    matrix,
+    target_col,
+    date_col,
+    cat_col,
+    params: dict,
+    log1p: bool,
+    metrics: pl.DataFrame | None = None,
+) -> dict:
+    # what serving needs to rebuild the feature frame a booster was fit on,
+    # and the cv metrics of its params
+    return {
+        "name": name,
+        "line": line,
+        "target_col": target_col,
+        "date_col": date_col,
+        "cat_col": cat_col,
+        "categories": matrix.X[cat_col].cat.categories.tolist(),
+        "features": matrix.X.columns.tolist(),
+        "log1p": log1p,
+        "params": params,
+        "train_start": df.get_column(date_col).min(),
+        "train_end": df.get_column(date_col).max(),
+        "rows": len(df),
+        "metrics": None if metrics is None else metrics.to_dicts(),
+    }
+
+
+def list_versions(name: str, path: str = MODEL_PATH) -> list[int]:
+    # only complete versions, a save in progress is still a hidden temp dir
+    return sorted(
+        int(os.path.basename(os.path.dirname(file)))
+        for file in glob(os.path.join(path, name, "[0-9]*", "meta.json"))
+    )
+
+
+def save_model(
+    xgb: xgboost.Booster, meta: dict, name: str, path: str = MODEL_PATH
+) -> int:
+    # models/<name>/<version>/ with model.ubj and the schema the features have
+    # to follow in meta.json. the version is written to a temp dir and renamed
+    # into place, a reader never sees half of one
+    directory = os.path.join(path, name)
+    os.makedirs(directory, exist_ok=True)
+    versions = list_versions(name, path)
+    version = versions[-1] + 1 if versions else 1
+
+    tmp = tempfile.mkdtemp(prefix=".tmp-", dir=directory)
+    xgb.save_model(os.path.join(tmp, "model.ubj"))
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({**meta, "version": version}, f, indent=2, default=str)
+    os.rename(tmp, os.path.join(directory, f"{version:04d}"))
+
+    return version
+
+
+def load_booster(file: str) -> xgboost.Booster:
+    # xgboost reads the file itself, no python copy of the model bytes
+    xgb = xgboost.Booster()
+    xgb.load_model(file)
+    return xgb
+
+
+def load_model(
+    name: str, path: str = MODEL_PATH, version: int | None = None
+) -> tuple[xgboost.Booster, dict]:
+    # the latest version unless one is asked for
+    if version is None:
+        versions = list_versions(name, path)
+        if not versions:
+            raise FileNotFoundError(f"no saved versions of {name} in {path}")
+        version = versions[-1]
+
+    directory = os.path.join(path, name, f"{version:04d}")
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+
+    return load_booster(os.path.join(directory, "model.ubj")), meta
+
+
+def load_models(versions: dict, path: str = MODEL_PATH) -> dict:
+    # name -> (booster, meta) for name -> version (None for the latest),
+    # xgboost releases the gil while parsing so the models load side by side
+    with ThreadPoolExecutor() as pool:
+        futures = {
+            name: pool.submit(load_model, name, path, version)
+            for name, version in versions.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def list_models(path: str = MODEL_PATH) -> list[str]:
+    return sorted(
+        {
+            os.path.basename(os.path.dirname(os.path.dirname(file)))
+            for file in glob(os.path.join(path, "*", "[0-9]*", "meta.json"))
+        }
+    )
@@ -0,0 +1,312 @@
+import calendar
+import math
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+
+import numpy as np
+import polars as pl
+from utils.date_features import CALENDAR_PATH, get_calendar, join_date_features
+from utils.incremental import get_lookback
+from utils.lag_features import LAG_UNITS
+from utils.rolling import (
+    DURATION_UNITS,
+    MOMENT_STATS,
+    ORDER_STATS,
+    QUANTILES,
+    finalize_moments,
+    interval_suffix,
+)
+from utils.session import Session
+
+# column order of add_stat_features
+STATS = ["avg", "min", "max", *QUANTILES, *MOMENT_STATS[1:]]
+
+UNIT_DELTAS = {"h": timedelta(hours=1), "d": timedelta(days=1), "w": timedelta(weeks=1)}
+
+
+def offset_back(ts: datetime, interval: str) -> datetime:
+    # ts - interval the way polars' offset_by does it, month arithmetic clamps
+    # to the month end (2023-03-29 - 1 month = 2023-02-28)
+    n, unit = interval.split()
+    n, unit = int(n), DURATION_UNITS[unit.lower().removesuffix("s")]
+    if unit not in ("mo", "y"):
+        return ts - n * UNIT_DELTAS[unit]
+
+    months = ts.year * 12 + ts.month - 1 - n * (12 if unit == "y" else 1)
+    year, month = divmod(months, 12)
+    day = min(ts.day, calendar.monthrange(year, month + 1)[1])
+    return ts.replace(year=year, month=month + 1, day=day)
+
+
+class Window:
+    # one RANGE frame of a series: its valid values kept sorted for the order
+    # stats and the running sums its central moments come from. only the sums are
+    # O(1) per add or remove, the sorted list is a bisect plus an O(n) shift
+    # of the n values in the frame (~2200 for 3 months of hours). sums of
+    # integral values stay python ints, so they never drift however long the
+    # stream
+    def __init__(self):
+        self.low = 0
+        self.end = -1
+        self.values = []
+        self.sums = [0] * 11
+
+    def terms(self, t, x, center):
+        if x.is_integer():
+            x = int(x)
+        y = x - center
+        return (1, x, x * x, math.log1p(x), y, y * y, y**3, y**4, t, t * t, t * x)
+
+    def add(self, t, x, center):
+        if x == x:
+            insort(self.values, x)
+            self.sums = [s + d for s, d in zip(self.sums, self.terms(t, x, center))]
+
+    def remove(self, t, x, center):
+        if x == x:
+            del self.values[bisect_left(self.values, x)]
+            self.sums = [s - d for s, d in zip(self.sums, self.terms(t, x, center))]
+
+    def moments(self) -> list:
+        # the arguments of finalize_moments, the central moments from the
+        # power sums. with integral values every numerator is an exact int,
+        # so the division is the only rounding
+        n, s1, s2, ln1p, y1, y2, y3, y4, st, stt, stx = self.sums
+        if not n:
+            return [0] * 9
+
+        return [
+            n,
+            s1,
+            s2,
+            ln1p,
+            (n * y2 - y1 * y1) / n,
+            (n * n * y3 - 3 * n * y2 * y1 + 2 * y1**3) / n**2,
+            (n**3 * y4 - 4 * n * n * y3 * y1 + 6 * n * y2 * y1 * y1 - 3 * y1**4) / n**3,
+            (n * stt - st * st) / n,
+            (n * stx - st * s1) / n,
+        ]
+
+    def order_stats(self) -> list:
+        n = len(self.values)
+        if not n:
+            return [None] * len(ORDER_STATS)
+
+        # same index DuckDB's discrete quantile picks
+        return [
+            self.values[0],
+            self.values[-1],
+            *[self.values[max(math.ceil(n * q), 1) - 1] for q in QUANTILES.values()],
+        ]
+
+
+class SeriesState:
+    # the last `capacity` values of one series in a ring buffer, addressed by
+    # their row position since the series started
+    def __init__(self, origin: datetime, capacity: int, n_windows: int, center=0):
+        self.origin = origin
+        self.rows = 0
+        self.buffer = [math.nan] * capacity
+        self.windows = [Window() for _ in range(n_windows)]
+        self.center = center
+
+    def value(self, position: int) -> float:
+        return self.buffer[position % len(self.buffer)]
+
+
+class OnlineFeatures:
+    # the feature row build_features would produce for the next hour of every
+    # series, kept up to date one observation at a time instead of recomputed
+    # from the history. a series is a regular grid of `step`, hours it never
+    # reports are missing values, the same as the dense rows offline
+    def __init__(
+        self,
+        target_col: str,
+        date_col: str,
+        cat_cols: list[str],
+        intervals: list[str],
+        lags: list[int],
+        horizon: int = 30,
+        lag_unit: str = "DAY",
+        step: timedelta = timedelta(hours=1),
+        calendar_path: str = CALENDAR_PATH,
+        session: Session | None = None,
+    ):
+        self.target_col = target_col
+        self.date_col = date_col
+        self.cat_cols = cat_cols
+        self.intervals = intervals
+        self.lags = lags
+        self.step = step
+        self.calendar_path = calendar_path
+        self.session = session
+        self.calendar = None
+
+        # horizon and lags as row offsets on the grid
+        self.shift = timedelta(days=horizon) // step
+        self.offsets = [lag * LAG_UNITS[lag_unit.upper()] // step for lag in lags]
+        self.capacity = get_lookback(intervals, lags, horizon) // step + 2
+        hours = step / timedelta(hours=1)
+        self.hours = int(hours) if hours.is_integer() else hours
+
+        self.series = {}
+        self.key_dtypes = {col: pl.String for col in cat_cols}
+
+    def start(self, state: SeriesState, end: int, interval: str) -> int:
+        # first row of the frame ending at row `end`
+        lower = offset_back(state.origin + end * self.step, interval)
+        return max(0, -((state.origin - lower) // self.step))
+
+    def slide(self, state: SeriesState, end: int):
+        # every frame from ending at row end - 1 to ending at row end
+        for window, interval in zip(state.windows, self.intervals):
+            window.add(end * self.hours, state.value(end), state.center)
+            window.end = end
+
+            start = self.start(state, end, interval)
+            while window.low < start:
+                window.remove(
+                    window.low * self.hours, state.value(window.low), state.center
+                )
+                window.low += 1
+            # month clamping can move the start of the frame back
+            while window.low > start:
+                window.low -= 1
+                window.add(
+                    window.low * self.hours, state.value(window.low), state.center
+                )
+
+    def load(self, df):
+        # start from the history of every series, regular grids sorted or not.
+        # only the last `capacity` rows are kept, the frames are built once
+        df = (
+            df.lazy()
+            .select(self.date_col, *self.cat_cols, self.target_col)
+            .sort(*self.cat_cols, self.date_col)
+            .collect()
+        )
+        self.key_dtypes = {col: df.schema[col] for col in self.cat_cols}
+
+        for part in df.partition_by(self.cat_cols, maintain_order=True):
+            ts = part.get_column(self.date_col)
+            if ts.diff().drop_nulls().ne(self.step).any():
+                raise ValueError(f"series is not a regular grid of {self.step}")
+
+            x = part.get_column(self.target_col).cast(pl.Float64).fill_null(np.nan)
+            x = x.to_numpy()
+            valid = ~np.isnan(x)
+            center = int(np.round(x[valid].mean())) if valid.any() else 0
+            state = SeriesState(ts[0], self.capacity, len(self.intervals), center)
+
+            state.rows = len(x)
+            for position in range(max(0, len(x) - self.capacity), len(x)):
+                state.buffer[position % self.capacity] = float(x[position])
+
+            end = state.rows - self.shift
+            if end >= 0:
+                for window, interval in zip(state.windows, self.intervals):
+                    window.low = self.start(state, end, interval)
+                    window.end = end
+                    for position in range(window.low, end + 1):
+                        window.add(position * self.hours, state.value(position), center)
+
+            key = tuple(part.row(0, named=True)[col] for col in self.cat_cols)
+            self.series[key] = state
+
+        return self
+
+    def update(self, key: tuple, timestamp: datetime, value: float | None):
+        # one observation of a series, O(1) per frame for the moment sums and
+        # O(n) in the values of the frame for the sorted order stats. hours
+        # skipped since the last one are missing values, an hour seen before
+        # is corrected in place
+        value = math.nan if value is None else float(value)
+        if key not in self.series:
+            self.series[key] = SeriesState(
+                timestamp, self.capacity, len(self.intervals)
+            )
+        state = self.series[key]
+
+        position, rest = divmod(timestamp - state.origin, self.step)
+        if rest or position < 0:
+            raise ValueError(f"{timestamp} is not on the grid of {key}")
+        if position < state.rows - self.capacity:
+            raise ValueError(f"{timestamp} is older than the state of {key} keeps")
+
+        if position < state.rows:
+            old = state.value(position)
+            for window in state.windows:
+                if window.low <= position <= window.end:
+                    window.remove(position * self.hours, old, state.center)
+                    window.add(position * self.hours, value, state.center)
+            state.buffer[position % self.capacity] = value
+            return
+
+        while state.rows <= position:
+            observed = value if state.rows == position else math.nan
+            state.buffer[state.rows % self.capacity] = observed
+            state.rows += 1
+            if state.rows - self.shift >= 0:
+                self.slide(state, state.rows - self.shift)
+
+    def features(self, keys: list[tuple] | None = None) -> pl.DataFrame:
+        # one row per series for the hour after its last observation, with the
+        # columns (and dtypes) of data/Xy/. the target is unknown, was_null 0
+        keys = list(self.series) if keys is None else keys
+        states = [self.series[key] for key in keys]
+        columns = {
+            self.date_col: [state.origin + state.rows * self.step for state in states],
+            **{col: [key[i] for key in keys] for i, col in enumerate(self.cat_cols)},
+            self.target_col: [None] * len(states),
+            "was_null": [0] * len(states),
+        }
+
+        # a row sees the frames ending `shift` rows earlier, none before that
+        ready = [state.rows >= self.shift for state in states]
+        k = len(self.intervals)
+        sums = np.array(
+            [window.moments() for state in states for window in state.windows], float
+        ).reshape(len(states), k, 9)
+        moments = finalize_moments(*np.moveaxis(sums, -1, 0))
+
+        for j, interval in enumerate(self.intervals):
+            order = [
+                state.windows[j].order_stats() if ok else [None] * len(ORDER_STATS)
+                for state, ok in zip(states, ready)
+            ]
+            for name in STATS:
+                column = f"{name}_{self.target_col}_{interval_suffix(interval)}"
+                if name in ORDER_STATS:
+                    m = ORDER_STATS.index(name)
+                    columns[column] = [row[m] for row in order]
+                else:
+                    # NaN where DuckDB returns NaN, NULL where it returns NULL
+                    value, defined = moments[name]
+                    columns[column] = [
+                        float(v) if ok and d else None
+                        for v, d, ok in zip(value[:, j], defined[:, j], ready)
+                    ]
+
+        for lag, offset in zip(self.lags, self.offsets):
+            values = [
+                state.value(state.rows - offset) if state.rows >= offset else None
+                for state in states
+            ]
+            columns[f"{self.target_col}_lag_{lag}"] = [
+                None if v is None or v != v else v for v in values
+            ]
+
+        df = pl.DataFrame(columns, strict=False).with_columns(
+            pl.col(self.date_col).cast(pl.Datetime("us")),
+            *[pl.col(col).cast(self.key_dtypes[col]) for col in self.cat_cols],
+            pl.exclude(self.date_col, *self.cat_cols).cast(pl.Float32),
+        )
+
+        # the calendar is only reloaded once the series run past its years
+        days = df.get_column(self.date_col).dt.date()
+        if self.calendar is None or days.max() > self.calendar.get_column("day").max():
+            self.calendar = get_calendar(
+                df, self.date_col, self.calendar_path, self.session
+            )
+
+        return join_date_features(df, self.calendar, self.date_col).collect()
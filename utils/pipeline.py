@@ -0,0 +1,119 @@
+import os
+
+import polars as pl
+from utils.cache import CACHE_MAX_BYTES, cache_file, cached, frame_key, get_key
+from utils.date_features import build_calendar, get_calendar, join_date_features
+from utils.lag_features import get_offsets, lag_features_join, lag_features_shift
+from utils.profiling import profile
+from utils.rolling import get_series, interval_suffix, moment_prefix, rolling_stats
+from utils.session import Session
+from utils.stat_features import add_stat_features
+
+
+def build_features(
+    df,
+    target_col: str,
+    date_col: str,
+    cat_cols: list[str],
+    intervals: list[str],
+    lags: list[int],
+    horizon: int = 30,
+    lag_unit: str = "DAY",
+    quantile_engine: str = "sliding",
+    moment_engine: str = "prefix",
+    n_jobs: int | None = None,
+    session: Session | None = None,
+    cache: str | None = None,
+    cache_max_bytes: int = CACHE_MAX_BYTES,
+) -> pl.LazyFrame:
+    # every stage returns only the columns it adds, row aligned with df sorted
+    # by series then date, so the stages are stacked side by side instead of
+    # joined and each one is cached on its own
+    df = df.lazy().sort(*cat_cols, date_col).collect()
+    series_key = frame_key(df.select(date_col, *cat_cols, target_col))
+
+    def stage(name: str, code: list, params: tuple, compute) -> pl.DataFrame:
+        key = get_key(name, code, series_key, target_col, date_col, cat_cols, *params)
+        hit = cache is not None and os.path.exists(cache_file(name, key, cache))
+        with profile(name, rows_in=len(df), cache_hit=hit) as record:
+            out = cached(name, key, compute, cache, cache_max_bytes)
+            record["rows_out"] = len(out)
+        return out
+
+    # the moment prefix sums and tree of a series are the same for every
+    # interval, the first stat stage that is not cached computes them for all
+    # the others
+    prefixes = []
+
+    def series_prefixes() -> list | None:
+        if moment_engine != "prefix":
+            return None
+        if not prefixes:
+            _, series = get_series(df, target_col, date_col, cat_cols, [])
+            prefixes.extend(moment_prefix(x, ts) for x, ts, _ in series)
+        return prefixes
+
+    def stat_features(interval: str) -> pl.DataFrame:
+        return (
+            add_stat_features(
+                df,
+                target_col,
+                date_col,
+                cat_cols,
+                intervals=[interval],
+                horizon=horizon,
+                quantile_engine=quantile_engine,
+                moment_engine=moment_engine,
+                n_jobs=n_jobs,
+                session=session,
+                prefixes=series_prefixes(),
+            )
+            .sort(*cat_cols, date_col)
+            .drop(df.columns)
+            .collect()
+        )
+
+    def lag_features() -> pl.DataFrame:
+        offsets = get_offsets(df, date_col, cat_cols, lags, lag_unit)
+        if offsets is not None:
+            lagged = lag_features_shift(
+                df, target_col, cat_cols, date_col, lags, offsets
+            )
+        else:
+            lagged = lag_features_join(
+                df, target_col, cat_cols, date_col, lags, lag_unit, session
+            ).sort(*cat_cols, date_col)
+
+        return lagged.drop(df.columns).collect()
+
+    def date_features() -> pl.DataFrame:
+        return (
+            join_date_features(
+                df.select(date_col),
+                get_calendar(df, date_col, session=session),
+                date_col,
+            )
+            .drop(date_col)
+            .collect()
+        )
+
+    # one entry per interval, adding an interval only computes the new one
+    stats = [
+        stage(
+            f"stat_{interval_suffix(interval)}",
+            [add_stat_features, rolling_stats],
+            (interval, horizon, quantile_engine, moment_engine),
+            lambda: stat_features(interval),
+        )
+        for interval in intervals
+    ]
+    # ~160 bytes a row, not kept past the stat stages
+    prefixes.clear()
+    lagged = stage("lag", [lag_features_shift], (lags, lag_unit), lag_features)
+    dates = stage("date", [build_calendar], (), date_features)
+
+    return (
+        pl.concat([df, *stats, lagged, dates], how="horizontal")
+        .lazy()
+        .with_columns(pl.selectors.numeric().cast(pl.Float32))
+    )
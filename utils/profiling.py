@@ -0,0 +1,270 @@
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import duckdb as ddb
+import polars as pl
+
+# the profiler of the running process, the hooks in utils/ do nothing while it
+# is None
+PROFILER = None
+
+
+def read_hwm() -> float | None:
+    # peak resident set since the last reset_hwm in MB, None off linux
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        return None
+
+
+def reset_hwm() -> bool:
+    # writing 5 to clear_refs resets VmHWM to the current rss (linux 4.0+)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def max_rss() -> float:
+    # peak of the whole process in MB, ru_maxrss is in bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def count_rows(df) -> int | None:
+    # a lazy frame is not counted, that would run its plan a second time
+    if df is None or isinstance(df, pl.LazyFrame):
+        return None
+    return len(df)
+
+
+def flatten_plan(plan: dict) -> list[dict]:
+    # the operators of an EXPLAIN ANALYZE tree, slowest first
+    operators = []
+    nodes = list(plan["children"])
+    while nodes:
+        node = nodes.pop()
+        nodes += node["children"]
+        if node["operator_type"] == "EXPLAIN_ANALYZE":
+            continue
+        operators.append(
+            {
+                "operator": node["operator_name"],
+                "type": node["operator_type"],
+                "seconds": node["operator_timing"],
+                "rows": node["operator_cardinality"],
+            }
+        )
+
+    return sorted(operators, key=lambda op: -op["seconds"])
+
+
+class Profiler:
+    # wall time, rows in and out and peak rss of every stage run while it is
+    # active, one JSON line per stage appended to `path` as soon as the stage
+    # ends, so a run that fails keeps the stages it got through. stages nest,
+    # a stage's peak covers its children. with explain=True the SQL sent to
+    # DuckDB is also run under EXPLAIN ANALYZE, a second execution that is
+    # left out of the stage's seconds
+    def __init__(self, path: str | None = None, explain: bool = False, **context):
+        self.path = path
+        self.explain = explain
+        self.context = context
+        self.records = []
+        self.stack = []
+        # without a resettable high-water mark the peaks are the process peak
+        # up to the end of the stage
+        self.per_stage_peak = reset_hwm() and read_hwm() is not None
+
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            open(path, "w").close()
+
+    def write(self, record: dict):
+        record = {**self.context, **record}
+        self.records.append(record)
+        if self.path is not None:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int | None = None, **info):
+        # the caller sets record["rows_out"] (or "rows_in") when it knows them
+        record = {"stage": name, "rows_in": rows_in, "rows_out": None, **info}
+        frame = {"peak": 0.0, "excluded": 0.0}
+        if self.stack:
+            parent = self.stack[-1]
+            record["parent"] = parent[0]["stage"]
+            if self.per_stage_peak:
+                parent[1]["peak"] = max(parent[1]["peak"], read_hwm())
+        if self.per_stage_peak:
+            reset_hwm()
+
+        self.stack.append((record, frame))
+        start_rss = read_hwm() if self.per_stage_peak else max_rss()
+        start = time.perf_counter()
+        record["start"] = datetime.now().isoformat(timespec="microseconds")
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            self.stack.pop()
+            peak = max(frame["peak"], read_hwm() if self.per_stage_peak else max_rss())
+            if self.stack:
+                parent = self.stack[-1][1]
+                parent["peak"] = max(parent["peak"], peak)
+                parent["excluded"] += frame["excluded"]
+
+            self.write(
+                {
+                    **record,
+                    "seconds": seconds - frame["excluded"],
+                    "peak_rss_mb": peak,
+                    "rss_growth_mb": peak - start_rss,
+                }
+            )
+
+    def explain_sql(self, name: str, query: str, con: ddb.DuckDBPyConnection):
+        # con has the tables of the query registered, the plan runs with the
+        # settings (threads, memory limit) of its session
+        if not self.explain:
+            return
+
+        start = time.perf_counter()
+        (_, plan), *_ = con.sql(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}").fetchall()
+        plan = json.loads(plan)
+        operators = flatten_plan(plan)
+        # the root of the query sits under the EXPLAIN_ANALYZE node
+        (root,) = plan["children"][0]["children"]
+
+        record = {"stage": name, "kind": "sql", "seconds": plan["latency"]}
+        if self.stack:
+            record["parent"] = self.stack[-1][0]["stage"]
+            self.stack[-1][1]["excluded"] += time.perf_counter() - start
+        self.write(
+            {
+                **record,
+                "rows_in": sum(
+                    op["rows"] for op in operators if op["type"] == "TABLE_SCAN"
+                ),
+                "rows_out": root["operator_cardinality"],
+                "peak_buffer_mb": plan["system_peak_buffer_memory"] / 2**20,
+                "spilled_mb": plan["system_peak_temp_dir_size"] / 2**20,
+                "operators": operators,
+                "sql": query,
+            }
+        )
+
+
+def start_profiling(path: str | None = None, explain: bool = False, **context):
+    global PROFILER
+    PROFILER = Profiler(path, explain, **context)
+    return PROFILER
+
+
+def stop_profiling() -> list[dict]:
+    global PROFILER
+    records, PROFILER = PROFILER.records if PROFILER else [], None
+    return records
+
+
+@contextmanager
+def profile(name: str, rows_in: int | None = None, **info):
+    # a stage of the active profiler, a throwaway record without one
+    if PROFILER is None:
+        yield {}
+        return
+
+    with PROFILER.stage(name, rows_in, **info) as record:
+        yield record
+
+
+def explain(name: str, query: str, con: ddb.DuckDBPyConnection):
+    # EXPLAIN ANALYZE of a query the caller is about to run on con, if asked for
+    if PROFILER is not None:
+        PROFILER.explain_sql(name, query, con)
+
+
+def load_profile(paths: list[str]) -> list[dict]:
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return records
+
+
+def profile_summary(records: list[dict], by: list[str] = []) -> pl.DataFrame:
+    # one row per stage (and per context key in `by`, e.g. the experiment) in
+    # the order they first started, over every call
+    stages = [record for record in records if record.get("kind") != "sql"]
+    if not stages:
+        return pl.DataFrame()
+
+    return (
+        pl.DataFrame(
+            [
+                {
+                    **{key: record.get(key) for key in by},
+                    "stage": record["stage"],
+                    "parent": record.get("parent"),
+                    "start": record["start"],
+                    "seconds": record["seconds"],
+                    "rows_in": record["rows_in"],
+                    "rows_out": record["rows_out"],
+                    "peak_rss_mb": record["peak_rss_mb"],
+                }
+                for record in stages
+            ],
+            schema_overrides={"rows_in": pl.Int64, "rows_out": pl.Int64},
+        )
+        .group_by(*by, "stage", "parent")
+        .agg(
+            pl.col("start").min(),
+            pl.len().alias("calls"),
+            pl.col("seconds").sum(),
+            # unknown row counts stay null instead of summing to 0
+            *[
+                pl.when(pl.col(col).is_not_null().any()).then(pl.col(col).sum())
+                for col in ["rows_in", "rows_out"]
+            ],
+            pl.col("peak_rss_mb").max(),
+        )
+        .sort(*by, "start")
+        .drop("start")
+    )
+
+
+def sql_summary(records: list[dict], top: int = 3) -> pl.DataFrame:
+    # the slowest operators of every query run under EXPLAIN ANALYZE
+    rows = [
+        {
+            "stage": record["stage"],
+            "parent": record.get("parent"),
+            "query_seconds": record["seconds"],
+            "operator": op["operator"],
+            "seconds": op["seconds"],
+            "rows": op["rows"],
+        }
+        for record in records
+        if record.get("kind") == "sql"
+        for op in record["operators"][:top]
+    ]
+    return pl.DataFrame(rows)
+
+
+def print_profile(records: list[dict], by: list[str] = []):
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, fmt_str_lengths=40):
+        print(profile_summary(records, by))
+        sql = sql_summary(records)
+        if len(sql):
+            print(sql)
@@ -0,0 +1,358 @@
+import math
+import os
+from bisect import bisect_left, insort
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import polars as pl
+
+QUANTILES = {"q25": 0.25, "q50": 0.5, "q75": 0.75}
+ORDER_STATS = ["min", "max", *QUANTILES]
+MOMENT_STATS = ["avg", "std", "skew", "kurt", "geomean", "sum", "abs_energy", "slope"]
+
+DURATION_UNITS = {
+    "hour": "h",
+    "day": "d",
+    "week": "w",
+    "month": "mo",
+    "year": "y",
+}
+
+
+def to_duration(interval: str) -> str:
+    # DuckDB interval string ("3 months") -> polars duration string ("3mo")
+    n, unit = interval.split()
+    return f"{int(n)}{DURATION_UNITS[unit.lower().removesuffix('s')]}"
+
+
+def interval_suffix(interval: str) -> str:
+    return interval.lower().replace(" ", "_")
+
+
+def get_series(
+    df, target_col: str, date_col: str, cat_cols: list[str], intervals: list[str]
+) -> tuple[pl.DataFrame, list[tuple[np.ndarray, np.ndarray, list[np.ndarray]]]]:
+    # (values, timestamps in us, window starts per interval) for every series,
+    # in the row order of the returned keys frame (sorted by series, then date)
+    df = (
+        df.lazy()
+        .select(
+            date_col,
+            *cat_cols,
+            pl.col(target_col).cast(pl.Float64),
+            # RANGE BETWEEN INTERVAL x PRECEDING AND CURRENT ROW, calendar aware
+            *[
+                pl.col(date_col)
+                .dt.offset_by(f"-{to_duration(interval)}")
+                .alias(f"__lower_{i}")
+                for i, interval in enumerate(intervals)
+            ],
+        )
+        .sort(*cat_cols, date_col)
+        .collect()
+    )
+
+    series = []
+    for part in df.partition_by(cat_cols, maintain_order=True):
+        ts = part.get_column(date_col).dt.cast_time_unit("us").to_physical().to_numpy()
+        starts = [
+            np.searchsorted(
+                ts,
+                part.get_column(f"__lower_{i}")
+                .dt.cast_time_unit("us")
+                .to_physical()
+                .to_numpy(),
+                "left",
+            )
+            for i in range(len(intervals))
+        ]
+        series.append(
+            (part.get_column(target_col).fill_null(np.nan).to_numpy(), ts, starts)
+        )
+
+    return df.select(date_col, *cat_cols), series
+
+
+def order_stats(
+    x: np.ndarray, starts: list[np.ndarray], quantiles: list[float]
+) -> np.ndarray:
+    # min, max and QUANTILE_DISC for every window ending at every row, each
+    # window is kept sorted and updated as it slides instead of re-sorted
+    k = len(starts)
+    out = np.full((len(x), k, 2 + len(quantiles)), np.nan)
+    windows = [[] for _ in range(k)]
+    lows = [0] * k
+
+    # plain lists are much cheaper to index element by element than arrays
+    x = x.tolist()
+    starts = [start.tolist() for start in starts]
+
+    for i, v in enumerate(x):
+        for j in range(k):
+            window = windows[j]
+            if v == v:
+                insort(window, v)
+
+            start = starts[j][i]
+            while lows[j] < start:
+                u = x[lows[j]]
+                if u == u:
+                    del window[bisect_left(window, u)]
+                lows[j] += 1
+            # month arithmetic clamps to the month end, so the start of the
+            # frame can move back (2023-03-29 - 1 month = 2023-02-28)
+            while lows[j] > start:
+                lows[j] -= 1
+                u = x[lows[j]]
+                if u == u:
+                    insort(window, u)
+
+            n = len(window)
+            if n:
+                row = out[i, j]
+                row[0] = window[0]
+                row[1] = window[-1]
+                for m, q in enumerate(quantiles):
+                    # same index DuckDB's discrete quantile picks
+                    row[2 + m] = window[max(math.ceil(n * q), 1) - 1]
+
+    return out
+
+
+def order_stats_chunk(chunk, quantiles):
+    return [order_stats(x, starts, quantiles) for x, _, starts in chunk]
+
+
+def finalize_moments(n, s1, s2, ln1p, m2, m3, m4, ctt, ctx) -> dict:
+    # MOMENT_STATS -> (value, defined) from the window sums of 1, x, x^2 and
+    # log1p(x), the sums of the 2nd to 4th powers of the deviations from the
+    # window mean and the co-moments of t (in hours) with itself and x, the
+    # same finalizers (and NULL / NaN cases) as DuckDB's aggregates
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv = 1 / n
+
+        # a spread lost in rounding is no spread, DuckDB sees those windows
+        # as constant
+        flat = m2 <= 16 * np.finfo(np.float64).eps * s2
+        m2 = np.where(flat, 0.0, m2)
+        m3 = np.where(flat, 0.0, m3)
+
+        var = m2 / (n - 1)
+        m2, m3, m4 = m2 * inv, m3 * inv, m4 * inv
+
+        return {
+            "avg": (s1 * inv, n > 0),
+            "std": (np.sqrt(np.maximum(var, 0)), n > 1),
+            "skew": (np.sqrt(n * (n - 1)) / (n - 2) * m3 / np.sqrt(m2**3), n > 2),
+            "kurt": (
+                (n - 1)
+                * ((n + 1) * m4 / (m2 * m2) - 3 * (n - 1))
+                / ((n - 2) * (n - 3)),
+                (n > 3) & (m2 > 0),
+            ),
+            "geomean": (np.exp(ln1p * inv) - 1, n > 0),
+            "sum": (s1, n > 0),
+            "abs_energy": (s2, n > 0),
+            "slope": (np.where(n > 1, ctx / ctt, np.nan) / 3600, n > 0),
+        }
+
+
+def merge_moments(a: list[np.ndarray], b: list[np.ndarray]) -> list[np.ndarray]:
+    # (n, mean x, M2, M3, M4, mean t, Ctt, Ctx) of the union of two disjoint
+    # sets of rows from those of each, the pairwise updates of Chan et al. and
+    # Pebay. every term is a deviation from a mean, so nothing large cancels
+    na, xa, a2, a3, a4, ta, att, atx = a
+    nb, xb, b2, b3, b4, tb, btt, btx = b
+    n = na + nb
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv = 1 / n
+        dx, dt = xb - xa, tb - ta
+        w = na * nb * inv
+        out = [
+            n,
+            xa + dx * nb * inv,
+            a2 + b2 + dx * dx * w,
+            a3 + b3 + dx**3 * w * (na - nb) * inv + 3 * dx * (na * b2 - nb * a2) * inv,
+            a4
+            + b4
+            + dx**4 * w * (na * na - na * nb + nb * nb) * inv * inv
+            + 6 * dx * dx * (na * na * b2 + nb * nb * a2) * inv * inv
+            + 4 * dx * (na * b3 - nb * a3) * inv,
+            ta + dt * nb * inv,
+            att + btt + dt * dt * w,
+            atx + btx + dt * dx * w,
+        ]
+
+    # an empty side (rows that are all missing) leaves the other one as is
+    return [
+        np.where(na == 0, vb, np.where(nb == 0, va, v)) for v, va, vb in zip(out, a, b)
+    ]
+
+
+def moment_prefix(x: np.ndarray, ts: np.ndarray) -> tuple:
+    # what every moment feature of one series is computed from, whatever the
+    # window: prefix sums of 1, x, x^2 and log1p(x) (a window sum is the
+    # difference of two, exact for counts) and a tree of the central moments
+    # of every aligned block of 2^l rows. they do not depend on the window, so
+    # one set serves every interval
+    valid = ~np.isnan(x)
+    x = np.where(valid, x, 0.0)
+
+    prefix = np.zeros((4, len(x) + 1))
+    np.cumsum([valid, x, x * x, np.log1p(x)], axis=1, out=prefix[:, 1:])
+
+    # REGR_SLOPE(x, EPOCH(ts)) is per second, hours since the series start
+    # keep the time sums small, the slope is rescaled at the end
+    t = (ts - ts[0]) / 3.6e9
+    zero = np.zeros(len(x))
+    tree = [[valid.astype(np.float64), x, zero, zero, zero, t, zero, zero]]
+    while len(tree[-1][0]) > 1:
+        pairs = len(tree[-1][0]) // 2 * 2
+        tree.append(
+            merge_moments(
+                [v[0:pairs:2] for v in tree[-1]], [v[1:pairs:2] for v in tree[-1]]
+            )
+        )
+
+    return prefix, tree
+
+
+def window_moments(tree: list, start: np.ndarray, end: np.ndarray) -> list:
+    # the central moments of rows [start, end) from the aligned blocks that
+    # tile it, at most two per level: up the levels from start while start is
+    # not aligned, then down the levels to end. O(log n) merges per window
+    acc = [np.zeros(len(start)) for _ in range(8)]
+    lo = start.copy()
+    rising = np.ones(len(start), bool)
+
+    def take(level: int, rows: np.ndarray):
+        blocks = lo[rows] >> level
+        merged = merge_moments([v[rows] for v in acc], [v[blocks] for v in tree[level]])
+        for v, m in zip(acc, merged):
+            v[rows] = m
+        lo[rows] += 1 << level
+
+    for level in range(len(tree)):
+        odd = (lo >> level) & 1 == 1
+        fits = lo + (1 << level) <= end
+        take(level, np.flatnonzero(rising & odd & fits))
+        rising &= ~odd | fits
+    for level in reversed(range(len(tree))):
+        take(level, np.flatnonzero(lo + (1 << level) <= end))
+
+    return acc
+
+
+def moment_stats(
+    x: np.ndarray,
+    ts: np.ndarray,
+    starts: list[np.ndarray],
+    prefix: tuple | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    # every moment based feature of every window. the plain sums are
+    # differences of prefix sums, the higher moments are merged from the
+    # tree, so each window is centered on its own mean and a constant window
+    # has exactly no spread
+    prefix, tree = prefix or moment_prefix(x, ts)
+
+    k = len(starts)
+    end = np.tile(np.arange(1, len(x) + 1), k)
+    start = np.concatenate(starts) if k else end[:0]
+    _, _, m2, m3, m4, _, ctt, ctx = window_moments(tree, start, end)
+    sums = prefix[:, end] - prefix[:, start]
+
+    features = finalize_moments(*sums, m2, m3, m4, ctt, ctx)
+    values = np.stack([value for value, _ in features.values()], -1)
+    nulls = ~np.stack([defined for _, defined in features.values()], -1)
+
+    # (k * rows, stats) -> (rows, k, stats)
+    shape = (k, len(x), len(MOMENT_STATS))
+    return (
+        values.reshape(shape).transpose(1, 0, 2),
+        nulls.reshape(shape).transpose(1, 0, 2),
+    )
+
+
+def shift_rows(out: np.ndarray, shift: int, fill) -> np.ndarray:
+    # out moved down by `shift` rows, the rows shifted in are `fill`
+    head = np.full((min(shift, len(out)), *out.shape[1:]), fill, out.dtype)
+    return np.concatenate([head, out[: len(out) - len(head)]])
+
+
+def map_series(fn, series: list, n_jobs: int | None, *args):
+    # yields one result per series, in order, as the chunks finish
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs == 1 or len(series) < 2:
+        for one in series:
+            yield from fn([one], *args)
+        return
+
+    # a few chunks per worker keeps the pool busy when series differ in length
+    size = max(1, math.ceil(len(series) / (n_jobs * 4)))
+    chunks = [series[i : i + size] for i in range(0, len(series), size)]
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        for chunk in pool.map(fn, chunks, *[[arg] * len(chunks) for arg in args]):
+            yield from chunk
+
+
+def rolling_stats(
+    df,
+    target_col: str,
+    date_col: str,
+    cat_cols: list[str],
+    intervals: list[str],
+    stats: list[str],
+    shift: int = 0,
+    n_jobs: int | None = None,
+    prefixes: list[tuple] | None = None,
+) -> pl.DataFrame:
+    # the requested stats for every interval, keyed by (date_col, *cat_cols),
+    # a row holds the stats of the window ending `shift` rows earlier.
+    # prefixes are the moment_prefix of every series of df in key order,
+    # computed here when not passed
+    keys, series = get_series(df, target_col, date_col, cat_cols, intervals)
+    bounds = np.cumsum([0] + [len(x) for x, _, _ in series])
+    shape = (len(keys), len(intervals))
+
+    # results are written straight into float32 outputs, one series at a time,
+    # instead of concatenating float64 copies of every series
+    columns = []
+    if any(stat in ORDER_STATS for stat in stats):
+        values = np.empty((*shape, len(ORDER_STATS)), np.float32)
+        results = map_series(
+            order_stats_chunk, series, n_jobs, list(QUANTILES.values())
+        )
+        for lo, hi, out in zip(bounds[:-1], bounds[1:], results):
+            values[lo:hi] = shift_rows(out, shift, np.nan)
+
+        columns += [
+            pl.Series(
+                f"{name}_{target_col}_{interval_suffix(interval)}", values[:, j, m]
+            ).fill_nan(None)
+            for j, interval in enumerate(intervals)
+            for m, name in enumerate(ORDER_STATS)
+            if name in stats
+        ]
+
+    if any(stat in MOMENT_STATS for stat in stats):
+        values = np.empty((*shape, len(MOMENT_STATS)), np.float32)
+        nulls = np.empty(values.shape, bool)
+        # vectorized within a series already, not worth a process pool
+        prefixes = prefixes or [None] * len(series)
+        for lo, hi, (x, ts, starts), prefix in zip(
+            bounds[:-1], bounds[1:], series, prefixes
+        ):
+            out, null = moment_stats(x, ts, starts, prefix)
+            values[lo:hi] = shift_rows(out, shift, np.nan)
+            nulls[lo:hi] = shift_rows(null, shift, True)
+
+        columns += [
+            pl.Series(
+                f"{name}_{target_col}_{interval_suffix(interval)}", values[:, j, m]
+            ).scatter(np.flatnonzero(nulls[:, j, m]), None)
+            for j, interval in enumerate(intervals)
+            for m, name in enumerate(MOMENT_STATS)
+            if name in stats
+        ]
+
+    return keys.with_columns(columns)
@@ -0,0 +1,143 @@
+import math
+import os
+
+import polars as pl
+
+ROLLUP_PATH = "data/rollups"
+
+LEVELS = {
+    "station": ["line_name", "station"],
+    "line": ["line_name"],
+    "network": ["network"],
+}
+GRAINS = ["1h", "1d", "1w"]
+
+
+def rollup_file(level: str, grain: str, path: str = ROLLUP_PATH) -> str:
+    return os.path.join(path, f"{level}_{grain}.parquet")
+
+
+def aggregate(
+    df: pl.LazyFrame, target_col: str, date_col: str, cat_cols: list[str], grain: str
+) -> pl.LazyFrame:
+    # the sum of the observed hours under a bucket, with observed and expected
+    # counting its station hours that have a value and all of them. coarser
+    # buckets are summed from these, covered() decides what the target is
+    return (
+        df.group_by(*cat_cols, pl.col(date_col).dt.truncate(grain))
+        .agg(pl.col(target_col, "observed", "expected").sum())
+        .sort(date_col, *cat_cols)
+    )
+
+
+def covered(df: pl.LazyFrame, target_col: str, min_coverage: float) -> pl.LazyFrame:
+    # a bucket missing some of its hours is not its total. it is null, or
+    # scaled up to all its hours when it still covers min_coverage of them,
+    # and was_null marks both
+    observed, expected = pl.col("observed"), pl.col("expected")
+    return df.with_columns(
+        pl.when((expected > 0) & (observed >= min_coverage * expected))
+        .then(pl.col(target_col) * expected / observed)
+        .cast(df.collect_schema()[target_col])
+        .alias(target_col),
+        (observed < expected).cast(pl.Int8).alias("was_null"),
+    )
+
+
+def full_buckets(
+    df: pl.LazyFrame, spans: pl.LazyFrame, date_col: str, cat_cols: list[str], grain
+) -> pl.LazyFrame:
+    # only the buckets that lie inside the span of their series, the first or
+    # last week of a series is otherwise a few days summed as a whole week
+    return (
+        df.join(spans, on=cat_cols, maintain_order="left")
+        .filter(
+            pl.col(date_col) >= pl.col("first"),
+            pl.col(date_col).dt.offset_by(grain) <= pl.col("last"),
+        )
+        .drop("first", "last")
+    )
+
+
+def build_rollups(
+    df: pl.LazyFrame,
+    target_col: str,
+    date_col: str,
+    min_coverage: float = 1.0,
+    path: str = ROLLUP_PATH,
+) -> dict[tuple[str, str], str]:
+    # df is the dense hourly station series, it is read once and every coarser
+    # table is derived from the next finer one. an hour of the day a station
+    # is never observed at is closed, not missing, and is not expected
+    observed = pl.col(target_col).is_not_null()
+    open_hours = [*LEVELS["station"], pl.col(date_col).dt.hour()]
+    hourly = (
+        df.lazy()
+        .select(date_col, *LEVELS["station"], target_col)
+        .with_columns(
+            observed.cast(pl.UInt32).alias("observed"),
+            observed.any().over(open_hours).cast(pl.UInt32).alias("expected"),
+            pl.lit("IBB").cast(pl.Enum(["IBB"])).alias("network"),
+        )
+        .collect()
+    )
+
+    station = {
+        "1h": aggregate(hourly.lazy(), target_col, date_col, LEVELS["station"], "1h")
+    }
+    station["1d"] = aggregate(
+        station["1h"], target_col, date_col, LEVELS["station"], "1d"
+    )
+    station["1w"] = aggregate(
+        station["1d"], target_col, date_col, LEVELS["station"], "1w"
+    )
+
+    tables = {}
+    for level, cat_cols in LEVELS.items():
+        # a line or network bucket sums its stations before the edges are
+        # cut, a station that opens mid week still counts for that week
+        spans = (
+            hourly.lazy()
+            .group_by(cat_cols)
+            .agg(
+                pl.col(date_col).min().alias("first"),
+                pl.col(date_col).max().dt.offset_by("1h").alias("last"),
+            )
+        )
+        for grain in GRAINS:
+            table = station[grain]
+            if level != "station":
+                table = aggregate(
+                    table.with_columns(
+                        pl.lit("IBB").cast(pl.Enum(["IBB"])).alias("network")
+                    ),
+                    target_col,
+                    date_col,
+                    cat_cols,
+                    grain,
+                )
+            table = full_buckets(table, spans, date_col, cat_cols, grain)
+            tables[level, grain] = covered(table, target_col, min_coverage)
+
+    # one plan for all tables, so shared subplans are only computed once
+    frames = pl.collect_all(list(tables.values()))
+
+    os.makedirs(path, exist_ok=True)
+    files = {}
+    for (level, grain), frame in zip(tables, frames):
+        files[level, grain] = rollup_file(level, grain, path)
+        frame.write_parquet(files[level, grain])
+
+    return files
+
+
+def load_rollup(level: str, grain: str, path: str = ROLLUP_PATH) -> pl.LazyFrame:
+    return pl.scan_parquet(rollup_file(level, grain, path))
+
+
+def align_days(days: int, grain: str) -> int:
+    # day offsets must land on the grain, weekly buckets start on mondays
+    if grain == "1w":
+        return math.ceil(days / 7) * 7
+
+    return days
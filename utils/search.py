@@ -0,0 +1,232 @@
+import hashlib
+import json
+import math
+import os
+import time
+from concurrent.futures import as_completed
+from functools import lru_cache
+
+import numpy as np
+import polars as pl
+from sklearn.metrics import (
+    mean_absolute_error,
+    mean_absolute_percentage_error,
+    median_absolute_error,
+    root_mean_squared_error,
+)
+from utils.matrix import slice_matrix, to_dmatrix
+from utils.training import get_folds, predict_xgb, time_rows, train_xgb
+
+# name -> (kind, low, high), int and uniform are inclusive, log is uniform in
+# log space
+SPACE = {
+    "max_depth": ("int", 3, 10),
+    "learning_rate": ("log", 0.005, 0.2),
+    "subsample": ("uniform", 0.5, 1.0),
+    "colsample_bytree": ("uniform", 0.4, 1.0),
+    "min_child_weight": ("log", 1, 100),
+    "gamma": ("uniform", 0, 10),
+}
+
+METRICS = {
+    "rmse": root_mean_squared_error,
+    "medae": median_absolute_error,
+    "mae": mean_absolute_error,
+    "mape": mean_absolute_percentage_error,
+}
+
+LOG_SCHEMA = {
+    "trial": pl.String,
+    "rung": pl.Int64,
+    "folds": pl.Int64,
+    "n_estimators": pl.Int64,
+    "metric": pl.String,
+    "score": pl.Float64,
+    "seconds": pl.Float64,
+    "params": pl.String,
+}
+
+
+def sample_params(base: dict, n: int, space: dict = SPACE, seed: int = 42) -> list:
+    # the hand tuned base config is always the first candidate, the same seed
+    # draws the same candidates so a search can be resumed
+    rng = np.random.default_rng(seed)
+    candidates = [base]
+    for _ in range(n - 1):
+        params = dict(base)
+        for name, (kind, low, high) in space.items():
+            if kind == "int":
+                params[name] = int(rng.integers(low, high + 1))
+            elif kind == "log":
+                params[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+            else:
+                params[name] = float(rng.uniform(low, high))
+        candidates.append(params)
+
+    return candidates
+
+
+def trial_key(params: dict) -> str:
+    # the budget is set per rung, it is not part of the trial
+    params = {k: v for k, v in params.items() if k != "n_estimators"}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def halving_schedule(
+    n_folds: int, min_rounds: int, max_rounds: int, eta: int = 3
+) -> list[tuple[int, int]]:
+    # (folds, rounds) per rung, both grow by eta until the last rung runs
+    # every fold with max_rounds trees
+    rungs = int(math.log(max_rounds / min_rounds, eta) + 1e-9)
+    return [
+        (
+            max(1, math.ceil(n_folds / eta ** (rungs - rung))),
+            max(1, round(max_rounds / eta ** (rungs - rung))),
+        )
+        for rung in range(rungs + 1)
+    ]
+
+
+def load_log(path: str) -> pl.DataFrame:
+    if os.path.exists(path):
+        return pl.read_parquet(path)
+    return pl.DataFrame(schema=LOG_SCHEMA)
+
+
+def write_log(log: pl.DataFrame, path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    log.write_parquet(f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+_worker = {}
+
+
+def init_worker(
+    load,
+    load_args,
+    target_col,
+    date_col,
+    splits,
+    log1p: bool = True,
+    backend: str = "auto",
+    nthread: int | None = None,
+    cores=None,
+    grain: str = "1h",
+):
+    # every worker loads the table and builds its feature matrix once, the
+    # trials it runs reuse them
+    if cores is not None:
+        os.sched_setaffinity(0, cores.get())
+
+    df, cat_col = load(*load_args)
+    df, index, matrix = get_folds(df, target_col, date_col, cat_col, log1p, grain)
+    _worker.update(
+        y=df.get_column(target_col).to_numpy(),
+        index=index,
+        matrix=matrix,
+        splits=splits,
+        log1p=log1p,
+        backend=backend,
+        nthread=nthread,
+    )
+
+
+@lru_cache(maxsize=None)
+def fold_dmatrix(fold: int, max_bin: int | None):
+    split = _worker["splits"][fold]
+    train_rows = time_rows(_worker["index"], None, split.start)
+    return to_dmatrix(
+        slice_matrix(_worker["matrix"], *train_rows),
+        max_bin=max_bin,
+        nthread=_worker["nthread"],
+    )
+
+
+def evaluate(params: dict, folds: int, rounds: int, metric: str = "mae") -> dict:
+    # the mean of the metric over the first `folds` folds, `rounds` trees each
+    options = {"backend": _worker["backend"], "nthread": _worker["nthread"]}
+    start = time.perf_counter()
+    scores = []
+    for fold in range(folds):
+        split = _worker["splits"][fold]
+        xgb = train_xgb(
+            fold_dmatrix(fold, params.get("max_bin")),
+            {**params, "n_estimators": rounds},
+            **options,
+        )
+
+        offset, length = time_rows(_worker["index"], split.start, split.end)
+        test = slice_matrix(_worker["matrix"], offset, length)
+        y_pred = predict_xgb(test.X, xgb, _worker["log1p"], **options)
+        scores.append(METRICS[metric](_worker["y"][offset : offset + length], y_pred))
+
+    return {"score": float(np.mean(scores)), "seconds": time.perf_counter() - start}
+
+
+def successive_halving(
+    pool,
+    candidates: list[dict],
+    schedule: list[tuple[int, int]],
+    log_path: str,
+    metric: str = "mae",
+    eta: int = 3,
+) -> pl.DataFrame:
+    # every rung evaluates the surviving candidates in parallel on the pool
+    # (started with init_worker) and keeps the best 1/eta of them. finished
+    # trials are appended to the log as they complete, a rerun with the same
+    # log skips them
+    log = load_log(log_path)
+    done = {
+        (row["trial"], row["folds"], row["n_estimators"], row["metric"]): row["score"]
+        for row in log.iter_rows(named=True)
+    }
+
+    trials = {trial_key(params): params for params in candidates}
+    alive = list(trials)
+    for rung, (folds, rounds) in enumerate(schedule):
+        scores = {
+            trial: done[(trial, folds, rounds, metric)]
+            for trial in alive
+            if (trial, folds, rounds, metric) in done
+        }
+        futures = {
+            pool.submit(evaluate, trials[trial], folds, rounds, metric): trial
+            for trial in alive
+            if trial not in scores
+        }
+        for future in as_completed(futures):
+            trial = futures[future]
+            result = future.result()
+            scores[trial] = result["score"]
+            row = {
+                "trial": trial,
+                "rung": rung,
+                "folds": folds,
+                "n_estimators": rounds,
+                "metric": metric,
+                **result,
+                "params": json.dumps(trials[trial], sort_keys=True),
+            }
+            log = pl.concat([log, pl.DataFrame([row], schema=LOG_SCHEMA)])
+            write_log(log, log_path)
+
+        alive = sorted(alive, key=scores.get)
+        print(
+            f"rung {rung}: {len(alive)} trials, {folds} folds, {rounds} trees, "
+            f"best {metric} {scores[alive[0]]:.4f} ({alive[0]})"
+        )
+        if rung < len(schedule) - 1:
+            alive = alive[: max(1, len(alive) // eta)]
+
+    # the last rung of this search, best first
+    return (
+        log.filter(
+            pl.col("trial").is_in(alive),
+            pl.col("folds") == schedule[-1][0],
+            pl.col("n_estimators") == schedule[-1][1],
+            pl.col("metric") == metric,
+        )
+        .unique("trial", keep="last")
+        .sort("score")
+    )
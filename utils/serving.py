@@ -0,0 +1,409 @@
+import http.client
+import json
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import numpy as np
+import polars as pl
+from utils.incremental import get_lookback
+from utils.matrix import get_features
+from utils.pipeline import build_features
+from utils.stations import line_station_table, load_registry
+from utils.training import backend_params, predict_xgb
+
+key_cols = ["line_name", "station"]
+REQUEST_FIELDS = ["line", "station", "start", "end"]
+
+# days ahead process-data.py builds the features for, every stat window and
+# lag of an hour ends at least this long before it
+HORIZON = 30
+
+
+def feature_spec(columns: list[str], target_col) -> tuple[list[str], list[int]]:
+    # the intervals and lags data/Xy/ was built with, read off its columns
+    intervals = [
+        col.removeprefix(f"avg_{target_col}_").replace("_", " ")
+        for col in columns
+        if col.startswith(f"avg_{target_col}_")
+    ]
+    lags = [
+        int(col.removeprefix(f"{target_col}_lag_"))
+        for col in columns
+        if col.startswith(f"{target_col}_lag_")
+    ]
+    return intervals, lags
+
+
+def future_features(
+    history: pl.DataFrame,
+    target_col,
+    date_col,
+    horizon: int = HORIZON,
+    step: timedelta = timedelta(hours=1),
+) -> pl.DataFrame:
+    # the feature rows of every hour up to `horizon` days after the last hour
+    # of each series. their windows and lags end at or before that hour, so
+    # they are the rows build_features writes once the hours exist: the tail
+    # of the history they reach back to is rebuilt with an unknown target
+    intervals, lags = feature_spec(history.columns, target_col)
+    lookback = get_lookback(intervals, lags, horizon)
+    ends = history.group_by(key_cols).agg(pl.col(date_col).max().alias("__end"))
+
+    tail = (
+        history.select(date_col, *key_cols, target_col, "was_null")
+        .join(ends, on=key_cols)
+        .filter(pl.col(date_col) >= pl.col("__end") - lookback)
+    )
+    future = (
+        ends.select(
+            *key_cols,
+            "__end",
+            pl.datetime_ranges(
+                pl.col("__end") + step, pl.col("__end") + timedelta(days=horizon), step
+            ).alias(date_col),
+        )
+        .explode(date_col)
+        .with_columns(
+            pl.lit(None).cast(tail.schema[target_col]).alias(target_col),
+            # not a missing observation, the model was fit on was_null 0
+            pl.lit(0).cast(tail.schema["was_null"]).alias("was_null"),
+        )
+        .select(tail.columns)
+    )
+
+    return (
+        build_features(
+            pl.concat([tail, future]), target_col, date_col, key_cols, intervals, lags
+        )
+        .filter(pl.col(date_col) > pl.col("__end"))
+        .select(pl.col(col).cast(dtype) for col, dtype in history.schema.items())
+        .collect()
+    )
+
+
+def load_features(
+    models: dict,
+    path: str = "data/Xy/*.parquet",
+    since: datetime | None = None,
+    horizon: int = HORIZON,
+) -> pl.DataFrame:
+    # the feature rows of every line a model serves, sorted by series and
+    # time, with the `horizon` days after the last hour of every series. the
+    # model over all lines keys its series by line_station
+    _, meta = next(iter(models.values()))
+    date_col, target_col = meta["date_col"], meta["target_col"]
+    lines = [meta["line"] for _, meta in models.values()]
+    scan = pl.scan_parquet(path)
+    if None not in lines:
+        scan = scan.filter(pl.col("line_name").is_in(lines))
+
+    if since is not None:
+        # the future rows reach back past `since` from the earliest series end
+        first_end = (
+            scan.group_by(key_cols)
+            .agg(pl.col(date_col).max())
+            .select(pl.col(date_col).min())
+            .collect()
+            .item()
+        )
+        spec = feature_spec(scan.collect_schema().names(), target_col)
+        lookback = get_lookback(*spec, horizon)
+        scan = scan.filter(pl.col(date_col) >= min(since, first_end - lookback))
+
+    df = scan.sort(*key_cols, date_col).collect()
+    if horizon > 0:
+        future = future_features(df, target_col, date_col, horizon)
+        df = pl.concat([df, future]).sort(*key_cols, date_col)
+    if since is not None:
+        df = df.filter(pl.col(date_col) >= since)
+
+    if any(meta["cat_col"] == "line_station" for _, meta in models.values()):
+        df = df.join(
+            line_station_table(load_registry(), df.schema),
+            on=key_cols,
+            how="left",
+            maintain_order="left",
+        )
+
+    return df
+
+
+class Forecaster:
+    # the boosters and the feature rows they score stay in memory, a request
+    # is a slice of one series per (line, station, range)
+    def __init__(
+        self,
+        models: dict,
+        features: pl.DataFrame,
+        backend: str = "auto",
+        nthread: int | None = None,
+        window: int = 10_000,
+    ):
+        self.models = models
+        self.features = features
+        self.date_col = next(iter(models.values()))[1]["date_col"]
+        self.index = features.get_column(self.date_col).to_numpy()
+        self.series = {
+            (line, station): (offset, length)
+            for line, station, offset, length in features.with_row_index()
+            .group_by(key_cols, maintain_order=True)
+            .agg(pl.col("index").first(), pl.len())
+            .iter_rows()
+        }
+        # line -> model name, the model over all lines serves the rest
+        self.routes = {meta["line"]: name for name, (_, meta) in models.items()}
+        self.dtypes = {
+            name: pl.Enum(meta["categories"]) for name, (_, meta) in models.items()
+        }
+        for xgb, _ in models.values():
+            xgb.set_param(backend_params(backend, nthread))
+
+        self.latencies = deque(maxlen=window)
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def model_for(self, line: str) -> str:
+        if line in self.routes:
+            return self.routes[line]
+        if None in self.routes:
+            return self.routes[None]
+        raise KeyError(f"no model serves line {line}")
+
+    def rows_for(self, line: str, station: str, start, end) -> pl.DataFrame:
+        # start <= date_col <= end of one series, inside the rows it has: the
+        # history that was loaded and the horizon after its last hour
+        if (line, station) not in self.series:
+            raise KeyError(f"unknown series {line} {station}")
+
+        offset, length = self.series[(line, station)]
+        index = self.index[offset : offset + length]
+        start = np.datetime64(datetime.fromisoformat(start))
+        end = np.datetime64(datetime.fromisoformat(end))
+        if start > end or start < index[0] or end > index[-1]:
+            first, last = (str(t.astype("datetime64[s]")) for t in index[[0, -1]])
+            raise ValueError(
+                f"{line} {station} is served from {first} to {last}, "
+                f"got {start.astype('datetime64[s]')} .. {end.astype('datetime64[s]')}"
+            )
+
+        lo = np.searchsorted(index, start)
+        hi = np.searchsorted(index, end, side="right")
+        return self.features.slice(offset + lo, hi - lo)
+
+    def forecast(self, requests: list[dict]) -> pl.DataFrame:
+        started = time.perf_counter()
+        batches = {}
+        for request in requests:
+            name = self.model_for(request["line"])
+            batches.setdefault(name, []).append(
+                self.rows_for(
+                    request["line"],
+                    request["station"],
+                    request["start"],
+                    request["end"],
+                )
+            )
+
+        forecasts = []
+        for name, frames in batches.items():
+            xgb, meta = self.models[name]
+            Xy = pl.concat(frames)
+            X = get_features(Xy, meta["features"], meta["cat_col"], self.dtypes[name])
+            forecasts.append(
+                Xy.select(*key_cols, self.date_col).with_columns(
+                    forecast=pl.Series(predict_xgb(X, xgb, meta["log1p"], None)),
+                    model=pl.lit(name),
+                )
+            )
+
+        if not forecasts:
+            forecasts = [
+                self.features.select(*key_cols, self.date_col)
+                .clear()
+                .with_columns(
+                    forecast=pl.lit(None, pl.Float32), model=pl.lit(None, pl.String)
+                )
+            ]
+
+        result = pl.concat(forecasts)
+        with self.lock:
+            self.latencies.append(time.perf_counter() - started)
+            self.rows += len(result)
+        return result
+
+    def metrics(self) -> dict:
+        # latency of the last `window` batches
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+        return {
+            "batches": len(latencies),
+            "rows": self.rows,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+
+def parse_requests(body: bytes | None) -> list[dict]:
+    # the (line, station, range) requests of a POST /forecast body, a
+    # malformed one is a ValueError, not a missing series
+    payload = json.loads(body or b"null")
+    if not isinstance(payload, dict) or not isinstance(payload.get("requests"), list):
+        raise ValueError('body must be {"requests": [...]}')
+
+    for i, request in enumerate(payload["requests"]):
+        if not isinstance(request, dict):
+            raise ValueError(f"request {i} is not an object")
+        missing = [field for field in REQUEST_FIELDS if field not in request]
+        if missing:
+            raise ValueError(f"request {i} is missing {', '.join(missing)}")
+        for field in REQUEST_FIELDS:
+            if not isinstance(request[field], str):
+                raise ValueError(f"request {i}: {field} must be a string")
+
+    return payload["requests"]
+
+
+def handle(forecaster: Forecaster, method: str, path: str, body: bytes | None):
+    # (status, payload) of one request, shared by the http handler and
+    # LocalClient
+    if method == "GET" and path == "/health":
+        return 200, {
+            "models": list(forecaster.models),
+            "series": len(forecaster.series),
+        }
+    if method == "GET" and path == "/metrics":
+        return 200, forecaster.metrics()
+    if method != "POST" or path != "/forecast":
+        return 404, {"error": f"no route {method} {path}"}
+
+    try:
+        requests = parse_requests(body)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+
+    # only an unknown series or a line no model serves is a KeyError here
+    try:
+        forecasts = forecaster.forecast(requests)
+    except KeyError as e:
+        return 404, {"error": e.args[0]}
+    except ValueError as e:
+        return 400, {"error": str(e)}
+
+    forecasts = forecasts.with_columns(
+        pl.col(forecaster.date_col).dt.to_string("%Y-%m-%dT%H:%M:%S")
+    )
+    return 200, {"forecasts": forecasts.to_dicts()}
+
+
+def make_handler(forecaster: Forecaster):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def respond(self, method: str, body: bytes | None = None):
+            status, payload = handle(forecaster, method, self.path, body)
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.respond("GET")
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            self.respond("POST", self.rfile.read(length))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(
+    forecaster: Forecaster,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    socket_path: str | None = None,
+):
+    # an http server on host:port, or on a unix socket with socket_path
+    handler = make_handler(forecaster)
+    if socket_path is not None:
+        return UnixHTTPServer(socket_path, handler)
+
+    # headers and body go out as separate writes, without nodelay the body
+    # waits for the client's delayed ack
+    handler.disable_nagle_algorithm = True
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class ServiceError(RuntimeError):
+    def __init__(self, status: int, error: str):
+        super().__init__(f"{status}: {error}")
+        self.status = status
+
+
+class LocalClient:
+    # the service without a socket, payloads take the same json round trip
+    def __init__(self, forecaster: Forecaster):
+        self.forecaster = forecaster
+
+    def request(self, method: str, path: str, payload: dict | None = None) -> dict:
+        body = None if payload is None else json.dumps(payload).encode()
+        status, response = handle(self.forecaster, method, path, body)
+        response = json.loads(json.dumps(response))
+        if status != 200:
+            raise ServiceError(status, response["error"])
+        return response
+
+    def forecast(self, requests: list[dict]) -> list[dict]:
+        return self.request("POST", "/forecast", {"requests": requests})["forecasts"]
+
+    def metrics(self) -> dict:
+        return self.request("GET", "/metrics")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str):
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class Client(LocalClient):
+    # the same calls over one kept-alive http connection
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        socket_path: str | None = None,
+    ):
+        if socket_path is not None:
+            self.connection = UnixHTTPConnection(socket_path)
+        else:
+            self.connection = http.client.HTTPConnection(host, port)
+        self.lock = threading.Lock()
+
+    def request(self, method: str, path: str, payload: dict | None = None) -> dict:
+        body = None if payload is None else json.dumps(payload).encode()
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        with self.lock:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            status, data = response.status, json.loads(response.read())
+        if status != 200:
+            raise ServiceError(status, data["error"])
+        return data
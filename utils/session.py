@@ -0,0 +1,73 @@
+import os
+
+import duckdb as ddb
+import polars as pl
+from utils.profiling import explain
+
+SPILL_PATH = "data/duckdb"
+
+
+class Session:
+    # one DuckDB database for the feature SQL with a fixed thread count,
+    # memory limit and spill directory. a query only sees the frames passed
+    # to it, registered as Arrow views on a cursor of its own, so concurrent
+    # or lazily collected queries never see each other's `df`. None keeps
+    # DuckDB's default (every core, 80% of the RAM, .tmp/)
+    def __init__(
+        self,
+        threads: int | None = None,
+        memory_limit: str | None = None,
+        temp_directory: str | None = None,
+    ):
+        config = {}
+        if threads is not None:
+            config["threads"] = threads
+        if memory_limit is not None:
+            config["memory_limit"] = memory_limit
+        if temp_directory is not None:
+            os.makedirs(temp_directory, exist_ok=True)
+            config["temp_directory"] = temp_directory
+
+        self.con = ddb.connect(config=config)
+
+    def settings(self) -> dict:
+        names = ["threads", "memory_limit", "temp_directory"]
+        values = self.con.execute(
+            f"SELECT {', '.join(f'current_setting({name!r})' for name in names)}"
+        ).fetchone()
+        return dict(zip(names, values))
+
+    def sql(
+        self, query: str, tables: dict[str, pl.DataFrame], name: str = "sql"
+    ) -> ddb.DuckDBPyRelation:
+        # the relation keeps its cursor, and with it the views, alive until
+        # it is collected
+        cursor = self.con.cursor()
+        for table, df in tables.items():
+            cursor.register(table, df.lazy().collect().to_arrow())
+        explain(name, query, cursor)
+
+        return cursor.sql(query)
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+DEFAULT_SESSION = None
+
+
+def get_session(session: Session | None = None) -> Session:
+    # the session a feature function runs its SQL in, a default one with
+    # DuckDB's settings if the caller did not pass one
+    global DEFAULT_SESSION
+    if session is not None:
+        return session
+    if DEFAULT_SESSION is None:
+        DEFAULT_SESSION = Session()
+    return DEFAULT_SESSION
@@ -1,35 +1,95 @@
-import duckdb as ddb
 import polars as pl
+from utils.lag_features import get_offsets
+from utils.rolling import MOMENT_STATS, ORDER_STATS, rolling_stats
+from utils.session import Session, get_session
+from utils.stations import decode_keys, encode_keys
 
 
-def add_stat_features(df, target_col, date_col, cat_cols, intervals, horizon:int = 30):
+def add_stat_features(
+    df,
+    target_col,
+    date_col,
+    cat_cols,
+    intervals,
+    horizon: int = 30,
+    quantile_engine: str = "duckdb",
+    moment_engine: str = "duckdb",
+    n_jobs: int | None = None,
+    session: Session | None = None,
+    prefixes=None,
+):
+    if quantile_engine not in ("duckdb", "sliding"):
+        raise ValueError(
+            f"quantile_engine must be 'duckdb' or 'sliding', got {quantile_engine!r}"
+        )
+    if moment_engine not in ("duckdb", "prefix"):
+        raise ValueError(
+            f"moment_engine must be 'duckdb' or 'prefix', got {moment_engine!r}"
+        )
+
+    native = []
+    if quantile_engine == "sliding":
+        native += ORDER_STATS
+    if moment_engine == "prefix":
+        native += MOMENT_STATS
+
+    shift = None
+    if native:
+        # these are computed in one sorted pass over every series and joined
+        # in, DuckDB only computes the remaining aggregates
+        df = df.lazy().sort(*cat_cols, date_col).collect()
+        if len(native) == len(ORDER_STATS + MOMENT_STATS):
+            # on a regular grid the horizon is a fixed row offset, the stats are
+            # shifted into place and line up with the rows of df, no join needed
+            offsets = get_offsets(df, date_col, cat_cols, [horizon])
+            shift = offsets[0] if offsets else None
+
+        native_df = rolling_stats(
+            df,
+            target_col,
+            date_col,
+            cat_cols,
+            intervals,
+            native,
+            shift=shift or 0,
+            n_jobs=n_jobs,
+            prefixes=prefixes,
+        )
+
     cat_col_str = ", ".join(col for col in cat_cols)
     cat_join_str = " AND ".join(f"a.{col} = b.{col}" for col in cat_cols)
     select_clauses = []
     window_clauses = []
+    feature_columns = []
 
     select_clauses.append(f"{target_col}, {date_col}, {cat_col_str},")
     for interval in intervals:
         suffix = interval.lower().replace(" ", "_")
         window_name = f"w_{suffix}"
 
-        features = f"""
-            AVG({target_col}) OVER {window_name} AS avg_{target_col}_{suffix},
-            MIN({target_col}) OVER {window_name} AS min_{target_col}_{suffix},
-            MAX({target_col}) OVER {window_name} AS max_{target_col}_{suffix},
-            QUANTILE({target_col}, 0.25) OVER {window_name} AS q25_{target_col}_{suffix},
-            QUANTILE({target_col}, 0.50) OVER {window_name} AS q50_{target_col}_{suffix},
-            QUANTILE({target_col}, 0.75) OVER {window_name} AS q75_{target_col}_{suffix},
-            STDDEV_SAMP({target_col}) OVER {window_name} AS std_{target_col}_{suffix},
-            SKEWNESS({target_col}) OVER {window_name} AS skew_{target_col}_{suffix},
-            KURTOSIS({target_col}) OVER {window_name} AS kurt_{target_col}_{suffix},
-            EXP(AVG(LN({target_col}+1)) OVER {window_name}) -1 AS geomean_{target_col}_{suffix},
-            SUM({target_col}) OVER {window_name} AS sum_{target_col}_{suffix},
-            SUM({target_col}*{target_col}) OVER {window_name} AS abs_energy_{target_col}_{suffix},
-            REGR_SLOPE({target_col}, EPOCH({date_col})) OVER {window_name} AS slope_{target_col}_{suffix},
-        """
+        features = {
+            "avg": f"AVG({target_col}) OVER {window_name}",
+            "min": f"MIN({target_col}) OVER {window_name}",
+            "max": f"MAX({target_col}) OVER {window_name}",
+            "q25": f"QUANTILE({target_col}, 0.25) OVER {window_name}",
+            "q50": f"QUANTILE({target_col}, 0.50) OVER {window_name}",
+            "q75": f"QUANTILE({target_col}, 0.75) OVER {window_name}",
+            "std": f"STDDEV_SAMP({target_col}) OVER {window_name}",
+            "skew": f"SKEWNESS({target_col}) OVER {window_name}",
+            "kurt": f"KURTOSIS({target_col}) OVER {window_name}",
+            "geomean": f"EXP(AVG(LN({target_col}+1)) OVER {window_name}) -1",
+            "sum": f"SUM({target_col}) OVER {window_name}",
+            "abs_energy": f"SUM({target_col}*{target_col}) OVER {window_name}",
+            "slope": f"REGR_SLOPE({target_col}, EPOCH({date_col})) OVER {window_name}",
+        }
 
-        select_clauses.append(features)
+        for name, expr in features.items():
+            column = f"{name}_{target_col}_{suffix}"
+            if name in native:
+                feature_columns.append(f"o.{column}")
+            else:
+                select_clauses.append(f"{expr} AS {column},")
+                feature_columns.append(f"b.{column}")
 
         window_def = f"""
         {window_name} AS (
@@ -41,6 +101,51 @@ def add_stat_features(df, target_col, date_col, cat_cols, intervals, horizon:int
 
     full_select_str = "\n    ".join(select_clauses)
     full_window_str = ",\n".join(window_clauses)
+    full_feature_str = ",\n            ".join(feature_columns)
+
+    if shift is not None:
+        return (
+            pl.concat([df, native_df.drop(date_col, *cat_cols)], how="horizontal")
+            .lazy()
+            .select(
+                *df.columns,
+                *[column.removeprefix("o.") for column in feature_columns],
+            )
+            .with_columns(pl.selectors.numeric().cast(pl.Float32))
+        )
+
+    if all(column.startswith("o.") for column in feature_columns):
+        # nothing left for DuckDB to aggregate, join the features in polars
+        return (
+            df.lazy()
+            .join(
+                native_df.lazy().with_columns(
+                    pl.col(date_col) + pl.duration(days=horizon)
+                ),
+                on=[date_col, *cat_cols],
+                how="left",
+                maintain_order="left",
+            )
+            .select(
+                *df.columns,
+                *[column.removeprefix("o.") for column in feature_columns],
+            )
+            .with_columns(pl.selectors.numeric().cast(pl.Float32))
+        )
+
+    df, key_dtypes = encode_keys(df, cat_cols)
+
+    tables = {"df": df}
+    native_join_str = ""
+    if native:
+        tables["native_df"], _ = encode_keys(native_df, cat_cols)
+        native_join_str = f"""
+        LEFT JOIN
+            native_df o
+        ON
+            o.{date_col} + INTERVAL {horizon} DAYS = a.{date_col}
+            AND {" AND ".join(f"a.{col} = o.{col}" for col in cat_cols)}"""
+
     final_query = f"""
         WITH features AS (
             SELECT 
@@ -53,20 +158,21 @@ def add_stat_features(df, target_col, date_col, cat_cols, intervals, horizon:int
 
         SELECT
             a.*,
-            b.* EXCLUDE({date_col}, {target_col}, {cat_col_str})
+            {full_feature_str}
         FROM
             df a
         LEFT JOIN
             features b
         ON
             b.{date_col} + INTERVAL {horizon} DAYS = a.{date_col}
-            AND {cat_join_str}
+            AND {cat_join_str}{native_join_str}
         ORDER BY a.{date_col}
         """
 
     return (
-        ddb.sql(final_query)
+        get_session(session)
+        .sql(final_query, tables, "add_stat_features")
         .pl(lazy=True)
+        .with_columns(decode_keys(key_dtypes))
         .with_columns(pl.selectors.numeric().cast(pl.Float32))
     )
-
@@ -0,0 +1,179 @@
+import os
+
+import polars as pl
+
+REGISTRY_PATH = "data/stations.parquet"
+REGISTRY_SCHEMA = {
+    "line_name": pl.String,
+    "raw_station": pl.String,
+    "station": pl.String,
+}
+
+DIRECTION_SUFFIXES = [
+    " (GUNEY)",
+    " (KUZEY)",
+    " (BATI)",
+    " (DOGU)",
+    " GUNEY",
+    " KUZEY",
+    " BATI",
+    " DOGU",
+]
+
+STATION_MAPPING = {
+    "HASTANE (DOGU/ADLIYE)": "HASTANE",
+    "SABIHA GOKCEN HAVALIMANI": "SABIHA GOKCEN",
+    "M4 KURTKOY": "KURTKOY",
+    "SEYRANTEPE 3 STAD GIRISI": "SEYRANTEPE",
+    "SEYRANTEPE 1": "SEYRANTEPE",
+    "SEYRANTEPE 2": "SEYRANTEPE",
+    "4 LEVENT 2": "4 LEVENT",
+    "LEVENT 2": "LEVENT",
+    "SISLI 2": "SISLI",
+    "OSMANBEY 2": "OSMANBEY",
+    "OTOGAR 1": "OTOGAR",
+    "AKSARAY 1": "AKSARAY",
+    "SIRKECI-4": "SIRKECI",
+    "SIRKECI-3": "SIRKECI",
+    "SIRKECI-2": "SIRKECI",
+    "SIRKECI-1": "SIRKECI",
+    "BAKIRKOY-1": "BAKIRKOY",
+    "BAKIRKOY-2": "BAKIRKOY",
+    "USKUDAR-1": "USKUDAR",
+    "USKUDAR-2": "USKUDAR",
+    "USKUDAR-3": "USKUDAR",
+    "GEBZE-1": "GEBZE",
+    "GEBZE-2": "GEBZE",
+    "KUCUKYALI-1": "KUCUKYALI",
+    "KUCUKYALI-2": "KUCUKYALI",
+    "YENIKAPI-1": "YENIKAPI",
+    "YENIKAPI-2": "YENIKAPI",
+    "YENIKAPI-3": "YENIKAPI",
+    "TERSANE-1": "TERSANE",
+    "TERSANE-2": "TERSANE",
+    "BOSTANCI-1": "BOSTANCI",
+    "BOSTANCI-2": "BOSTANCI",
+    "CEVIZLI-1": "CEVIZLI",
+    "CEVIZLI-2": "CEVIZLI",
+    "EMINONU 2": "EMINONU",
+    "ZEYTINBURNU 2": "ZEYTINBURNU",
+    "KABATAS 2": "KABATAS",
+    "AYRILIKCESME": "AYRILIKCESMESI",
+    "CAMI": "YAVUZSELIM",
+    "KERESTECILER": "MERTER",
+}
+
+
+def canonicalize(raw: pl.Expr) -> pl.Expr:
+    return raw.str.replace_many(DIRECTION_SUFFIXES, [""]).replace(STATION_MAPPING)
+
+
+def load_registry(path: str = REGISTRY_PATH) -> pl.DataFrame:
+    if not os.path.exists(path):
+        return pl.DataFrame(schema=REGISTRY_SCHEMA)
+
+    return pl.read_parquet(path)
+
+
+def update_registry(df: pl.LazyFrame, path: str = REGISTRY_PATH) -> pl.DataFrame:
+    registry = load_registry(path)
+
+    seen = (
+        df.select(pl.col("line_name", "station").cast(pl.String))
+        .unique()
+        .rename({"station": "raw_station"})
+        .collect()
+    )
+    new = seen.join(registry, on=["line_name", "raw_station"], how="anti")
+    if new.is_empty():
+        return registry
+
+    # rows are only ever appended, so the enum codes of known stations and
+    # series never change between runs
+    registry = pl.concat(
+        [
+            registry,
+            new.sort("line_name", "raw_station").with_columns(
+                canonicalize(pl.col("raw_station")).alias("station")
+            ),
+        ]
+    )
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    registry.write_parquet(path)
+
+    return registry
+
+
+def station_dtype(registry: pl.DataFrame) -> pl.Enum:
+    return pl.Enum(registry.get_column("station").unique(maintain_order=True))
+
+
+def series_dtype(registry: pl.DataFrame) -> pl.Enum:
+    return pl.Enum(
+        registry.select(pl.concat_str(["line_name", "station"], separator="_"))
+        .to_series()
+        .unique(maintain_order=True)
+    )
+
+
+def apply_registry(df: pl.LazyFrame, registry: pl.DataFrame) -> pl.LazyFrame:
+    lookup = (
+        registry.select("raw_station", "station")
+        .unique("raw_station", maintain_order=True)
+        .with_columns(
+            pl.col("raw_station").cast(pl.Categorical),
+            pl.col("station").cast(station_dtype(registry)),
+        )
+    )
+
+    return (
+        df.with_columns(pl.col("station").cast(pl.Categorical))
+        .join(lookup.lazy(), left_on="station", right_on="raw_station", how="left")
+        .drop("station")
+        .rename({"station_right": "station"})
+    )
+
+
+def line_station_table(registry: pl.DataFrame, schema: pl.Schema) -> pl.DataFrame:
+    # (line_name, station) -> line_station, typed like the feature table
+    dtype = series_dtype(registry)
+    lines = schema["line_name"]
+    if isinstance(lines, pl.Enum):
+        registry = registry.filter(pl.col("line_name").is_in(lines.categories))
+
+    return (
+        registry.select(
+            "line_name",
+            "station",
+            pl.concat_str(["line_name", "station"], separator="_")
+            .cast(dtype)
+            .alias("line_station"),
+        )
+        .unique(["line_name", "station"], maintain_order=True)
+        .with_columns(
+            pl.col("line_name").cast(lines), pl.col("station").cast(schema["station"])
+        )
+    )
+
+
+def from_codes(col: str, dtype: pl.Enum) -> pl.Expr:
+    codes = pl.col(col).cast(pl.Series(dtype=dtype).to_physical().dtype)
+
+    # integer -> enum casts moved to `cat.to` in newer polars
+    if hasattr(codes.cat, "to"):
+        return codes.cat.to(dtype)
+
+    return codes.cast(dtype)
+
+
+def encode_keys(df, cat_cols: list[str]):
+    # DuckDB decodes enum columns to VARCHAR, hand it the integer codes instead
+    # so the joins and window partitions run on compact integer keys
+    schema = df.collect_schema()
+    dtypes = {col: schema[col] for col in cat_cols if isinstance(schema[col], pl.Enum)}
+
+    return df.with_columns(pl.col(col).to_physical() for col in dtypes), dtypes
+
+
+def decode_keys(dtypes: dict[str, pl.Enum]) -> list[pl.Expr]:
+    return [from_codes(col, dtype) for col, dtype in dtypes.items()]
@@ -0,0 +1,149 @@
+import os
+from datetime import date, timedelta
+
+import numpy as np
+import polars as pl
+from holidays import Turkey
+from utils.densification import get_dense
+from utils.incremental import write_partitions
+from utils.ingest import RAW_SCHEMA, scan_raw
+from utils.pipeline import build_features
+from utils.stations import apply_registry, update_registry
+
+LINES = ["M1", "M2", "M4", "T1", "MARMARAY"]
+PRODUCT_KINDS = ["TAM", "INDIRIMLI"]
+
+# relative demand per hour of the day, metro closed 01:00-06:00, commuter
+# peaks at 08:00 and 18:00
+HOUR_PROFILE = np.array(
+    [0.3, 0, 0, 0, 0, 0, 0.4, 1.4, 2.2, 1.3, 0.8, 0.8]
+    + [0.9, 0.9, 0.9, 1.0, 1.3, 1.9, 2.3, 1.5, 1.0, 0.8, 0.6, 0.4]
+)
+# monday .. sunday
+DOW_PROFILE = np.array([1.0, 1.02, 1.03, 1.03, 1.05, 0.75, 0.55])
+
+
+def line_names(n: int) -> list[str]:
+    return LINES[:n] + [f"L{i}" for i in range(len(LINES), n)]
+
+
+def generate_raw(
+    lines: int = 5,
+    stations: int = 6,
+    days: int = 365,
+    start: date = date(2023, 1, 1),
+    missing: float = 0.01,
+    seed: int = 42,
+) -> pl.DataFrame:
+    # raw rows in the schema of data/hourly_transportation.parquet: one row per
+    # (line, station, day, open hour, product kind) with daily, weekly and
+    # yearly seasonality, a trend, quieter holidays and negative binomial
+    # noise. `missing` of the station hours are dropped like sensor gaps, a
+    # few bus rows check the road_type filter
+    rng = np.random.default_rng(seed)
+    names = line_names(lines)
+    series = [
+        (line, f"{line} STATION {j + 1}") for line in names for j in range(stations)
+    ]
+
+    days_ = np.arange(days)
+    day = np.datetime64(start) + days_
+    # monday = 0, 1970-01-01 was a thursday
+    dow = (day.view("int64") + 3) % 7
+    holidays = set(Turkey(years=range(start.year, start.year + days // 365 + 2)))
+    holiday = np.array([start + timedelta(days=int(d)) in holidays for d in days_])
+    season = 1 + 0.1 * np.cos(2 * np.pi * (days_ - 30) / 365)
+    trend = 1 + 0.05 * days_ / 365
+    daily = DOW_PROFILE[dow] * season * trend * np.where(holiday, 0.6, 1.0)
+
+    open_hours = np.flatnonzero(HOUR_PROFILE > 0)
+    rate = daily[:, None] * HOUR_PROFILE[open_hours][None, :]
+
+    # every station has its own size and a slightly shifted commute
+    scale = rng.lognormal(np.log(300), 0.6, len(series))
+    peak = rng.uniform(0.8, 1.2, len(series))
+    mean = scale[:, None, None] * rate[None] ** peak[:, None, None]
+
+    # gamma-poisson keeps the overdispersion of real counts
+    passage = rng.poisson(rng.gamma(20, mean / 20)).astype(np.int64)
+    keep = rng.random(passage.shape) >= missing
+
+    s, d, h = np.nonzero(keep)
+    passage = passage[keep]
+    # full fare and discounted rows of every station hour
+    full = rng.binomial(passage, 0.6)
+
+    lines_ = np.array([line for line, _ in series])[s]
+    stations_ = np.array([station for _, station in series])[s]
+    rows = pl.DataFrame(
+        {
+            "transition_date": np.repeat(day[d].astype(str), 2),
+            "transition_hour": np.repeat(open_hours[h], 2),
+            "line_name": np.repeat(lines_, 2),
+            "station_poi_desc_cd": np.repeat(stations_, 2),
+            "product_kind": np.tile(PRODUCT_KINDS, len(s)),
+            "number_of_passage": np.column_stack([full, passage - full]).ravel(),
+        }
+    )
+
+    bus = rows.head(max(1, len(rows) // 1000)).with_columns(
+        pl.lit("OTOYOL").alias("road_type"),
+        pl.lit(None, pl.String).alias("station_poi_desc_cd"),
+        pl.lit(2).alias("transport_type_id"),
+    )
+    rows = pl.concat(
+        [
+            rows.with_columns(
+                pl.lit("RAYLI").alias("road_type"), pl.lit(1).alias("transport_type_id")
+            ),
+            bus,
+        ]
+    )
+
+    return rows.with_columns(
+        pl.col("line_name").alias("line"),
+        pl.lit("Aktarma").alias("transfer_type"),
+        # a passenger can pass more than once, counts sit a little lower
+        (pl.col("number_of_passage") * 0.9)
+        .round()
+        .cast(pl.Int64)
+        .alias("number_of_passenger"),
+        pl.lit("Tam").alias("transaction_type_desc"),
+        pl.lit("FATIH").alias("town"),
+    ).select(pl.col(col).cast(dtype) for col, dtype in RAW_SCHEMA.items())
+
+
+def write_raw(path: str, **kwargs) -> str:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    generate_raw(**kwargs).write_parquet(path)
+    return path
+
+
+def build_xy(
+    path: str,
+    intervals: list[str],
+    lags: list[int],
+    horizon: int = 30,
+    lines: int = 5,
+    **kwargs,
+) -> pl.DataFrame:
+    # data/Xy/ of synthetic raw data the way process-data.py builds it, the
+    # raw file, the station registry and the Xy/ partitions go under `path`
+    raw_path = write_raw(os.path.join(path, "raw.parquet"), lines=lines, **kwargs)
+    df = scan_raw(raw_path, line_names(lines))
+    registry = update_registry(df, os.path.join(path, "stations.parquet"))
+    df = (
+        apply_registry(df, registry)
+        .group_by("line_name", "station", "timestamp")
+        .agg(pl.sum("number_of_passage").alias("passage"))
+        .sort("line_name", "station", "timestamp")
+    )
+
+    cat_cols = ["line_name", "station"]
+    dense = get_dense(df, "passage", "timestamp", cat_cols).collect()
+    Xy = build_features(
+        dense, "passage", "timestamp", cat_cols, intervals, lags, horizon
+    ).collect()
+    write_partitions(Xy, os.path.join(path, "Xy"), "timestamp", cat_cols)
+
+    return Xy
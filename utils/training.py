@@ -0,0 +1,405 @@
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from glob import glob
+
+import numpy as np
+import polars as pl
+from sklearn.metrics import median_absolute_error
+from tqdm import tqdm
+from utils.matrix import (
+    Matrix,
+    XyBatches,
+    category_dtype,
+    external_dmatrix,
+    get_matrix,
+    slice_matrix,
+    to_dmatrix,
+)
+from utils.metrics import MetricAccumulator, finish_metrics, metric_exprs
+from utils.profiling import profile
+import xgboost
+
+
+@dataclass
+class Range:
+    start: datetime
+    end: datetime
+
+
+def rolling_origin_splits(
+    end: datetime,
+    n_folds: int,
+    horizon: timedelta,
+    step: timedelta | None = None,
+    grain: str = "1h",
+) -> list[Range]:
+    # n_folds test windows of `horizon`, the origin moves by `step` (horizon by
+    # default) and the last window ends at `end`. on a rollup the end moves
+    # back to the start of its bucket, which is the timestamp the bucket has
+    step = step or horizon
+    end = pl.Series([end]).dt.truncate(grain).item()
+    return [
+        Range(start=end - horizon - k * step, end=end - k * step)
+        for k in reversed(range(n_folds))
+    ]
+
+
+test_split = rolling_origin_splits(datetime(2024, 6, 30, 23, 0), 4, timedelta(days=30))
+
+
+def time_index(df: pl.DataFrame, date_col) -> np.ndarray:
+    # df must be sorted by date_col, rows with date_col <= t are df[:offset(t)]
+    return df.get_column(date_col).to_numpy()
+
+
+def time_rows(
+    index: np.ndarray, start: datetime | None, end: datetime | None
+) -> tuple[int, int]:
+    # (offset, length) of the rows with start < date_col <= end
+    lo, hi = 0, len(index)
+    if start is not None:
+        lo = np.searchsorted(index, np.datetime64(start), "right")
+    if end is not None:
+        hi = np.searchsorted(index, np.datetime64(end), "right")
+    return int(lo), int(max(hi - lo, 0))
+
+
+def time_slice(
+    df: pl.DataFrame, index: np.ndarray, start: datetime | None, end: datetime | None
+) -> pl.DataFrame:
+    # start < date_col <= end as a zero-copy slice of the sorted frame
+    return df.slice(*time_rows(index, start, end))
+
+
+BACKENDS = ["auto", "cpu", "cuda"]
+
+
+def get_device(backend: str = "auto") -> str:
+    # auto is cuda only with a cuda build of xgboost and a visible gpu
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend}, expected one of {BACKENDS}")
+    if backend != "auto":
+        return backend
+
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES") != ""
+    if xgboost.build_info().get("USE_CUDA") and visible and glob("/dev/nvidia[0-9]*"):
+        return "cuda"
+    return "cpu"
+
+
+def backend_params(backend: str = "auto", nthread: int | None = None) -> dict:
+    params = {"device": get_device(backend)}
+    if nthread is not None:
+        params["nthread"] = nthread
+    return params
+
+
+def train_xgb(
+    dtrain: xgboost.DMatrix,
+    params,
+    deval: xgboost.DMatrix | None = None,
+    early_stopping_rounds: int | None = None,
+    xgb_model: xgboost.Booster | None = None,
+    backend: str = "auto",
+    nthread: int | None = None,
+) -> xgboost.Booster:
+    # with deval and early_stopping_rounds, n_estimators is only an upper
+    # bound, with xgb_model the trees are added to that booster. histogram
+    # options (max_bin, max_cached_hist_node) go in params, max_bin has to
+    # match the one dtrain was built with
+    params = {
+        "random_state": 42,
+        "verbosity": 0,
+        "eval_metric": "mae",
+        "tree_method": "hist",
+        **backend_params(backend, nthread),
+        **params,
+    }
+    n_estimators = params.pop("n_estimators", 100)
+
+    return xgboost.train(
+        params,
+        dtrain,
+        num_boost_round=n_estimators,
+        evals=[(deval, "eval")] if deval is not None else (),
+        early_stopping_rounds=early_stopping_rounds if deval is not None else None,
+        verbose_eval=False,
+        xgb_model=xgb_model,
+    )
+
+
+def predict_xgb(
+    X,
+    xgb: xgboost.Booster,
+    log1p: bool = True,
+    backend: str | None = "auto",
+    nthread: int | None = None,
+):
+    # X is a feature frame from get_matrix, an early stopped booster predicts
+    # with its best iteration. backend=None keeps the booster's settings, so
+    # threads sharing a booster do not reconfigure it
+    if backend is not None:
+        xgb.set_param(backend_params(backend, nthread))
+    iteration_range = (0, 0)
+    if "best_iteration" in xgb.attributes():
+        iteration_range = (0, xgb.best_iteration + 1)
+    y_pred = xgb.inplace_predict(X, iteration_range=iteration_range)
+
+    if log1p:
+        y_pred = np.expm1(y_pred)
+
+    return y_pred
+
+
+def get_folds(
+    df: pl.DataFrame,
+    target_col,
+    date_col,
+    cat_col,
+    log1p: bool = True,
+    grain: str = "1h",
+    build_matrix: bool = True,
+) -> tuple[pl.DataFrame, np.ndarray, Matrix | None]:
+    # the splits are cut on bucket starts, a table of a finer grain than the
+    # one they were built for would put part of a bucket in the wrong window
+    if not df.select(
+        (pl.col(date_col).dt.truncate(grain) == pl.col(date_col)).all()
+    ).item():
+        raise ValueError(f"{date_col} is not on the {grain} grain")
+
+    df = df.with_columns(
+        [
+            df[col].cast(pl.Float32)
+            for col, dtype in zip(df.columns, df.dtypes)
+            if dtype == pl.Float64
+        ]
+    )
+    # sorted once, every fold is then a slice of the same buffers instead of
+    # a filtered copy. the sort is stable, input already in time order keeps
+    # its row order
+    df = df.sort(date_col, maintain_order=True)
+    index = time_index(df, date_col)
+
+    # one feature matrix with a fixed category dictionary, the folds are row
+    # views of it. without build_matrix the folds convert their own rows
+    matrix = None
+    if build_matrix:
+        matrix = get_matrix(df, target_col, date_col, cat_col, log1p)
+
+    return df, index, matrix
+
+
+def rows_matrix(
+    df: pl.DataFrame,
+    matrix: Matrix | None,
+    rows: tuple[int, int],
+    target_col,
+    date_col,
+    cat_col,
+    log1p: bool,
+    dtype: pl.Enum,
+) -> Matrix:
+    # a row view of the full matrix, or a matrix of just these rows
+    if matrix is not None:
+        return slice_matrix(matrix, *rows)
+    return get_matrix(
+        df.slice(*rows), target_col, date_col, cat_col, log1p, dtype=dtype
+    )
+
+
+def batch_dmatrix(
+    df: pl.DataFrame,
+    rows: tuple[int, int],
+    target_col,
+    date_col,
+    cat_col,
+    log1p: bool,
+    dtype: pl.Enum,
+    path: str,
+    batch_rows: int,
+    ref: xgboost.DMatrix | None = None,
+    max_bin: int | None = None,
+    nthread: int | None = None,
+) -> xgboost.DMatrix:
+    # the rows as an external memory matrix, converted batch_rows at a time
+    # with the histogram pages written under path
+    offset, length = rows
+    batches = [
+        df.lazy().slice(start, min(batch_rows, offset + length - start))
+        for start in range(offset, offset + length, batch_rows)
+    ]
+    return external_dmatrix(
+        XyBatches(batches, target_col, date_col, cat_col, dtype, log1p, cache_dir=path),
+        ref,
+        max_bin,
+        nthread,
+    )
+
+
+def fit(
+    df: pl.DataFrame,
+    target_col,
+    date_col,
+    cat_col,
+    params,
+    log1p: bool = True,
+    backend: str = "auto",
+    nthread: int | None = None,
+    grain: str = "1h",
+) -> tuple[xgboost.Booster, Matrix]:
+    # one model on every row of df, the one that is persisted and served
+    df, _, matrix = get_folds(df, target_col, date_col, cat_col, log1p, grain)
+    dtrain = to_dmatrix(matrix, max_bin=params.get("max_bin"), nthread=nthread)
+    xgb = train_xgb(dtrain, params, backend=backend, nthread=nthread)
+
+    return xgb, matrix
+
+
+def cv(
+    df: pl.DataFrame,
+    target_col,
+    date_col,
+    cat_col,
+    params,
+    log1p: bool = True,
+    warm_start: bool = False,
+    warm_rounds: int = 100,
+    early_stopping_rounds: int | None = None,
+    holdout_days: int = 14,
+    splits: list[Range] = test_split,
+    backend: str = "auto",
+    nthread: int | None = None,
+    grain: str = "1h",
+    external_memory: str | None = None,
+    batch_rows: int = 2**16,
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    # the training windows are nested, with warm_start every fold after the
+    # first adds warm_rounds trees to the previous fold's booster instead of
+    # training n_estimators from scratch. with early_stopping_rounds the last
+    # holdout_days of every training window are held out to stop on. with
+    # external_memory (a directory) no feature matrix of the whole frame is
+    # built, the training rows of a fold reach xgboost batch_rows at a time
+    # and its histogram pages are written there
+    df, index, matrix = get_folds(
+        df,
+        target_col,
+        date_col,
+        cat_col,
+        log1p,
+        grain,
+        build_matrix=external_memory is None,
+    )
+    dtype = category_dtype(df, cat_col)
+    matrix_options = (target_col, date_col, cat_col, log1p, dtype)
+    dmatrix_options = {"max_bin": params.get("max_bin"), "nthread": nthread}
+    if external_memory is not None:
+        os.makedirs(external_memory, exist_ok=True)
+
+    # only the key, target and prediction of a fold are kept, and only until
+    # its metrics are taken: every (split, cat_col) exactly, the per cat_col
+    # accumulator is merged fold by fold
+    xgb = None
+    by_split = []
+    by_cat = MetricAccumulator([cat_col], target_col)
+    mae = []
+    mape = []
+    rmse = []
+    mae_w = []
+    for i, split in enumerate(tqdm(splits, desc="Processing test splits")):
+        with profile("cv_fold", fold=i) as record:
+            train_rows = time_rows(index, None, split.start)
+            test_rows = time_rows(index, split.start, split.end)
+
+            deval = None
+            if early_stopping_rounds is not None:
+                cutoff = split.start - timedelta(days=holdout_days)
+                eval_rows = time_rows(index, cutoff, split.start)
+                train_rows = time_rows(index, None, cutoff)
+
+            record["rows_in"], record["rows_out"] = train_rows[1], test_rows[1]
+            pages = None
+            with profile("to_dmatrix", rows_in=train_rows[1]):
+                if external_memory is None:
+                    dtrain = to_dmatrix(
+                        slice_matrix(matrix, *train_rows), **dmatrix_options
+                    )
+                else:
+                    pages = tempfile.mkdtemp(dir=external_memory)
+                    dtrain = batch_dmatrix(
+                        df,
+                        train_rows,
+                        *matrix_options,
+                        pages,
+                        batch_rows,
+                        **dmatrix_options,
+                    )
+                if early_stopping_rounds is not None:
+                    deval = to_dmatrix(
+                        rows_matrix(df, matrix, eval_rows, *matrix_options),
+                        ref=dtrain,
+                        **dmatrix_options,
+                    )
+
+            tqdm.write(f"Train: {train_rows[1]} / Test:  {test_rows[1]}")
+
+            fold_params, xgb_model = params, None
+            if warm_start and xgb is not None:
+                fold_params = {**params, "n_estimators": warm_rounds}
+                # trees past the early stopping point are not carried over
+                xgb_model = xgb
+                if early_stopping_rounds is not None:
+                    xgb_model = xgb[: xgb.best_iteration + 1]
+
+            with profile("train_xgb", rows_in=train_rows[1]):
+                xgb = train_xgb(
+                    dtrain,
+                    fold_params,
+                    deval,
+                    early_stopping_rounds=early_stopping_rounds,
+                    xgb_model=xgb_model,
+                    backend=backend,
+                    nthread=nthread,
+                )
+            if pages is not None:
+                # the pages are read until the fold's matrices are freed
+                del dtrain, deval
+                shutil.rmtree(pages)
+
+            with profile("predict_xgb", rows_in=test_rows[1]) as predicted:
+                y_pred = predict_xgb(
+                    rows_matrix(df, matrix, test_rows, *matrix_options).X,
+                    xgb,
+                    log1p,
+                    backend,
+                    nthread,
+                )
+                predicted["rows_out"] = len(y_pred)
+
+            fold = (
+                df.slice(*test_rows)
+                .select(cat_col, target_col)
+                .with_columns(pl.Series("prediction", y_pred), pl.lit(i).alias("split"))
+            )
+            with profile("fold_metrics", rows_in=len(fold)):
+                by_split.append(
+                    fold.group_by("split", cat_col).agg(metric_exprs(target_col))
+                )
+                by_cat.update(fold)
+
+            overall = fold.select(metric_exprs(target_col)).row(0, named=True)
+            y = fold.get_column(target_col).to_numpy()
+            mape.append(overall["mape"])
+            mae.append(overall["medae"])
+            mae_w.append(median_absolute_error(y, y_pred, sample_weight=1 / y))
+            rmse.append(overall["rmse"])
+
+    print("MAE: {:.4f} {}".format(np.array(mae).mean(), np.array(mae)))
+    print("MAE-w: {:.4f} {}".format(np.array(mae_w).mean(), np.array(mae_w)))
+    print("MAPE: {:.4f} {}".format(np.array(mape).mean(), np.array(mape)))
+    print("RMSE: {:.4f}".format(np.array(rmse).mean()))
+
+    by_all = finish_metrics(pl.concat(by_split), ["split", cat_col]).collect()
+    return by_all, by_cat.result()